@@ -0,0 +1,87 @@
+"""Benchmarks of the Yubival verification hot path
+
+Usage:
+    python -m benchmarks run [--output results.json] [--iterations N] [--repeat N] [--threads N]
+    python -m benchmarks compare baseline.json results.json [--threshold 0.1]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+from benchmarks.compare import compare, load_results
+
+
+def run(args):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    database = settings.DATABASES['default']['NAME']
+    if os.path.exists(database):
+        os.remove(database)
+    django.setup()
+    call_command('migrate', verbosity=0)
+
+    from benchmarks.suite import run_benchmarks
+
+    results = run_benchmarks(args.iterations, args.repeat, args.threads)
+
+    for name, values in sorted(results.items()):
+        print('{:<40} {:>12.0f} ops/s {:>10.1f} us/op'.format(
+            name, values['ops_per_second'], values['seconds_per_op'] * 1e6,
+        ))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'date': datetime.datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'benchmarks': results,
+            }, f, indent=2, sort_keys=True)
+
+
+def compare_results(args):
+    rows = compare(load_results(args.baseline), load_results(args.results), args.threshold)
+
+    for name, before, after, change, is_regression in rows:
+        print('{:<40} {:>12.0f} {:>12.0f} ops/s {:>+8.1%}{}'.format(
+            name, before, after, change, '  REGRESSION' if is_regression else '',
+        ))
+
+    if any(row[-1] for row in rows):
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmarks Yubival OTP verification')
+    subparsers = parser.add_subparsers(title='subcommands', dest='subcommand')
+    subparsers.required = True
+
+    parser_run = subparsers.add_parser('run', description='Runs the benchmarks on a new SQLite database')
+    parser_run.add_argument('--output', help='JSON file where results are written')
+    parser_run.add_argument('--iterations', type=int, default=200, help='end-to-end verifications per run')
+    parser_run.add_argument('--repeat', type=int, default=5, help='number of runs of each benchmark')
+    parser_run.add_argument('--threads', type=int, default=4, help='threads of the multi-thread benchmark')
+    parser_run.set_defaults(func=run)
+
+    parser_compare = subparsers.add_parser('compare', description='Compares results to a baseline')
+    parser_compare.add_argument('baseline', help='baseline JSON results')
+    parser_compare.add_argument('results', help='new JSON results')
+    parser_compare.add_argument(
+        '--threshold', type=float, default=0.1,
+        help='relative throughput decrease reported as a regression (default: 0.1)',
+    )
+    parser_compare.set_defaults(func=compare_results)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import json
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['benchmarks']
+
+
+def compare(baseline, results, threshold):
+    """Compares benchmark results to a baseline
+
+    Args:
+        baseline: dictionary of baseline results, by benchmark name.
+        results: dictionary of new results, by benchmark name.
+        threshold: relative throughput decrease above which a benchmark is reported as a regression.
+
+    Returns:
+        rows: list of `(name, baseline_ops_per_second, ops_per_second, relative_change, is_regression)` tuples for the
+            benchmarks present in both dictionaries.
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(results)):
+        before = baseline[name]['ops_per_second']
+        after = results[name]['ops_per_second']
+        change = (after - before) / before
+        rows.append((name, before, after, change, change < -threshold))
+    return rows
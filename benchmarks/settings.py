@@ -0,0 +1,36 @@
+import os
+import tempfile
+
+SECRET_KEY = 'yubival-benchmarks'
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['testserver']
+
+INSTALLED_APPS = [
+    'yubival',
+]
+
+MIDDLEWARE = [
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'yubival.urls'
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get(
+            'YUBIVAL_BENCHMARK_DB',
+            os.path.join(tempfile.gettempdir(), 'yubival-benchmarks.sqlite3'),
+        ),
+        'OPTIONS': {
+            'timeout': 30,
+        },
+    }
+}
+
+USE_TZ = True
+
+DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
@@ -0,0 +1,145 @@
+import statistics
+import threading
+import time
+
+from django.db import connections
+from django.http import QueryDict
+from django.test import Client
+from yubiotp.otp import decode_otp
+
+from yubival.counters import DjangoCounterStore, MemoryCounterStore
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey
+from yubival.models import APIKey, Device
+from yubival.query import SignedQuery
+from yubival.views import DeviceKeyMaterial, SigningKey, VerificationResponse, hmac_sign_string, \
+    is_request_signature_valid, ordered_parameters_string, parse_response, response_signature
+
+
+VERIFY_URL = '/wsapi/2.0/verify'
+
+
+def measure(func, iterations, repeat):
+    """Runs `func` `repeat` times `iterations` times and returns the median duration of a call in seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        timings.append((time.perf_counter() - start) / iterations)
+    return statistics.median(timings)
+
+
+def result(seconds_per_op):
+    return {
+        'seconds_per_op': seconds_per_op,
+        'ops_per_second': 1 / seconds_per_op,
+    }
+
+
+def micro_benchmarks(client, device, iterations, repeat):
+    """Returns the results of the benchmarks of each verification stage"""
+    yubikey = SyntheticYubiKey.from_device(device)
+    key = client.key
+    signing_key = SigningKey(key)
+    query_string = client.verify_query(yubikey)
+    query = QueryDict(query_string)
+    unsigned_query = query.copy()
+    del unsigned_query['h']
+    text = ordered_parameters_string(unsigned_query, escape=True)
+    response_text = (
+        'status=OK\r\n'
+        't=2021-10-29T08:31:11.885803\r\n'
+        'nonce=%s\r\n'
+        'otp=%s\r\n'
+        'sl=1\r\n'
+    ) % (query['nonce'], query['otp'])
+    response = VerificationResponse(parse_response(response_text))
+    token = query['otp'].encode('utf-8')
+    device_key = yubikey.key
+    key_material = DeviceKeyMaterial(device.private_id, device.key)
+
+    django_store = DjangoCounterStore()
+    memory_store = MemoryCounterStore()
+    counters = iter(range(1, 2**31))
+
+    benchmarks = {
+        'ordered_parameters_string': lambda: ordered_parameters_string(unsigned_query, escape=True),
+        'hmac_sign_string': lambda: hmac_sign_string(text, key),
+        'signing_key_sign': lambda: signing_key.sign(text),
+        'is_request_signature_valid': lambda: is_request_signature_valid(query, signing_key),
+        'signed_query_signature_valid': lambda: is_request_signature_valid(
+            SignedQuery(query_string), signing_key,
+        ),
+        'response_signature': lambda: response_signature(response_text, signing_key),
+        'verification_response_render': lambda: response.render(signing_key),
+        'yubiotp_decode_otp': lambda: decode_otp(token, device_key),
+        'device_key_material_decode_otp': lambda: key_material.decode_otp(token),
+        'django_counter_store_advance': lambda: django_store.advance(
+            device.public_id, divmod(next(counters), 256), key_material,
+        ),
+        'memory_counter_store_advance': lambda: memory_store.advance(
+            device.public_id, divmod(next(counters), 256), key_material,
+        ),
+    }
+    return {
+        'stage.%s' % name: result(measure(func, iterations, repeat))
+        for name, func in benchmarks.items()
+    }
+
+
+def verify_single_thread(client, yubikey, iterations, repeat):
+    """Returns the result of end-to-end verifications from a single thread"""
+    http_client = Client()
+
+    def verify():
+        response = http_client.get(VERIFY_URL, QueryDict(client.verify_query(yubikey)))
+        assert b'status=OK' in response.content, response.content
+
+    return result(measure(verify, iterations, repeat))
+
+
+def verify_multi_thread(client, yubikeys, iterations):
+    """Returns the result of end-to-end verifications from one thread per YubiKey
+
+    Each thread verifies `iterations` OTPs of its own YubiKey.
+    """
+    errors = []
+    barrier = threading.Barrier(len(yubikeys) + 1)
+
+    def run(yubikey):
+        http_client = Client()
+        barrier.wait()
+        try:
+            for _ in range(iterations):
+                response = http_client.get(VERIFY_URL, QueryDict(client.verify_query(yubikey)))
+                if b'status=OK' not in response.content:
+                    errors.append(response.content)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(yubikey,)) for yubikey in yubikeys]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        raise RuntimeError('%d verifications failed, first response: %r' % (len(errors), errors[0]))
+    return result(elapsed / (iterations * len(yubikeys)))
+
+
+def run_benchmarks(iterations, repeat, threads):
+    """Creates synthetic clients and YubiKeys and returns the results of all benchmarks, by name"""
+    client = SyntheticClient.from_api_key(APIKey.objects.create(label='benchmark'))
+    devices = [Device.objects.create(label='benchmark %d' % i) for i in range(threads + 2)]
+    # The stage benchmarks advance the counters of the first device, which is then not used for verifications:
+    yubikeys = [SyntheticYubiKey.from_device(device) for device in devices]
+
+    results = micro_benchmarks(client, devices[0], iterations * 10, repeat)
+    results['verify.single_thread'] = verify_single_thread(client, yubikeys[1], iterations, repeat)
+    if threads > 1:
+        results['verify.threads_%d' % threads] = verify_multi_thread(client, yubikeys[2:], iterations)
+    return results
@@ -0,0 +1,158 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.urls import reverse
+
+from yubival.admin import LargeTablePaginator
+from yubival.cache import device_cache
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
+
+
+class AdminTestCase(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+
+class DeviceAdminTest(AdminTestCase):
+    def test_changelist_does_not_load_key_material(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'))
+
+        # THEN
+        self.assertContains(response, device.public_id)
+        self.assertNotIn('key', response.context['cl'].result_list[0].__dict__)
+        self.assertNotIn('private_id', response.context['cl'].result_list[0].__dict__)
+
+    def test_changelist_shows_counters(self):
+        # GIVEN
+        for i in range(3):
+            device = Device.objects.create(label='Device %d' % i)
+            DeviceCounter.objects.filter(device=device).update(value=pack_counters(0, 42))
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'))
+
+        # THEN
+        self.assertContains(response, '<td class="field-usage_counter">42</td>', count=3, html=True)
+
+    def test_changelist_shows_bulk_delete_action_and_counter_columns(self):
+        # GIVEN
+        Device.objects.create(label='John')
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'))
+
+        # THEN
+        self.assertContains(response, '<option value="bulk_delete">Delete selected devices</option>', html=True)
+        self.assertContains(response, 'Session counter')
+        self.assertContains(response, 'Usage counter')
+
+    def test_search_by_otp_finds_device(self):
+        # GIVEN
+        device = Device.objects.create(label='John', public_id='cccccccccccb')
+        Device.objects.create(label='Jane', public_id='cccccccccccd')
+        otp = 'cccccccccccb' + 'dteffujehknhfjbrjnlnldnhcujvddbi'
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'), {'q': otp})
+
+        # THEN
+        self.assertEqual([device], list(response.context['cl'].result_list))
+
+    def test_search_by_label_prefix(self):
+        # GIVEN
+        Device.objects.create(label='lab-1')
+        Device.objects.create(label='office-1')
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'), {'q': 'lab'})
+
+        # THEN
+        self.assertEqual(['lab-1'], [device.label for device in response.context['cl'].result_list])
+
+    def test_bulk_delete_resets_counters_and_cache(self):
+        # GIVEN
+        devices = [Device.objects.create(label='Device %d' % i) for i in range(3)]
+        device_cache.set(devices[0].public_id, 'cached')
+
+        # WHEN
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:yubival_device_changelist'), {
+                'action': 'bulk_delete',
+                '_selected_action': [devices[0].pk, devices[1].pk],
+            }, follow=True)
+
+        # THEN
+        self.assertContains(response, 'Successfully deleted 2 devices.')
+        self.assertEqual([devices[2]], list(Device.objects.all()))
+        self.assertEqual([devices[2].pk], list(DeviceCounter.objects.values_list('device_id', flat=True)))
+        self.assertIsNone(device_cache.get(devices[0].public_id))
+
+    def test_default_delete_action_is_not_available(self):
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_changelist'))
+
+        # THEN
+        action_choices = [name for name, _ in response.context['action_form'].fields['action'].choices]
+        self.assertNotIn('delete_selected', action_choices)
+        self.assertIn('bulk_delete', action_choices)
+
+
+class APIKeyAdminTest(AdminTestCase):
+    def test_bulk_delete(self):
+        # GIVEN
+        key = APIKey.objects.create(label='Key')
+
+        # WHEN
+        response = self.client.post(reverse('admin:yubival_apikey_changelist'), {
+            'action': 'bulk_delete',
+            '_selected_action': [key.pk],
+        }, follow=True)
+
+        # THEN
+        self.assertContains(response, 'Successfully deleted 1 api key.')
+        self.assertFalse(APIKey.objects.exists())
+
+    def test_search_uses_case_sensitive_label_prefix(self):
+        # GIVEN
+        APIKey.objects.create(label='web-1')
+        APIKey.objects.create(label='mobile-1')
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_apikey_changelist'), {'q': ' web '})
+
+        # THEN
+        changelist = response.context['cl']
+        self.assertEqual(['web-1'], [key.label for key in changelist.result_list])
+        # An `istartswith` lookup would compare upper-cased labels, which no index covers:
+        self.assertEqual(['startswith'], [lookup.lookup_name for lookup in changelist.queryset.query.where.children])
+
+
+class LargeTablePaginatorTest(TestCase):
+    def test_count_is_exact_below_limit(self):
+        # GIVEN
+        for i in range(3):
+            APIKey.objects.create(label='Key %d' % i)
+
+        # WHEN
+        count = LargeTablePaginator(APIKey.objects.order_by('id'), 2).count
+
+        # THEN
+        self.assertEqual(3, count)
+
+    def test_count_is_capped_above_limit(self):
+        # GIVEN
+        for i in range(3):
+            APIKey.objects.create(label='Key %d' % i)
+
+        # WHEN
+        with mock.patch('yubival.admin.ADMIN_COUNT_LIMIT', 2):
+            count = LargeTablePaginator(APIKey.objects.order_by('id'), 2).count
+
+        # THEN
+        self.assertEqual(3, count)
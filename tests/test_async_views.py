@@ -0,0 +1,73 @@
+import asyncio
+import base64
+
+from asgiref.sync import async_to_sync
+from django.http import QueryDict
+from django.test import RequestFactory, TransactionTestCase
+
+from yubival.models import APIKey, Device
+from yubival.views import AsyncVerifyView, hmac_sign_string, ordered_parameters_string
+
+from tests.test_views import get_status_from_response, unique_nonce
+
+
+class TestAsyncVerifyView(TransactionTestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(key=base64.b64encode(b'000000000001').decode('utf-8'))
+
+        # Example at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
+        Device.objects.create(
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+
+    def get(self, params):
+        q = QueryDict('', mutable=True)
+        q.update(params)
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        request = RequestFactory().get('/wsapi/2.0/verify?%s' % q.urlencode())
+        return async_to_sync(AsyncVerifyView.as_view())(request)
+
+    def test_valid_otp_gives_ok_status(self):
+        # WHEN
+        response = self.get({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        })
+
+        # THEN
+        self.assertEqual('OK', get_status_from_response(response))
+
+    def test_replayed_otp_gives_replayed_otp_status(self):
+        # GIVEN
+        params = {
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        }
+        self.get(params)
+
+        # WHEN
+        response = self.get(dict(params, nonce=unique_nonce()))
+
+        # THEN
+        self.assertEqual('REPLAYED_OTP', get_status_from_response(response))
+
+    def test_post_is_not_allowed(self):
+        # GIVEN
+        request = RequestFactory().post('/wsapi/2.0/verify')
+
+        # WHEN
+        response = async_to_sync(AsyncVerifyView.as_view())(request)
+
+        # THEN
+        self.assertEqual(405, response.status_code)
+
+    def test_view_is_detected_as_asynchronous(self):
+        # WHEN
+        view = AsyncVerifyView.as_view()
+
+        # THEN
+        self.assertTrue(asyncio.iscoroutinefunction(view))
@@ -0,0 +1,116 @@
+import base64
+
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from yubiotp.otp import OTP, encode_otp
+
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
+from yubival.views import hmac_sign_string, ordered_parameters_string, parse_response
+
+from tests.test_views import unique_nonce
+
+
+def make_token(public_id, private_id, key, session, counter):
+    otp = OTP(bytes.fromhex(private_id), session, 0x1234, counter, 0x5678)
+    return encode_otp(otp, bytes.fromhex(key), public_id.encode('utf-8')).decode('utf-8')
+
+
+class TestBatchVerifyView(TestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(key=base64.b64encode(b'000000000001').decode('utf-8'))
+        self.public_id = 'cdcdcdcdcdcd'
+        self.private_id = '010203040506'
+        self.key = '000102030405060708090a0b0c0d0e0f'
+        Device.objects.create(
+            public_id=self.public_id,
+            private_id=self.private_id,
+            key=self.key,
+        )
+        self.nonce = unique_nonce()
+
+    def token(self, session, counter):
+        return make_token(self.public_id, self.private_id, self.key, session, counter)
+
+    def query(self, tokens):
+        q = QueryDict('', mutable=True)
+        q['id'] = str(self.api_key.id)
+        for n, token in enumerate(tokens, 1):
+            q['otp%d' % n] = token
+            q['nonce%d' % n] = '%s-%d' % (self.nonce, n)
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        return q
+
+    def get(self, tokens):
+        response = self.client.get('/wsapi/2.0/verify_batch?%s' % self.query(tokens).urlencode())
+        return parse_response(response.content.decode('utf-8'))
+
+    def test_otps_of_same_device_are_accepted_in_counter_order(self):
+        # WHEN
+        params = self.get([self.token(1, 2), self.token(1, 1), self.token(2, 0)])
+
+        # THEN
+        self.assertEqual('OK', params['status'])
+        self.assertEqual(['OK', 'OK', 'OK'], [params['status1'], params['status2'], params['status3']])
+        counter = DeviceCounter.objects.get(device__public_id=self.public_id)
+        self.assertEqual((2, 0), (counter.session_counter, counter.usage_counter))
+
+    def test_repeated_otp_is_replayed(self):
+        # GIVEN
+        token = self.token(1, 1)
+
+        # WHEN
+        params = self.get([token, token])
+
+        # THEN
+        self.assertEqual(['OK', 'REPLAYED_OTP'], [params['status1'], params['status2']])
+
+    def test_otp_older_than_device_counters_is_replayed(self):
+        # GIVEN
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(1, 5))
+
+        # WHEN
+        params = self.get([self.token(1, 5), self.token(1, 6)])
+
+        # THEN
+        self.assertEqual(['REPLAYED_OTP', 'OK'], [params['status1'], params['status2']])
+
+    def test_unknown_device_gives_bad_otp(self):
+        # WHEN
+        params = self.get([make_token('cccccccccccc', self.private_id, self.key, 1, 1), self.token(1, 1)])
+
+        # THEN
+        self.assertEqual(['BAD_OTP', 'OK'], [params['status1'], params['status2']])
+        self.assertEqual('%s-1' % self.nonce, params['nonce1'])
+
+    def test_wrong_signature_gives_bad_signature_status(self):
+        # GIVEN
+        q = self.query([self.token(1, 1)])
+        q['h'] = 'pOHpsdCn3f5pazYy4MK7P+Ol6zk='
+
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify_batch?%s' % q.urlencode())
+
+        # THEN
+        params = parse_response(response.content.decode('utf-8'))
+        self.assertEqual('BAD_SIGNATURE', params['status'])
+        self.assertNotIn('status1', params)
+
+    @override_settings(YUBIVAL_BATCH_MAX_SIZE=1)
+    def test_oversized_batch_is_not_allowed(self):
+        # WHEN
+        params = self.get([self.token(1, 1), self.token(1, 2)])
+
+        # THEN
+        self.assertEqual('OPERATION_NOT_ALLOWED', params['status'])
+
+    def test_post_request(self):
+        # WHEN
+        response = self.client.post(
+            '/wsapi/2.0/verify_batch',
+            self.query([self.token(1, 1)]).urlencode(),
+            content_type='application/x-www-form-urlencoded',
+        )
+
+        # THEN
+        params = parse_response(response.content.decode('utf-8'))
+        self.assertEqual('OK', params['status1'])
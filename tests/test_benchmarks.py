@@ -0,0 +1,27 @@
+from django.test import SimpleTestCase
+
+from benchmarks.compare import compare
+
+
+class CompareTest(SimpleTestCase):
+    def test_slower_benchmark_is_a_regression(self):
+        # GIVEN
+        baseline = {'a': {'ops_per_second': 100.0}, 'b': {'ops_per_second': 100.0}}
+        results = {'a': {'ops_per_second': 85.0}, 'b': {'ops_per_second': 95.0}}
+
+        # WHEN
+        rows = compare(baseline, results, 0.1)
+
+        # THEN
+        self.assertEqual([('a', 100.0, 85.0, -0.15, True), ('b', 100.0, 95.0, -0.05, False)], rows)
+
+    def test_benchmarks_missing_from_either_results_are_ignored(self):
+        # GIVEN
+        baseline = {'a': {'ops_per_second': 100.0}}
+        results = {'b': {'ops_per_second': 100.0}}
+
+        # WHEN
+        rows = compare(baseline, results, 0.1)
+
+        # THEN
+        self.assertEqual([], rows)
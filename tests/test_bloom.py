@@ -0,0 +1,129 @@
+from unittest import mock
+
+from django.test import TestCase, override_settings
+
+from yubival.bloom import BloomFilter, public_id_filter
+from yubival.cache import PUBLIC_ID_FILTER_GENERATION, bump_cache_generation, device_cache
+from yubival.models import Device, generate_public_id
+from yubival.signals import devices_created_in_bulk, devices_deleted_in_bulk
+from yubival.views import get_devices_key_material, load_device_key_material
+
+
+class BloomFilterTest(TestCase):
+    def test_added_values_are_found(self):
+        # GIVEN
+        bloom = BloomFilter(1000, 0.01, 2**20)
+        values = [generate_public_id() for _ in range(1000)]
+
+        # WHEN
+        for value in values:
+            bloom.add(value)
+
+        # THEN
+        self.assertTrue(all(value in bloom for value in values))
+
+    def test_false_positive_rate(self):
+        # GIVEN
+        bloom = BloomFilter(1000, 0.01, 2**20)
+        for _ in range(1000):
+            bloom.add(generate_public_id())
+
+        # WHEN
+        false_positives = sum(generate_public_id() in bloom for _ in range(10000))
+
+        # THEN
+        self.assertLess(false_positives, 300)
+
+    def test_memory_limit_takes_precedence(self):
+        # WHEN
+        bloom = BloomFilter(10**6, 0.01, 1024)
+
+        # THEN
+        self.assertEqual(8192, bloom.size)
+
+
+@override_settings(YUBIVAL_PUBLIC_ID_FILTER=True, YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL=0)
+class PublicIdFilterTest(TestCase):
+    def setUp(self):
+        # Builds the filter synchronously, as the test transaction is not visible from other threads:
+        patcher = mock.patch.object(public_id_filter, 'start_build', public_id_filter.build)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(public_id_filter.clear)
+        device_cache.clear()
+        self.device = Device.objects.create(label='John')
+        public_id_filter.build()
+
+    def test_unknown_device_is_rejected_without_device_query(self):
+        # GIVEN
+        public_id = generate_public_id()
+
+        # WHEN
+        with self.assertNumQueries(1):  # Cache generation check
+            key_material = load_device_key_material(public_id)
+
+        # THEN
+        self.assertIsNone(key_material)
+
+    def test_registered_device_is_loaded(self):
+        # WHEN
+        key_material = load_device_key_material(self.device.public_id)
+
+        # THEN
+        self.assertEqual(self.device.key, key_material.key_hex)
+
+    def test_device_created_by_this_process_is_added(self):
+        # GIVEN
+        device = Device.objects.create(label='Jane')
+
+        # WHEN
+        excluded = public_id_filter.excludes(device.public_id)
+
+        # THEN
+        self.assertFalse(excluded)
+        self.assertTrue(public_id_filter.excludes(generate_public_id()))
+
+    def test_devices_created_in_bulk_are_added(self):
+        # GIVEN
+        devices = Device.objects.bulk_create([Device(label='Device %d' % i) for i in range(3)])
+        devices_created_in_bulk([device.public_id for device in devices])
+
+        # WHEN
+        key_materials = get_devices_key_material([device.public_id for device in devices])
+
+        # THEN
+        self.assertEqual(3, len(key_materials))
+
+    def test_device_deletion_keeps_filter_enabled(self):
+        # GIVEN
+        self.device.delete()
+
+        # WHEN
+        excluded = public_id_filter.excludes(generate_public_id())
+
+        # THEN
+        self.assertTrue(excluded)
+
+    def test_devices_deleted_in_bulk_are_forgotten_on_next_use(self):
+        # GIVEN
+        Device.objects.filter(pk=self.device.pk).delete()
+
+        # WHEN
+        devices_deleted_in_bulk([self.device.public_id])
+
+        # THEN
+        self.assertTrue(public_id_filter.excludes(self.device.public_id))
+
+    def test_change_by_another_process_disables_filter_until_rebuilt(self):
+        # GIVEN
+        bump_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+        public_id = generate_public_id()
+
+        # WHEN
+        with mock.patch.object(public_id_filter, 'start_build') as start_build:
+            excluded = public_id_filter.excludes(public_id)
+
+        # THEN
+        self.assertFalse(excluded)
+        start_build.assert_called_once_with()
+        self.assertTrue(public_id_filter.excludes(public_id))
@@ -0,0 +1,175 @@
+import base64
+
+from django.test import TestCase, override_settings
+
+from yubival.cache import LRUCache, GenerationCache, api_key_cache, bump_cache_generation, device_cache, \
+    get_cache_generation, DEVICE_CACHE_GENERATION
+from yubival.models import APIKey, Device
+from yubival.views import get_signing_key_or_none, get_device_key_material_or_none
+
+
+class LRUCacheTest(TestCase):
+    def test_least_recently_used_entry_is_evicted(self):
+        # GIVEN
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+
+        # WHEN
+        cache.set('c', 3)
+
+        # THEN
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_zero_size_cache_stores_nothing(self):
+        # GIVEN
+        cache = LRUCache(0)
+
+        # WHEN
+        cache.set('a', 1)
+
+        # THEN
+        self.assertEqual(0, len(cache))
+
+
+@override_settings(YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL=0)
+class GenerationCacheTest(TestCase):
+    def setUp(self):
+        self.cache = GenerationCache('test', lambda: 16)
+        self.loads = []
+
+    def load(self, key):
+        self.loads.append(key)
+        return len(self.loads)
+
+    def test_cached_value_is_reused(self):
+        # WHEN
+        first = self.cache.get_or_load('a', self.load)
+        second = self.cache.get_or_load('a', self.load)
+
+        # THEN
+        self.assertEqual(1, first)
+        self.assertEqual(1, second)
+        self.assertEqual(['a'], self.loads)
+
+    def test_generation_change_reloads_value(self):
+        # GIVEN
+        self.cache.get_or_load('a', self.load)
+
+        # WHEN
+        bump_cache_generation('test')
+        value = self.cache.get_or_load('a', self.load)
+
+        # THEN
+        self.assertEqual(2, value)
+
+    def test_none_is_not_cached(self):
+        # WHEN
+        self.cache.get_or_load('a', lambda key: None)
+        value = self.cache.get_or_load('a', self.load)
+
+        # THEN
+        self.assertEqual(1, value)
+
+
+class APIKeyCacheTest(TestCase):
+    def setUp(self):
+        api_key_cache.clear()
+
+    def test_saved_api_key_is_reloaded(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='service', key=base64.b64encode(b'000000000001').decode('utf-8'))
+        get_signing_key_or_none(str(api_key.id))
+
+        # WHEN
+        api_key.key = base64.b64encode(b'000000000002').decode('utf-8')
+        api_key.save()
+
+        # THEN
+        self.assertEqual(b'000000000002', get_signing_key_or_none(str(api_key.id)).key)
+
+    def test_deleted_api_key_is_forgotten(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='service')
+        key_id = str(api_key.id)
+        get_signing_key_or_none(key_id)
+
+        # WHEN
+        api_key.delete()
+
+        # THEN
+        self.assertIsNone(get_signing_key_or_none(key_id))
+
+
+class DeviceCacheTest(TestCase):
+    def setUp(self):
+        device_cache.clear()
+        self.device = Device.objects.create(
+            label='John',
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+
+    def test_key_material_is_reused(self):
+        # WHEN
+        first = get_device_key_material_or_none('cdcdcdcdcdcd')
+        second = get_device_key_material_or_none('cdcdcdcdcdcd')
+
+        # THEN
+        self.assertIs(first, second)
+        self.assertEqual(bytes.fromhex('010203040506'), first.private_id)
+
+    def test_saved_device_is_reloaded(self):
+        # GIVEN
+        get_device_key_material_or_none('cdcdcdcdcdcd')
+
+        # WHEN
+        self.device.key = '000102030405060708090a0b0c0d0e0a'
+        self.device.save()
+
+        # THEN
+        key_material = get_device_key_material_or_none('cdcdcdcdcdcd')
+        self.assertEqual(bytes.fromhex('000102030405060708090a0b0c0d0e0a'), key_material.key)
+
+    def test_unknown_device_has_no_key_material(self):
+        # WHEN
+        key_material = get_device_key_material_or_none('cccccccccccc')
+
+        # THEN
+        self.assertIsNone(key_material)
+
+    def test_counter_update_keeps_cache_generation(self):
+        # GIVEN
+        generation = get_cache_generation(DEVICE_CACHE_GENERATION)
+
+        # WHEN
+        self.device.counter.value = 1
+        self.device.counter.save()
+
+        # THEN
+        self.assertEqual(generation, get_cache_generation(DEVICE_CACHE_GENERATION))
+
+    def test_device_creation_keeps_cache_generation(self):
+        # GIVEN
+        generation = get_cache_generation(DEVICE_CACHE_GENERATION)
+
+        # WHEN
+        Device.objects.create(label='Jane')
+
+        # THEN
+        self.assertEqual(generation, get_cache_generation(DEVICE_CACHE_GENERATION))
+
+    def test_device_change_bumps_cache_generation(self):
+        # GIVEN
+        generation = get_cache_generation(DEVICE_CACHE_GENERATION)
+
+        # WHEN
+        self.device.label = 'Jane'
+        self.device.save()
+
+        # THEN
+        self.assertEqual(generation + 1, get_cache_generation(DEVICE_CACHE_GENERATION))
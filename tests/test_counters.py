@@ -0,0 +1,266 @@
+import base64
+import os
+import tempfile
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+
+from yubival.counters import DjangoCounterStore, MemoryCounterStore, JournalCounterStore, get_counter_store, \
+    request_digest
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
+from yubival.views import DeviceKeyMaterial, hmac_sign_string, ordered_parameters_string
+
+from tests.test_views import get_status_from_response, unique_nonce
+
+
+class CounterStoreTestMixin:
+    def setUp(self):
+        self.device = Device.objects.create(
+            label='John',
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+        DeviceCounter.objects.filter(device=self.device).update(value=pack_counters(1, 2))
+        self.key_material = DeviceKeyMaterial(self.device.private_id, self.device.key)
+        self.store = self.create_store()
+
+    def create_store(self):
+        raise NotImplementedError
+
+    def test_counters_are_initialized_from_device(self):
+        # WHEN
+        counters = self.store.get(['cdcdcdcdcdcd', 'cccccccccccc'])
+
+        # THEN
+        self.assertEqual({'cdcdcdcdcdcd': (1, 2)}, counters)
+
+    def test_more_recent_counters_are_stored(self):
+        # WHEN
+        updated = self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material)
+
+        # THEN
+        self.assertTrue(updated)
+        self.assertEqual({'cdcdcdcdcdcd': (1, 3)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_older_counters_are_not_stored(self):
+        # WHEN
+        updated = self.store.advance('cdcdcdcdcdcd', (1, 2), self.key_material)
+
+        # THEN
+        self.assertFalse(updated)
+        self.assertEqual({'cdcdcdcdcdcd': (1, 2)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_compare_and_set_with_expected_counters(self):
+        # WHEN
+        updated = self.store.compare_and_set('cdcdcdcdcdcd', (1, 2), (2, 0), self.key_material)
+
+        # THEN
+        self.assertTrue(updated)
+        self.assertEqual({'cdcdcdcdcdcd': (2, 0)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_compare_and_set_with_unexpected_counters(self):
+        # WHEN
+        updated = self.store.compare_and_set('cdcdcdcdcdcd', (1, 1), (2, 0), self.key_material)
+
+        # THEN
+        self.assertFalse(updated)
+        self.assertEqual({'cdcdcdcdcdcd': (1, 2)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_unknown_device_is_not_advanced(self):
+        # WHEN
+        updated = self.store.advance('cccccccccccc', (1, 3), self.key_material)
+
+        # THEN
+        self.assertFalse(updated)
+
+    def test_counters_are_accepted_for_their_request(self):
+        # GIVEN
+        digest = request_digest('cdcdcdcdcdcdtoken', 'nonce')
+
+        # WHEN
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material, digest)
+
+        # THEN
+        self.assertTrue(self.store.is_accepted('cdcdcdcdcdcd', (1, 3), digest))
+        self.assertFalse(self.store.is_accepted('cdcdcdcdcdcd', (1, 3), request_digest('cdcdcdcdcdcdtoken', 'other')))
+        self.assertFalse(self.store.is_accepted('cdcdcdcdcdcd', (1, 2), digest))
+
+
+class DjangoCounterStoreTest(CounterStoreTestMixin, TestCase):
+    def create_store(self):
+        return DjangoCounterStore()
+
+    def test_device_with_other_key_is_not_advanced(self):
+        # GIVEN
+        key_material = DeviceKeyMaterial(self.device.private_id, '000102030405060708090a0b0c0d0e0a')
+
+        # WHEN
+        updated = self.store.advance('cdcdcdcdcdcd', (1, 3), key_material)
+
+        # THEN
+        self.assertFalse(updated)
+
+
+class MemoryCounterStoreTest(CounterStoreTestMixin, TestCase):
+    def create_store(self):
+        return MemoryCounterStore()
+
+    def test_reset_device_is_reinitialized(self):
+        # GIVEN
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material)
+
+        # WHEN
+        self.store.reset('cdcdcdcdcdcd')
+
+        # THEN
+        self.assertEqual({'cdcdcdcdcdcd': (1, 2)}, self.store.get(['cdcdcdcdcdcd']))
+
+
+class JournalCounterStoreTest(CounterStoreTestMixin, TestCase):
+    def create_store(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'counters.journal')
+        return JournalCounterStore(self.path)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_counters_are_restored_from_journal(self):
+        # GIVEN
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material)
+        self.store.advance('cdcdcdcdcdcd', (1, 4), self.key_material)
+        self.store.close()
+
+        # WHEN
+        self.store = JournalCounterStore(self.path)
+
+        # THEN
+        self.assertEqual({'cdcdcdcdcdcd': (1, 4)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_reset_many_is_restored_from_journal(self):
+        # GIVEN
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material)
+        self.store.reset_many(['cdcdcdcdcdcd', 'cbcbcbcbcbcb'])
+        self.store.close()
+
+        # WHEN
+        self.store = JournalCounterStore(self.path)
+
+        # THEN
+        self.assertEqual({'cdcdcdcdcdcd': (1, 2)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_request_digest_is_restored_from_journal(self):
+        # GIVEN
+        digest = request_digest('cdcdcdcdcdcdtoken', 'nonce')
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material, digest)
+        self.store.close()
+
+        # WHEN
+        self.store = JournalCounterStore(self.path)
+
+        # THEN
+        self.assertTrue(self.store.is_accepted('cdcdcdcdcdcd', (1, 3), digest))
+
+    def test_truncated_record_is_ignored(self):
+        # GIVEN
+        self.store.advance('cdcdcdcdcdcd', (1, 3), self.key_material)
+        self.store.close()
+        with open(self.path, 'a') as f:
+            f.write('cdcdcdcdcdcd 1')
+
+        # WHEN
+        self.store = JournalCounterStore(self.path)
+
+        # THEN
+        self.assertEqual({'cdcdcdcdcdcd': (1, 3)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_concurrent_updates_are_all_synced(self):
+        # GIVEN
+        results = []
+        self.store.get(['cdcdcdcdcdcd'])
+
+        def advance(usage_counter):
+            results.append(self.store.advance('cdcdcdcdcdcd', (2, usage_counter), self.key_material))
+
+        threads = [threading.Thread(target=advance, args=(usage_counter,)) for usage_counter in range(20)]
+
+        # WHEN
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.store.close()
+        self.store = JournalCounterStore(self.path)
+
+        # THEN
+        self.assertIn(True, results)
+        self.assertEqual({'cdcdcdcdcdcd': (2, 19)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_journal_is_compacted_when_it_grows(self):
+        # GIVEN
+        self.store.close()
+        self.store = JournalCounterStore(self.path, compaction_ratio=2, compaction_min_records=4)
+
+        # WHEN
+        for usage_counter in range(3, 13):
+            self.store.advance('cdcdcdcdcdcd', (1, usage_counter), self.key_material)
+
+        # THEN
+        with open(self.path) as f:
+            self.assertLessEqual(len(f.readlines()), 4)
+        self.store.close()
+        self.store = JournalCounterStore(self.path)
+        self.assertEqual({'cdcdcdcdcdcd': (1, 12)}, self.store.get(['cdcdcdcdcdcd']))
+
+    def test_journal_cannot_be_opened_twice(self):
+        # THEN
+        with self.assertRaises(ImproperlyConfigured):
+            JournalCounterStore(self.path)
+
+
+class GetCounterStoreTest(TestCase):
+    def test_default_store(self):
+        # THEN
+        self.assertIsInstance(get_counter_store(), DjangoCounterStore)
+
+    @override_settings(YUBIVAL_COUNTER_STORE='yubival.counters.MemoryCounterStore')
+    def test_configured_store(self):
+        # THEN
+        self.assertIsInstance(get_counter_store(), MemoryCounterStore)
+
+
+@override_settings(YUBIVAL_COUNTER_STORE='yubival.counters.MemoryCounterStore')
+class MemoryCounterStoreVerifyTest(TestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(key=base64.b64encode(b'000000000001').decode('utf-8'))
+        Device.objects.create(
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+
+    def test_replayed_otp_is_detected(self):
+        # GIVEN
+        q = QueryDict('', mutable=True)
+        q.update({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        })
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        first_response = self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+        del q['h']
+        q['nonce'] = unique_nonce()
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+
+        # WHEN
+        second_response = self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+
+        # THEN
+        self.assertEqual('OK', get_status_from_response(first_response))
+        self.assertEqual('REPLAYED_OTP', get_status_from_response(second_response))
+        self.assertEqual({'cdcdcdcdcdcd': (1, 1)}, get_counter_store().get(['cdcdcdcdcdcd']))
@@ -1,3 +1,4 @@
+import datetime
 from io import StringIO
 
 from django.core.management import call_command
@@ -74,6 +75,41 @@ class CommandTest(TestCase):
         self.assertIn('1 Key A', output)
         self.assertIn('2 Key B', output)
 
+    def test_key_listing_filtered_by_label_prefix_as_csv(self):
+        # GIVEN
+        key = APIKey.objects.create(label='web-1')
+        APIKey.objects.create(label='vpn-1')
+        command = 'apikey'
+        args = ['list', '--label-prefix', 'web-', '--format', 'csv']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        self.assertEqual(
+            'id,label,date_created\n%d,web-1,%s\n' % (key.id, key.date_created.isoformat()),
+            out.getvalue(),
+        )
+
+    def test_key_listing_filtered_by_creation_date(self):
+        # GIVEN
+        old_key = APIKey.objects.create(label='Old key')
+        APIKey.objects.filter(id=old_key.id).update(
+            date_created=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        )
+        APIKey.objects.create(label='New key')
+        command = 'apikey'
+        args = ['list', '--created-after', '2021-01-01']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        self.assertIn('New key', out.getvalue())
+        self.assertNotIn('Old key', out.getvalue())
+
     def test_deleting_existing_key_succeeds(self):
         # GIVEN
         APIKey.objects.create(label='John')
@@ -1,10 +1,13 @@
+import json
+import os
+import tempfile
 from io import StringIO
 
 from django.core.management import call_command
 from django.test import TestCase
 from django.test.utils import captured_stderr
 
-from yubival.models import Device
+from yubival.models import Device, DeviceCounter, pack_counters
 
 
 class CommandTest(TestCase):
@@ -76,6 +79,40 @@ class CommandTest(TestCase):
         self.assertIn('%s Yubikey A' % public_id_a, output)
         self.assertIn('%s Yubikey B' % public_id_b, output)
 
+    def test_used_devices_listing_as_json_lines(self):
+        # GIVEN
+        used_device = Device.objects.create(label='Used')
+        DeviceCounter.objects.filter(device=used_device).update(value=pack_counters(1, 2))
+        Device.objects.create(label='Unused')
+        command = 'yubikey'
+        args = ['list', '--used', '--format', 'jsonl']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(1, len(rows))
+        self.assertEqual(used_device.public_id, rows[0]['public_id'])
+        self.assertEqual(1, rows[0]['session_counter'])
+        self.assertNotIn('key', rows[0])
+
+    def test_unused_devices_listing_filtered_by_label_prefix(self):
+        # GIVEN
+        DeviceCounter.objects.filter(device=Device.objects.create(label='lab-used')).update(value=pack_counters(1, 0))
+        Device.objects.create(label='lab-unused')
+        Device.objects.create(label='office-unused')
+        command = 'yubikey'
+        args = ['list', '--unused', '--label-prefix', 'lab-']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        self.assertEqual(['lab-unused'], [line.split(' ', 1)[1] for line in out.getvalue().splitlines()])
+
     def test_deleting_existing_key_succeeds(self):
         # GIVEN
         public_id = Device.objects.create(label='John').public_id
@@ -100,3 +137,88 @@ class CommandTest(TestCase):
 
         # THEN
         self.assertIn('Device public_id=cccccccccccc does not exist.', out.getvalue())
+
+
+class ImportCommandTest(TestCase):
+    def import_file(self, content, *args):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write(content)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command('yubikey', 'import', f.name, *args, stdout=out)
+        return out.getvalue()
+
+    def test_csv_devices_are_imported_in_batches(self):
+        # GIVEN
+        content = (
+            'label,public_id,private_id,key\n'
+            'John,cccccccccccb,000000000001,00112233445566778899aabbccddeeff\n'
+            'Jane,cccccccccccd,000000000002,00112233445566778899aabbccddeeff\n'
+            'Jack,ccccccccccce,000000000003,00112233445566778899aabbccddeeff\n'
+        )
+
+        # WHEN
+        output = self.import_file(content, '--batch-size', '2')
+
+        # THEN
+        self.assertIn('Imported 3 devices, skipped 0 already imported, 0 failed.', output)
+        self.assertEqual('000000000002', Device.objects.get(label='Jane').private_id)
+        self.assertEqual(3, Device.objects.count())
+        self.assertEqual(3, DeviceCounter.objects.count())
+
+    def test_invalid_and_duplicate_rows_are_reported(self):
+        # GIVEN
+        Device.objects.create(label='John')
+        content = (
+            'John,cccccccccccb,000000000001,00112233445566778899aabbccddeeff\n'
+            'Jane,cccccccccccd,00000000000z,00112233445566778899aabbccddeeff\n'
+            'Jack,ccccccccccce,000000000003\n'
+            'Jill,cccccccccccf,000000000004,00112233445566778899aabbccddeeff\n'
+            'Joe,cccccccccccf,000000000005,00112233445566778899aabbccddeeff\n'
+        )
+
+        # WHEN
+        output = self.import_file(content)
+
+        # THEN
+        self.assertIn('Line 1: duplicate label "John"', output)
+        self.assertIn('Line 2: invalid private_id "00000000000z"', output)
+        self.assertIn('Line 3: expected label, public_id, private_id and key fields', output)
+        self.assertIn('Line 5: duplicate public_id "cccccccccccf"', output)
+        self.assertIn('Imported 1 devices, skipped 0 already imported, 4 failed.', output)
+        self.assertTrue(Device.objects.filter(label='Jill').exists())
+
+    def test_import_is_resumed_by_running_it_again(self):
+        # GIVEN
+        content = (
+            'John,cccccccccccb,000000000001,00112233445566778899aabbccddeeff\n'
+            'Jane,cccccccccccd,000000000002,00112233445566778899aabbccddeeff\n'
+        )
+        Device.objects.create(
+            label='John',
+            public_id='cccccccccccb',
+            private_id='000000000001',
+            key='00112233445566778899aabbccddeeff',
+        )
+
+        # WHEN
+        output = self.import_file(content)
+
+        # THEN
+        self.assertIn('Imported 1 devices, skipped 1 already imported, 0 failed.', output)
+        self.assertEqual(2, Device.objects.count())
+
+    def test_ykman_log_devices_are_labeled_by_serial(self):
+        # GIVEN
+        content = (
+            '1234567,cccccccccccb,000000000001,00112233445566778899aabbccddeeff,,2021-10-29T08:31:11,\n'
+            ',cccccccccccd,000000000002,00112233445566778899aabbccddeeff,,2021-10-29T08:31:12,\n'
+        )
+
+        # WHEN
+        output = self.import_file(content, '--format', 'ykman', '--label-prefix', 'key ')
+
+        # THEN
+        self.assertIn('Imported 2 devices', output)
+        self.assertEqual('cccccccccccb', Device.objects.get(label='key 1234567').public_id)
+        self.assertEqual('000000000002', Device.objects.get(label='key cccccccccccd').private_id)
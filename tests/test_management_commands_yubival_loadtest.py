@@ -0,0 +1,64 @@
+from io import StringIO
+
+from django.core.management import call_command, CommandError
+from django.test import TestCase, TransactionTestCase
+
+from yubival.loadtest import percentile
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
+
+
+class CommandTest(TransactionTestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(label='loadtest')
+
+    def test_all_requests_are_valid(self):
+        # GIVEN
+        command = 'yubival_loadtest'
+        args = [str(self.api_key.id), '--requests', '10', '--workers', '2']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        self.assertIn('Requests: 10 in', out.getvalue())
+        self.assertIn('\tOK: 10', out.getvalue())
+        self.assertEqual(2, Device.objects.filter(label__startswith='loadtest-').count())
+
+    def test_existing_devices_are_reused(self):
+        # GIVEN
+        device = Device.objects.create(label='loadtest-0')
+        DeviceCounter.objects.filter(device=device).update(value=pack_counters(10, 0))
+        command = 'yubival_loadtest'
+        args = [str(self.api_key.id), '--requests', '4', '--workers', '1', '--devices', '2']
+        out = StringIO()
+
+        # WHEN
+        call_command(command, *args, stdout=out)
+
+        # THEN
+        self.assertIn('\tOK: 4', out.getvalue())
+        self.assertEqual(
+            ['loadtest-0', 'loadtest-1'],
+            list(Device.objects.order_by('label').values_list('label', flat=True)),
+        )
+
+    def test_fewer_devices_than_workers_is_an_error(self):
+        # GIVEN
+        command = 'yubival_loadtest'
+        args = [str(self.api_key.id), '--workers', '2', '--devices', '1']
+
+        # THEN
+        with self.assertRaises(CommandError):
+            call_command(command, *args, stdout=StringIO())
+
+
+class PercentileTest(TestCase):
+    def test_nearest_rank(self):
+        # GIVEN
+        values = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+
+        # THEN
+        self.assertEqual(5, percentile(values, 0.5))
+        self.assertEqual(10, percentile(values, 0.99))
+        self.assertEqual(10, percentile(values, 1))
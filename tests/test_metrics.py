@@ -0,0 +1,297 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock
+
+from django.http import Http404, QueryDict
+from django.test import RequestFactory, TestCase, override_settings
+
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey
+from yubival.metrics import MERGED_FILENAME, Registry, get_registry, prometheus_text
+from yubival.models import APIKey, Device
+from yubival.views import metrics_view, verify
+
+from tests.test_views import unique_nonce
+
+
+class RegistryTest(TestCase):
+    def test_counters_are_summed_by_labels(self):
+        # GIVEN
+        registry = Registry()
+
+        # WHEN
+        registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+        registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+        registry.inc('yubival_responses_total', ('verify', 'BAD_OTP', '1'))
+        counters, _ = registry.collect()
+
+        # THEN
+        self.assertEqual({
+            ('yubival_responses_total', ('verify', 'OK', '1')): 2,
+            ('yubival_responses_total', ('verify', 'BAD_OTP', '1')): 1,
+        }, counters)
+
+    def test_histogram_is_formatted_with_cumulative_buckets(self):
+        # GIVEN
+        registry = Registry()
+        registry.observe('yubival_decrypt_duration_seconds', 0.00005)
+        registry.observe('yubival_decrypt_duration_seconds', 0.003)
+
+        # WHEN
+        text = prometheus_text(*registry.collect())
+
+        # THEN
+        self.assertIn('yubival_decrypt_duration_seconds_bucket{le="0.0001"} 1\n', text)
+        self.assertIn('yubival_decrypt_duration_seconds_bucket{le="0.005"} 2\n', text)
+        self.assertIn('yubival_decrypt_duration_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('yubival_decrypt_duration_seconds_count 2\n', text)
+        self.assertIn('# TYPE yubival_decrypt_duration_seconds histogram\n', text)
+
+    def test_label_values_are_escaped(self):
+        # GIVEN
+        registry = Registry()
+        registry.inc('yubival_batch_otps_total', ('OK', 'a"b\\c'))
+
+        # WHEN
+        text = prometheus_text(*registry.collect())
+
+        # THEN
+        self.assertIn('yubival_batch_otps_total{status="OK",client="a\\"b\\\\c"} 1\n', text)
+
+    def test_values_of_processes_sharing_a_directory_are_merged(self):
+        # GIVEN
+        with tempfile.TemporaryDirectory() as directory:
+            other_process = Registry(directory)
+            other_process.inc('yubival_responses_total', ('verify', 'OK', '1'), 3)
+            other_process.close()
+            other_process.flush()
+            os.rename(other_process._path(), os.path.join(directory, 'metrics-0.json'))
+            registry = Registry(directory)
+            self.addCleanup(registry.close)
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+
+            # WHEN
+            counters, _ = registry.collect()
+
+        # THEN
+        self.assertEqual({('yubival_responses_total', ('verify', 'OK', '1')): 4}, counters)
+
+    def test_values_of_exited_processes_are_merged_once(self):
+        # GIVEN
+        process = subprocess.Popen([sys.executable, '-c', 'pass'])
+        process.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            exited_path = os.path.join(directory, 'metrics-%d.json' % process.pid)
+            with open(exited_path, 'w') as f:
+                json.dump({'counters': [['yubival_responses_total', ['verify', 'OK', '1'], 3]], 'histograms': []}, f)
+            registry = Registry(directory)
+            self.addCleanup(registry.close)
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+
+            # WHEN
+            registry.collect()
+            counters, _ = registry.collect()
+
+            # THEN
+            self.assertEqual({('yubival_responses_total', ('verify', 'OK', '1')): 4}, counters)
+            self.assertFalse(os.path.exists(exited_path))
+            self.assertTrue(os.path.exists(os.path.join(directory, MERGED_FILENAME)))
+
+    def test_values_of_former_process_with_same_pid_are_kept(self):
+        # GIVEN
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'metrics-%d.json' % os.getpid()), 'w') as f:
+                json.dump({'counters': [['yubival_responses_total', ['verify', 'OK', '1'], 5]], 'histograms': []}, f)
+            registry = Registry(directory)
+            self.addCleanup(registry.close)
+
+            # WHEN
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+            counters, _ = registry.collect()
+
+        # THEN
+        self.assertEqual({('yubival_responses_total', ('verify', 'OK', '1')): 6}, counters)
+
+    @mock.patch('yubival.metrics.FLUSH_INTERVAL', 0.01)
+    def test_values_are_written_by_background_thread(self):
+        # GIVEN
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry(directory)
+            self.addCleanup(registry.close)
+
+            # WHEN
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+
+            # THEN
+            deadline = time.monotonic() + 5
+            while not os.path.exists(registry._path()) and time.monotonic() < deadline:
+                time.sleep(0.01)
+            registry.close()
+            with open(registry._path()) as f:
+                self.assertEqual([['yubival_responses_total', ['verify', 'OK', '1'], 1]], json.load(f)['counters'])
+
+    def test_concurrent_flushes_write_valid_file(self):
+        # GIVEN
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry(directory)
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+            registry.close()
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(registry.flush())) for _ in range(20)]
+
+            # WHEN
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            # THEN
+            self.assertEqual([True] * 20, results)
+            with open(registry._path()) as f:
+                self.assertEqual([['yubival_responses_total', ['verify', 'OK', '1'], 1]], json.load(f)['counters'])
+
+    def test_write_errors_are_ignored(self):
+        # GIVEN
+        with tempfile.TemporaryDirectory() as directory:
+            registry = Registry(os.path.join(directory, 'missing'))
+            self.addCleanup(registry.close)
+            registry.inc('yubival_responses_total', ('verify', 'OK', '1'))
+
+            # WHEN
+            flushed = registry.flush()
+            counters, _ = registry.collect()
+
+        # THEN
+        self.assertFalse(flushed)
+        self.assertEqual({}, counters)
+
+
+class VerifyMetricsTest(TestCase):
+    def setUp(self):
+        api_key = APIKey.objects.create()
+        self.client_id = str(api_key.id)
+        self.synthetic_client = SyntheticClient.from_api_key(api_key, nonce_prefix=unique_nonce())
+        self.yubikey = SyntheticYubiKey.from_device(Device.objects.create())
+
+    def test_metrics_are_not_collected_by_default(self):
+        # WHEN
+        verify(QueryDict(self.synthetic_client.verify_query(self.yubikey)))
+
+        # THEN
+        self.assertIsNone(get_registry())
+
+    @override_settings(YUBIVAL_METRICS=True)
+    def test_responses_are_counted_by_status_and_client(self):
+        # GIVEN
+        query = self.synthetic_client.verify_query(self.yubikey)
+        replayed = QueryDict(query).copy()
+        replayed['nonce'] = self.synthetic_client.nonce()
+        del replayed['h']
+
+        # WHEN
+        verify(QueryDict(query))
+        verify(self.synthetic_client.sign(replayed))
+
+        # THEN
+        counters, histograms = get_registry().collect()
+        self.assertEqual(1, counters[('yubival_responses_total', ('verify', 'OK', self.client_id))])
+        self.assertEqual(1, counters[('yubival_responses_total', ('verify', 'REPLAYED_OTP', self.client_id))])
+        self.assertEqual(2, sum(histograms[('yubival_request_duration_seconds', ('verify',))][:-1]))
+        self.assertEqual(2, sum(histograms[('yubival_decrypt_duration_seconds', ())][:-1]))
+        self.assertEqual(2, sum(histograms[('yubival_counter_update_duration_seconds', ())][:-1]))
+
+    @override_settings(YUBIVAL_METRICS=True)
+    def test_unknown_client_is_not_used_as_label(self):
+        # GIVEN
+        query = self.synthetic_client.sign({'id': '999999', 'otp': self.yubikey.token(), 'nonce': 'abcdefghijklmnop'})
+
+        # WHEN
+        verify(query)
+
+        # THEN
+        counters, _ = get_registry().collect()
+        self.assertEqual({('yubival_responses_total', ('verify', 'NO_SUCH_CLIENT', '')): 1}, counters)
+
+    @override_settings(YUBIVAL_METRICS=True)
+    def test_metrics_view_returns_prometheus_text(self):
+        # GIVEN
+        verify(QueryDict(self.synthetic_client.verify_query(self.yubikey)))
+        request = RequestFactory().get('/metrics')
+
+        # WHEN
+        response = metrics_view(request)
+
+        # THEN
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertIn(
+            'yubival_responses_total{endpoint="verify",status="OK",client="%s"} 1\n' % self.client_id,
+            response.content.decode('utf-8'),
+        )
+
+    def test_metrics_view_is_not_found_when_metrics_are_disabled(self):
+        # GIVEN
+        request = RequestFactory().get('/metrics')
+
+        # WHEN / THEN
+        with self.assertRaises(Http404):
+            metrics_view(request)
+
+
+class StageTimingTest(TestCase):
+    def setUp(self):
+        self.synthetic_client = SyntheticClient.from_api_key(APIKey.objects.create(), nonce_prefix=unique_nonce())
+        self.yubikey = SyntheticYubiKey.from_device(Device.objects.create())
+
+    def test_stage_timings_are_not_reported_by_default(self):
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify?%s' % self.synthetic_client.verify_query(self.yubikey))
+
+        # THEN
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(YUBIVAL_STAGE_TIMING=True)
+    def test_stage_timings_are_reported_in_server_timing_header(self):
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify?%s' % self.synthetic_client.verify_query(self.yubikey))
+
+        # THEN
+        stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        self.assertEqual(
+            ['parse', 'api_key', 'signature', 'nonce', 'device', 'decrypt', 'counter', 'sign', 'total'],
+            stages,
+        )
+
+    def test_stage_timings_are_passed_to_hook(self):
+        # GIVEN
+        hook = mock.Mock()
+
+        # WHEN
+        with override_settings(YUBIVAL_STAGE_TIMING=True, YUBIVAL_STAGE_TIMING_HOOK=hook):
+            self.client.get('/wsapi/2.0/verify?%s' % self.synthetic_client.verify_query(self.yubikey))
+
+        # THEN
+        hook.assert_called_once()
+        request, stages = hook.call_args[0]
+        self.assertEqual('/wsapi/2.0/verify', request.path)
+        self.assertEqual('parse', stages[0][0])
+        self.assertTrue(all(seconds >= 0 for _, seconds in stages))
+
+    @override_settings(YUBIVAL_STAGE_TIMING=True)
+    def test_batch_stage_timings_are_reported(self):
+        # GIVEN
+        query = self.synthetic_client.sign({
+            'id': str(self.synthetic_client.client_id),
+            'otp1': self.yubikey.token(),
+            'nonce1': 'abcdefghijklmnop',
+        })
+
+        # WHEN
+        response = self.client.post('/wsapi/2.0/verify_batch', query.dict())
+
+        # THEN
+        self.assertIn('otps;dur=', response['Server-Timing'])
@@ -0,0 +1,114 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+
+from django.conf import settings
+from django.db.migrations import RunPython
+from django.db.migrations.loader import MigrationLoader
+from django.test import SimpleTestCase
+
+
+SHARDED_SETTINGS = '''
+from tests.settings import *
+
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(default)r},
+    'shard1': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(shard1)r},
+}
+DATABASE_ROUTERS = ['yubival.sharding.DeviceShardRouter']
+YUBIVAL_DEVICE_SHARDS = ['shard1']
+'''
+
+
+class MigrationRoutingTest(SimpleTestCase):
+    def test_data_migrations_name_their_model(self):
+        # GIVEN
+        loader = MigrationLoader(None, ignore_no_migrations=True)
+
+        # WHEN
+        operations = [
+            (key, operation)
+            for key, migration in loader.disk_migrations.items() if key[0] == 'yubival'
+            for operation in migration.operations if isinstance(operation, RunPython)
+        ]
+
+        # THEN
+        self.assertTrue(operations)
+        for key, operation in operations:
+            with self.subTest(migration=key[1]):
+                self.assertIn('model_name', operation.hints)
+
+
+class ShardedMigrationTest(SimpleTestCase):
+    """Runs the migrations of empty databases in a subprocess, with the default database not being a shard"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.databases = {
+            alias: os.path.join(self.directory.name, '%s.sqlite3' % alias)
+            for alias in ('default', 'shard1')
+        }
+        with open(os.path.join(self.directory.name, 'sharded_settings.py'), 'w') as f:
+            f.write(SHARDED_SETTINGS % self.databases)
+
+    def migrate(self, alias, *args):
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE='sharded_settings',
+            PYTHONPATH=os.pathsep.join([self.directory.name, str(settings.BASE_DIR)]),
+        )
+        subprocess.run(
+            [sys.executable, '-m', 'django', 'migrate', '--database', alias, *args],
+            env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        )
+
+    def query(self, alias, sql, params=()):
+        with sqlite3.connect(self.databases[alias]) as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def tables(self, alias):
+        return {name for name, in self.query(alias, "SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    def insert_device(self, alias, session_counter, usage_counter):
+        self.query(alias, (
+            'INSERT INTO yubival_device '
+            '(label, public_id, private_id, key, session_counter, usage_counter, date_created) '
+            "VALUES ('John', 'cccccccccccb', '000000000001', '00112233445566778899aabbccddeeff', ?, ?, '2021-01-01')"
+        ), (session_counter, usage_counter))
+
+    def test_tables_are_created_in_their_database(self):
+        # WHEN
+        self.migrate('default')
+        self.migrate('shard1')
+
+        # THEN
+        self.assertIn('yubival_apikey', self.tables('default'))
+        self.assertNotIn('yubival_device', self.tables('default'))
+        self.assertIn('yubival_devicecounter', self.tables('shard1'))
+        self.assertNotIn('yubival_apikey', self.tables('shard1'))
+
+    def test_counters_are_moved_to_counter_table_of_shard(self):
+        # GIVEN
+        self.migrate('shard1', 'yubival', '0004')
+        self.insert_device('shard1', 7, 9)
+
+        # WHEN
+        self.migrate('shard1', 'yubival', '0005')
+
+        # THEN
+        rows = self.query('shard1', 'SELECT session_counter, usage_counter FROM yubival_devicecounter')
+        self.assertEqual([(7, 9)], rows)
+
+    def test_counters_are_packed_in_shard(self):
+        # GIVEN
+        self.migrate('shard1', 'yubival', '0004')
+        self.insert_device('shard1', 7, 9)
+
+        # WHEN
+        self.migrate('shard1', 'yubival', '0006')
+
+        # THEN
+        self.assertEqual([(7 << 8 | 9,)], self.query('shard1', 'SELECT value FROM yubival_devicecounter'))
@@ -1,6 +1,6 @@
 from django.test import TestCase
 
-from yubival.models import generate_otp_key
+from yubival.models import Device, DeviceCounter, generate_otp_key, pack_counters, unpack_counters
 
 
 class TestGenerateOtpKey(TestCase):
@@ -10,3 +10,41 @@ class TestGenerateOtpKey(TestCase):
 
         # THEN
         self.assertEqual(32, len(key))
+
+
+class TestDeviceCounter(TestCase):
+    def test_counter_is_created_with_device(self):
+        # WHEN
+        device = Device.objects.create(label='John')
+
+        # THEN
+        counter = DeviceCounter.objects.get(device=device)
+        self.assertEqual(0, counter.value)
+
+    def test_counter_is_deleted_with_device(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+
+        # WHEN
+        device.delete()
+
+        # THEN
+        self.assertFalse(DeviceCounter.objects.exists())
+
+    def test_packed_counters_are_ordered_like_otps(self):
+        # GIVEN
+        counters = [(0, 1), (0, 255), (1, 0), (1, 1), (2**15 - 1, 255)]
+
+        # WHEN
+        values = [pack_counters(*pair) for pair in counters]
+
+        # THEN
+        self.assertEqual(sorted(values), values)
+        self.assertEqual(counters, [unpack_counters(value) for value in values])
+
+    def test_unpacked_counters_are_readable(self):
+        # WHEN
+        counter = DeviceCounter(value=pack_counters(3, 200))
+
+        # THEN
+        self.assertEqual((3, 200), (counter.session_counter, counter.usage_counter))
@@ -0,0 +1,150 @@
+import base64
+from unittest import mock
+
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+
+from yubival.models import APIKey, Device
+from yubival.nonces import NonceIndex
+from yubival.views import hmac_sign_string, ordered_parameters_string, parse_response
+
+from tests.test_views import get_status_from_response
+
+
+class NonceIndexTest(TestCase):
+    def test_new_nonce_is_added(self):
+        # GIVEN
+        index = NonceIndex(60, 100)
+
+        # WHEN
+        added = index.add('1', 'abc')
+
+        # THEN
+        self.assertTrue(added)
+
+    def test_known_nonce_is_not_added(self):
+        # GIVEN
+        index = NonceIndex(60, 100)
+        index.add('1', 'abc')
+
+        # WHEN
+        added = index.add('1', 'abc')
+
+        # THEN
+        self.assertFalse(added)
+
+    def test_nonce_of_other_client_is_added(self):
+        # GIVEN
+        index = NonceIndex(60, 100)
+        index.add('1', 'abc')
+
+        # WHEN
+        added = index.add('2', 'abc')
+
+        # THEN
+        self.assertTrue(added)
+
+    def test_nonce_is_forgotten_after_window(self):
+        # GIVEN
+        with mock.patch('yubival.nonces.time.monotonic', return_value=1000):
+            index = NonceIndex(60, 100)
+            index.add('1', 'abc')
+
+        # WHEN
+        with mock.patch('yubival.nonces.time.monotonic', return_value=1061):
+            added = index.add('1', 'abc')
+
+        # THEN
+        self.assertTrue(added)
+
+    def test_nonce_is_remembered_across_buckets(self):
+        # GIVEN
+        with mock.patch('yubival.nonces.time.monotonic', return_value=1000):
+            index = NonceIndex(60, 100)
+            index.add('1', 'abc')
+
+        # WHEN
+        with mock.patch('yubival.nonces.time.monotonic', return_value=1040):
+            added = index.add('1', 'abc')
+
+        # THEN
+        self.assertFalse(added)
+
+    def test_size_is_capped(self):
+        # GIVEN
+        index = NonceIndex(60, 10)
+
+        # WHEN
+        for i in range(25):
+            index.add('1', str(i))
+
+        # THEN
+        self.assertLessEqual(len(index), 10)
+
+
+@override_settings(YUBIVAL_NONCE_WINDOW=60)
+class ReplayedRequestTest(TestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(key=base64.b64encode(b'000000000001').decode('utf-8'))
+        Device.objects.create(
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+
+    def signed_query(self, params):
+        q = QueryDict('', mutable=True)
+        q.update(params)
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        return q.urlencode()
+
+    def test_replayed_request_gives_replayed_request_status(self):
+        # GIVEN
+        query = self.signed_query({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': 'fHUKs9',
+        })
+        self.client.get('/wsapi/2.0/verify?%s' % query)
+
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify?%s' % query)
+
+        # THEN
+        self.assertEqual('REPLAYED_REQUEST', get_status_from_response(response))
+
+    def test_unsigned_request_does_not_record_nonce(self):
+        # GIVEN
+        params = {
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': 'fHUKs9unsigned',
+        }
+        unsigned_query = QueryDict('', mutable=True)
+        unsigned_query.update(params)
+        unsigned_query['h'] = 'pOHpsdCn3f5pazYy4MK7P+Ol6zk='
+        self.client.get('/wsapi/2.0/verify?%s' % unsigned_query.urlencode())
+        query = self.signed_query(params)
+
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify?%s' % query)
+
+        # THEN
+        self.assertEqual('OK', get_status_from_response(response))
+
+    def test_repeated_nonce_in_batch_gives_replayed_request_status(self):
+        # GIVEN
+        query = self.signed_query({
+            'id': str(self.api_key.id),
+            'otp1': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce1': 'fHUKs9batch',
+            'otp2': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce2': 'fHUKs9batch',
+        })
+
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify_batch?%s' % query)
+
+        # THEN
+        params = parse_response(response.content.decode('utf-8'))
+        self.assertEqual(['OK', 'REPLAYED_REQUEST'], [params['status1'], params['status2']])
@@ -0,0 +1,114 @@
+import base64
+
+from django.core.exceptions import TooManyFieldsSent
+from django.http import QueryDict
+from django.test import RequestFactory, TestCase, override_settings
+
+from yubival.query import SignedQuery
+from yubival.views import is_request_signature_valid, ordered_parameters_string, query_parameters
+
+
+class SignedQueryTest(TestCase):
+    def assert_same_signed_text(self, query_string):
+        unsigned_query = QueryDict(query_string, mutable=True)
+        unsigned_query.pop('h', None)
+        self.assertEqual(ordered_parameters_string(unsigned_query, escape=True), SignedQuery(query_string).signed_text)
+
+    def test_signed_text_is_sorted_without_signature(self):
+        # GIVEN
+        query = SignedQuery('otp=vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft&id=1&h=%2Bja8S3IjbX593/LAgTBixwPNGX4%3D')
+
+        # THEN
+        self.assertEqual('id=1&otp=vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft', query.signed_text)
+        self.assertEqual('+ja8S3IjbX593/LAgTBixwPNGX4=', query.signature)
+
+    def test_signed_text_has_query_dict_escaping(self):
+        for query_string in [
+            'id=1&nonce=a+b&otp=x',
+            'id=1&nonce=a%20b%2bc%7E&otp=x',
+            'id=1&nonce=a~b&otp=x',
+            'id=1&nonce=%C3%A9t%C3%A9&otp=x',
+            'id=1&nonce=a/b:c*&otp=x',
+            'i%64=1&nonce=&otp&&timestamp=1',
+            'id=1&nonce=%zz&otp=x',
+        ]:
+            with self.subTest(query_string=query_string):
+                self.assert_same_signed_text(query_string)
+
+    def test_parameters_are_decoded(self):
+        # GIVEN
+        query = SignedQuery('id=1&nonce=a+b%2Bc&otp')
+
+        # THEN
+        self.assertEqual('a b+c', query['nonce'])
+        self.assertEqual('', query['otp'])
+        self.assertEqual(['1'], query.getlist('id'))
+        self.assertNotIn('h', query)
+
+    def test_encoded_duplicates_are_detected(self):
+        # GIVEN
+        query = SignedQuery('id=1&i%64=2&otp=x')
+
+        # THEN
+        self.assertTrue(query.has_duplicates)
+        self.assertEqual(['1', '2'], query.getlist('id'))
+
+    def test_valid_signature_is_valid(self):
+        # Example from https://developers.yubico.com/OTP/Specifications/Test_vectors.html
+
+        # GIVEN
+        key = base64.b64decode('mG5be6ZJU1qBGz24yPh/ESM3UdU=')
+        query = SignedQuery(
+            'id=1&otp=vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft&nonce=jrFwbaYFhn0HoxZIsd9LQ6w2ceU'
+            '&h=%2Bja8S3IjbX593/LAgTBixwPNGX4%3D',
+        )
+
+        # WHEN
+        is_valid = is_request_signature_valid(query, key)
+
+        # THEN
+        self.assertTrue(is_valid)
+
+    def test_duplicate_parameter_signature_is_invalid(self):
+        # GIVEN
+        key = base64.b64decode('mG5be6ZJU1qBGz24yPh/ESM3UdU=')
+        query = SignedQuery(
+            'id=1&otp=vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft&nonce=jrFwbaYFhn0HoxZIsd9LQ6w2ceU'
+            '&h=%2Bja8S3IjbX593/LAgTBixwPNGX4%3D&id=1',
+        )
+
+        # WHEN
+        is_valid = is_request_signature_valid(query, key)
+
+        # THEN
+        self.assertFalse(is_valid)
+
+    @override_settings(DATA_UPLOAD_MAX_NUMBER_FIELDS=2)
+    def test_too_many_fields_are_rejected(self):
+        # THEN
+        with self.assertRaises(TooManyFieldsSent):
+            SignedQuery('id=1&otp=x&nonce=y')
+
+
+class QueryParametersTest(TestCase):
+    def test_ascii_query_string_is_parsed_in_a_single_pass(self):
+        # GIVEN
+        request = RequestFactory().get('/wsapi/2.0/verify', {'id': '1', 'nonce': 'é'})
+
+        # WHEN
+        query = query_parameters(request)
+
+        # THEN
+        self.assertIsInstance(query, SignedQuery)
+        self.assertEqual('é', query['nonce'])
+
+    def test_non_ascii_query_string_is_parsed_by_django(self):
+        # GIVEN
+        request = RequestFactory().get('/wsapi/2.0/verify', QUERY_STRING='id=1&nonce=\xc3\xa9')
+
+        # WHEN
+        query = query_parameters(request)
+
+        # THEN
+        self.assertIsInstance(query, QueryDict)
+        self.assertEqual('é', query['nonce'])
@@ -0,0 +1,143 @@
+import base64
+
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+
+from yubival.cache import DEVICE_CACHE_GENERATION, api_key_cache, bump_cache_generation, device_cache
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey
+from yubival.models import APIKey, Device, DeviceCounter, generate_api_key, generate_otp_key
+from yubival.views import get_api_key_or_none, get_device_key_material_or_none, get_devices_key_material, \
+    get_signing_key_or_none, load_device_key_material, parse_response, verify
+
+from tests.test_views import unique_nonce
+
+
+# The `shard1` test database stands for a read replica of the default database, and the rows created by the tests are
+# considered replicated unless they override `YUBIVAL_READ_REPLICA_MAX_LAG`:
+@override_settings(YUBIVAL_READ_REPLICAS={'default': ['shard1']}, YUBIVAL_READ_REPLICA_MAX_LAG=0)
+class ReadReplicaTest(TestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        api_key_cache.clear()
+        device_cache.clear()
+
+    def replicate(self, obj):
+        obj.save(using='shard1', force_insert=True)
+
+    def test_api_key_is_read_from_replica(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='client')
+        APIKey.objects.using('shard1').create(id=api_key.id, label='client', key='replicated')
+
+        # WHEN
+        loaded = get_api_key_or_none(str(api_key.id))
+
+        # THEN
+        self.assertEqual('replicated', loaded.key)
+
+    def test_api_key_not_replicated_yet_is_read_from_primary(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='client')
+
+        # WHEN
+        loaded = get_api_key_or_none(str(api_key.id))
+
+        # THEN
+        self.assertEqual(api_key.key, loaded.key)
+
+    def test_device_not_replicated_yet_is_read_from_primary(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+
+        # WHEN
+        key_material = load_device_key_material(device.public_id)
+
+        # THEN
+        self.assertEqual(device.key, key_material.key_hex)
+
+    def test_batch_reads_devices_from_replica_then_primary(self):
+        # GIVEN
+        replicated = Device.objects.create(label='replicated')
+        Device.objects.using('shard1').create(
+            label='replicated', public_id=replicated.public_id, private_id=replicated.private_id,
+            key='00112233445566778899aabbccddeeff',
+        )
+        new = Device.objects.create(label='new')
+
+        # WHEN
+        with self.assertNumQueries(1, using='shard1'):
+            key_materials = get_devices_key_material([replicated.public_id, new.public_id])
+
+        # THEN
+        self.assertEqual('00112233445566778899aabbccddeeff', key_materials[replicated.public_id].key_hex)
+        self.assertEqual(new.key, key_materials[new.public_id].key_hex)
+
+    def test_counters_are_updated_on_primary(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='client')
+        device = Device.objects.create(label='John')
+        self.replicate(api_key)
+        self.replicate(device)
+        client = SyntheticClient.from_api_key(api_key, nonce_prefix=unique_nonce())
+        query = QueryDict(client.verify_query(SyntheticYubiKey.from_device(device)))
+
+        # WHEN
+        with self.assertNumQueries(2, using='shard1'):
+            response = parse_response(verify(query).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+        self.assertEqual(1, DeviceCounter.objects.using('default').get().session_counter)
+        self.assertEqual(0, DeviceCounter.objects.using('shard1').get().session_counter)
+
+    @override_settings(YUBIVAL_READ_REPLICA_MAX_LAG=60)
+    def test_changed_api_key_is_reloaded_from_primary(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='client')
+        self.replicate(api_key)
+        api_key_cache.clear()
+        former_key = get_signing_key_or_none(str(api_key.id)).key
+
+        # WHEN
+        api_key = APIKey.objects.using('default').get(pk=api_key.pk)
+        api_key.key = generate_api_key()
+        api_key.save()
+        signing_key = get_signing_key_or_none(str(api_key.id))
+
+        # THEN
+        self.assertNotEqual(former_key, signing_key.key)
+        self.assertEqual(api_key.key, base64.b64encode(signing_key.key).decode('ascii'))
+
+    @override_settings(YUBIVAL_READ_REPLICA_MAX_LAG=60, YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL=0)
+    def test_device_changed_by_other_process_is_reloaded_from_primary(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+        self.replicate(device)
+        device_cache.clear()
+        self.assertEqual(device.key, get_device_key_material_or_none(device.public_id).key_hex)
+
+        # WHEN
+        new_key = generate_otp_key()
+        Device.objects.filter(pk=device.pk).update(key=new_key)
+        bump_cache_generation(DEVICE_CACHE_GENERATION)
+        key_material = get_device_key_material_or_none(device.public_id)
+
+        # THEN
+        self.assertEqual(new_key, key_material.key_hex)
+
+    @override_settings(YUBIVAL_READ_REPLICA_MAX_LAG=60)
+    def test_batch_reads_changed_devices_from_primary(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+        self.replicate(device)
+
+        # WHEN
+        device = Device.objects.using('default').get(pk=device.pk)
+        device.key = generate_otp_key()
+        device.save()
+        with self.assertNumQueries(0, using='shard1'):
+            key_materials = get_devices_key_material([device.public_id])
+
+        # THEN
+        self.assertEqual(device.key, key_materials[device.public_id].key_hex)
@@ -0,0 +1,286 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.http import QueryDict
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters, generate_public_id
+from yubival.sharding import HashRing, device_database
+from yubival.views import parse_response, verify, verify_batch
+
+from tests.test_views import unique_nonce
+
+
+SHARDS = ['shard1', 'shard2']
+sharded = override_settings(
+    YUBIVAL_DEVICE_SHARDS=SHARDS,
+    DATABASE_ROUTERS=['yubival.sharding.DeviceShardRouter'],
+)
+
+
+def public_id_in(shard):
+    """Returns a random public ID stored in `shard`"""
+    while True:
+        public_id = generate_public_id()
+        if device_database(public_id) == shard:
+            return public_id
+
+
+class HashRingTest(TestCase):
+    def test_devices_are_spread_over_all_shards(self):
+        # GIVEN
+        ring = HashRing(['a', 'b', 'c'])
+
+        # WHEN
+        shards = [ring.shard(generate_public_id()) for _ in range(3000)]
+
+        # THEN
+        for shard in 'abc':
+            self.assertGreater(shards.count(shard), 700)
+
+    def test_adding_a_shard_only_moves_devices_to_that_shard(self):
+        # GIVEN
+        public_ids = [generate_public_id() for _ in range(3000)]
+        ring = HashRing(['a', 'b'])
+        new_ring = HashRing(['a', 'b', 'c'])
+
+        # WHEN
+        moves = [(ring.shard(public_id), new_ring.shard(public_id)) for public_id in public_ids]
+
+        # THEN
+        moved = [(old, new) for old, new in moves if old != new]
+        self.assertTrue(all(new == 'c' for _, new in moved))
+        self.assertLess(len(moved), 1300)
+
+
+@sharded
+class ShardedVerificationTest(TestCase):
+    databases = {'default', 'shard1', 'shard2'}
+
+    def setUp(self):
+        self.synthetic_client = SyntheticClient.from_api_key(APIKey.objects.create(), nonce_prefix=unique_nonce())
+
+    def test_devices_are_created_in_their_shard(self):
+        # WHEN
+        device = Device.objects.create(label='John', public_id=public_id_in('shard2'))
+
+        # THEN
+        self.assertEqual('shard2', device._state.db)
+        self.assertTrue(Device.objects.using('shard2').filter(public_id=device.public_id).exists())
+        self.assertFalse(Device.objects.using('shard1').filter(public_id=device.public_id).exists())
+        self.assertFalse(Device.objects.using('default').exists())
+
+    def test_otp_is_validated_against_its_shard(self):
+        # GIVEN
+        device = Device.objects.create(public_id=public_id_in('shard2'))
+        yubikey = SyntheticYubiKey.from_device(device)
+        query = QueryDict(self.synthetic_client.verify_query(yubikey))
+        replayed_query = query.copy()
+        replayed_query['nonce'] = self.synthetic_client.nonce()
+        del replayed_query['h']
+
+        # WHEN
+        first = parse_response(verify(query).content.decode('utf-8'))
+        replayed = parse_response(verify(self.synthetic_client.sign(replayed_query)).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('OK', first['status'])
+        self.assertEqual('REPLAYED_OTP', replayed['status'])
+        counter = DeviceCounter.objects.using('shard2').get(device__public_id=device.public_id)
+        self.assertEqual(1, counter.session_counter)
+
+    def test_batch_spans_shards(self):
+        # GIVEN
+        yubikeys = [
+            SyntheticYubiKey.from_device(Device.objects.create(label=shard, public_id=public_id_in(shard)))
+            for shard in SHARDS
+        ]
+        query = self.synthetic_client.sign({
+            'id': str(self.synthetic_client.client_id),
+            'otp1': yubikeys[0].token(),
+            'nonce1': self.synthetic_client.nonce(),
+            'otp2': yubikeys[1].token(),
+            'nonce2': self.synthetic_client.nonce(),
+        })
+
+        # WHEN
+        response = parse_response(verify_batch(query).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('OK', response['status1'])
+        self.assertEqual('OK', response['status2'])
+        for shard in SHARDS:
+            self.assertEqual(1, DeviceCounter.objects.using(shard).get().session_counter)
+
+
+@sharded
+class ShardedCommandTest(TestCase):
+    databases = {'default', 'shard1', 'shard2'}
+
+    def test_devices_of_all_shards_are_listed(self):
+        # GIVEN
+        Device.objects.create(label='one', public_id=public_id_in('shard1'))
+        Device.objects.create(label='two', public_id=public_id_in('shard2'))
+        out = StringIO()
+
+        # WHEN
+        call_command('yubikey', 'list', stdout=out)
+
+        # THEN
+        self.assertEqual(['one', 'two'], [line.split()[1] for line in out.getvalue().splitlines()])
+
+    def test_device_is_deleted_from_its_shard(self):
+        # GIVEN
+        device = Device.objects.create(public_id=public_id_in('shard2'))
+
+        # WHEN
+        call_command('yubikey', 'delete', device.public_id, stdout=StringIO())
+
+        # THEN
+        self.assertFalse(Device.objects.using('shard2').exists())
+
+    def test_rebalance_moves_devices_to_new_shard(self):
+        # GIVEN
+        with override_settings(YUBIVAL_DEVICE_SHARDS=['shard1']):
+            for i in range(20):
+                device = Device.objects.create(label='Device %d' % i)
+                DeviceCounter.objects.using('shard1').filter(device=device).update(value=pack_counters(i, 0))
+        misplaced = [
+            device for device in Device.objects.using('shard1').select_related('counter')
+            if device_database(device.public_id) == 'shard2'
+        ]
+        self.assertTrue(misplaced)
+        out = StringIO()
+
+        # WHEN
+        call_command('yubikey', 'rebalance', '--batch-size', '7', stdout=out)
+
+        # THEN
+        self.assertEqual('Moved %d devices, 0 failed.\n' % len(misplaced), out.getvalue())
+        self.assertEqual(20 - len(misplaced), Device.objects.using('shard1').count())
+        self.assertEqual(20 - len(misplaced), DeviceCounter.objects.using('shard1').count())
+        for device in misplaced:
+            moved = Device.objects.using('shard2').select_related('counter').get(public_id=device.public_id)
+            self.assertEqual(
+                (device.label, device.private_id, device.key, device.counter.session_counter, device.date_created),
+                (moved.label, moved.private_id, moved.key, moved.counter.session_counter, moved.date_created),
+            )
+
+    def test_rebalance_resumes_interrupted_moves(self):
+        # GIVEN
+        public_id = public_id_in('shard2')
+        device = Device.objects.using('shard1').create(label='John', public_id=public_id)
+        Device.objects.using('shard2').create(
+            label='John', public_id=public_id, private_id=device.private_id, key=device.key,
+        )
+        out = StringIO()
+
+        # WHEN
+        call_command('yubikey', 'rebalance', stdout=out)
+
+        # THEN
+        self.assertEqual('Moved 1 devices, 0 failed.\n', out.getvalue())
+        self.assertFalse(Device.objects.using('shard1').exists())
+        self.assertEqual(1, Device.objects.using('shard2').count())
+
+    def test_rebalance_dry_run_moves_nothing(self):
+        # GIVEN
+        Device.objects.using('shard1').create(public_id=public_id_in('shard2'))
+        out = StringIO()
+
+        # WHEN
+        call_command('yubikey', 'rebalance', '--dry-run', stdout=out)
+
+        # THEN
+        self.assertEqual('1 devices would be moved, 0 conflicting.\n', out.getvalue())
+        self.assertEqual(1, Device.objects.using('shard1').count())
+
+    def test_rebalance_moves_devices_of_former_database(self):
+        # GIVEN
+        Device.objects.using('default').create(public_id=public_id_in('shard1'))
+        out = StringIO()
+
+        # WHEN
+        call_command('yubikey', 'rebalance', '--source', 'default', stdout=out)
+
+        # THEN
+        self.assertEqual('Moved 1 devices, 0 failed.\n', out.getvalue())
+        self.assertEqual(0, Device.objects.using('default').count())
+        self.assertEqual(1, Device.objects.using('shard1').count())
+
+
+@sharded
+class ShardedAdminTest(TestCase):
+    databases = {'default', 'shard1', 'shard2'}
+
+    def setUp(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+
+    def test_changelist_lists_selected_shard(self):
+        # GIVEN
+        Device.objects.create(label='one', public_id=public_id_in('shard1'))
+        Device.objects.create(label='two', public_id=public_id_in('shard2'))
+
+        # WHEN
+        first = self.client.get(reverse('admin:yubival_device_changelist'))
+        second = self.client.get(reverse('admin:yubival_device_changelist'), {'shard': 'shard2'})
+
+        # THEN
+        self.assertEqual(['one'], [device.label for device in first.context['cl'].result_list])
+        self.assertEqual(['two'], [device.label for device in second.context['cl'].result_list])
+
+    def test_change_form_updates_device_of_selected_shard(self):
+        # GIVEN
+        device = Device.objects.create(label='John', public_id=public_id_in('shard2'))
+        url = '%s?_changelist_filters=shard%%3Dshard2' % reverse('admin:yubival_device_change', args=[device.id])
+
+        # WHEN
+        response = self.client.post(url, {'label': 'Jane', 'private_id': device.private_id, 'key': device.key})
+
+        # THEN
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('Jane', Device.objects.using('shard2').get().label)
+
+    def test_change_form_finds_device_of_other_shard_without_selected_shard(self):
+        # GIVEN
+        device = Device.objects.create(label='John', public_id=public_id_in('shard2'))
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_change', args=[device.id]))
+
+        # THEN
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(device.public_id, response.context['original'].public_id)
+
+    def test_change_form_finds_device_by_public_id(self):
+        # GIVEN
+        Device.objects.create(label='Jane', public_id=public_id_in('shard1'))
+        device = Device.objects.create(label='John', public_id=public_id_in('shard2'))
+
+        # WHEN
+        response = self.client.get(reverse('admin:yubival_device_change', args=[device.public_id]))
+
+        # THEN
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('John', response.context['original'].label)
+
+    def test_label_must_be_unique_across_shards(self):
+        # GIVEN
+        Device.objects.create(label='John', public_id=public_id_in('shard1'))
+
+        # WHEN
+        response = self.client.post(reverse('admin:yubival_device_add'), {
+            'label': 'John',
+            'public_id': public_id_in('shard2'),
+            'private_id': '0123456789ab',
+            'key': '00112233445566778899aabbccddeeff',
+        })
+
+        # THEN
+        self.assertEqual(200, response.status_code)
+        self.assertIn('label', response.context['adminform'].form.errors)
+        self.assertFalse(Device.objects.using('shard2').exists())
@@ -0,0 +1,461 @@
+import base64
+import concurrent.futures
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.http import QueryDict
+from django.test import TestCase, TransactionTestCase, override_settings
+
+from yubival.counters import MemoryCounterStore
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey
+from yubival.metrics import get_registry
+from yubival.models import APIKey, Device, DeviceCounter
+from yubival.query import SignedQuery
+from yubival.sync import SYNC_NOT_ENOUGH_ANSWERS, SYNC_OK, SYNC_REPLAYED_OTP, SyncPool, get_sync_pool, http_get, \
+    parse_sync_level
+from yubival.views import SigningKey, hmac_sign_string, load_device_key_material, ordered_parameters_string, \
+    parse_response, sync_response, verify, verify_batch
+
+from tests.test_views import unique_nonce
+
+
+SYNC_KEY = base64.b64encode(b'sync key shared by all servers').decode('utf-8')
+PEERS = ['http://peer1/wsapi/2.0/sync', 'http://peer2/wsapi/2.0/sync']
+
+PEER_SETTINGS = '''
+from tests.settings import *
+
+DATABASES = {'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(database)r}}
+YUBIVAL_SYNC_KEY = %(sync_key)r
+'''
+DEVICE = {
+    'public_id': 'cccccccccccb',
+    'private_id': '000000000001',
+    'key': '00112233445566778899aabbccddeeff',
+}
+
+
+def completed(status):
+    future = concurrent.futures.Future()
+    future.set_result(status)
+    return future
+
+
+def failed():
+    future = concurrent.futures.Future()
+    future.set_exception(OSError('Connection refused'))
+    return future
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class SyncPoolTest(TestCase):
+    def setUp(self):
+        self.pool = SyncPool(PEERS + ['http://peer3/wsapi/2.0/sync'], b'key')
+        self.addCleanup(self.pool.close)
+
+    def test_enough_confirmations(self):
+        # WHEN
+        result = self.pool.wait([completed(SYNC_OK), completed(SYNC_OK), failed()], 60, 1)
+
+        # THEN
+        self.assertEqual(SYNC_OK, result.status)
+        self.assertEqual(66, result.level)
+
+    def test_not_enough_confirmations(self):
+        # WHEN
+        result = self.pool.wait([completed(SYNC_OK), failed(), failed()], 60, 1)
+
+        # THEN
+        self.assertEqual(SYNC_NOT_ENOUGH_ANSWERS, result.status)
+        self.assertEqual(33, result.level)
+
+    def test_replay_reported_by_a_peer(self):
+        # WHEN
+        result = self.pool.wait([completed(SYNC_OK), completed(SYNC_REPLAYED_OTP), completed(SYNC_OK)], 100, 1)
+
+        # THEN
+        self.assertEqual(SYNC_REPLAYED_OTP, result.status)
+
+    def test_pending_answers_time_out(self):
+        # WHEN
+        result = self.pool.wait([completed(SYNC_OK), concurrent.futures.Future()], 100, 0.01)
+
+        # THEN
+        self.assertEqual(SYNC_NOT_ENOUGH_ANSWERS, result.status)
+
+    @override_settings(YUBIVAL_METRICS=True)
+    def test_requests_above_max_pending_are_dropped(self):
+        # GIVEN
+        pool = SyncPool(PEERS, b'key', threads=1, max_pending=2)
+        self.addCleanup(pool.close)
+        answer = threading.Event()
+        self.addCleanup(answer.set)
+        futures = pool.start(lambda peer: answer.wait(5) and SYNC_OK)
+
+        # WHEN
+        dropped = pool.start(lambda peer: SYNC_OK)
+        answer.set()
+
+        # THEN
+        self.assertEqual([], dropped)
+        self.assertEqual(SYNC_OK, pool.wait(futures, 100, 5).status)
+        counters, _ = get_registry().collect()
+        self.assertEqual(1, counters[('yubival_sync_dropped_total', (PEERS[0],))])
+        self.assertEqual(1, counters[('yubival_sync_dropped_total', (PEERS[1],))])
+        self.assertEqual(2, len(pool.start(lambda peer: SYNC_OK)))
+
+    def test_sync_levels(self):
+        self.assertEqual(1, parse_sync_level('fast'))
+        self.assertEqual(40, parse_sync_level('secure'))
+        self.assertEqual(75, parse_sync_level('75'))
+        with self.assertRaises(ValueError):
+            parse_sync_level('101')
+
+
+@override_settings(YUBIVAL_SYNC_PEERS=PEERS, YUBIVAL_SYNC_KEY=SYNC_KEY)
+class SyncTest(TransactionTestCase):
+    # Peers answer from the threads of the pool, which must see the committed devices
+    def setUp(self):
+        self.synthetic_client = SyntheticClient.from_api_key(APIKey.objects.create(), nonce_prefix=unique_nonce())
+        self.device = Device.objects.create()
+        self.yubikey = SyntheticYubiKey.from_device(self.device)
+        # Each peer has its own counters, initialized before the local server accepts any OTP:
+        self.peer_stores = {peer: MemoryCounterStore() for peer in PEERS}
+        for store in self.peer_stores.values():
+            store.get([self.device.public_id])
+        self.unreachable_peers = set()
+        get_sync_pool().transport = self.transport
+
+    def transport(self, peer, query, timeout):
+        if peer in self.unreachable_peers:
+            raise OSError('Connection refused')
+        return sync_response(SignedQuery(query), self.peer_stores[peer]).render(SigningKey(base64.b64decode(SYNC_KEY)))
+
+    def verify(self, **params):
+        query = self.synthetic_client.sign(dict({
+            'id': str(self.synthetic_client.client_id),
+            'otp': self.yubikey.token(),
+            'nonce': self.synthetic_client.nonce(),
+        }, **params))
+        return parse_response(verify(query).content.decode('utf-8'))
+
+    def sync_query(self, token, nonce='abcdef'):
+        otp = load_device_key_material(self.device.public_id).decode_otp(token.encode('utf-8'))
+        query = QueryDict(mutable=True)
+        query.update({
+            'public_id': self.device.public_id,
+            'session_counter': str(otp.session),
+            'usage_counter': str(otp.counter),
+            'otp': token,
+            'nonce': nonce,
+        })
+        query['h'] = hmac_sign_string(ordered_parameters_string(query, escape=True), base64.b64decode(SYNC_KEY))
+        return query.urlencode()
+
+    def test_otp_confirmed_by_peers_is_accepted(self):
+        # WHEN
+        response = self.verify(sl='100')
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+        self.assertEqual('100', response['sl'])
+        counter = DeviceCounter.objects.get(device=self.device)
+        for store in self.peer_stores.values():
+            self.assertEqual(
+                {self.device.public_id: (counter.session_counter, counter.usage_counter)},
+                store.get([self.device.public_id]),
+            )
+
+    def test_otp_seen_by_a_peer_is_replayed(self):
+        # GIVEN
+        token = self.yubikey.token()
+        self.transport(PEERS[0], self.sync_query(token), 1)
+
+        # WHEN
+        response = self.verify(otp=token, sl='100')
+
+        # THEN
+        self.assertEqual('REPLAYED_OTP', response['status'])
+
+    def test_request_accepted_by_a_peer_is_confirmed(self):
+        # GIVEN
+        token = self.yubikey.token()
+        nonce = self.synthetic_client.nonce()
+        # The client sent the same request to the first peer, which accepted it:
+        self.transport(PEERS[0], self.sync_query(token, nonce), 1)
+
+        # WHEN
+        response = self.verify(otp=token, nonce=nonce, sl='100')
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+        self.assertEqual('100', response['sl'])
+
+    def test_request_synchronized_by_a_peer_is_a_replayed_request(self):
+        # GIVEN
+        token = self.yubikey.token()
+        nonce = self.synthetic_client.nonce()
+        # The client sent the same request to a peer, which accepted it and synchronized it first:
+        sync_response(SignedQuery(self.sync_query(token, nonce)))
+
+        # WHEN
+        response = self.verify(otp=token, nonce=nonce)
+
+        # THEN
+        self.assertEqual('REPLAYED_REQUEST', response['status'])
+
+    def test_unreachable_peers_give_not_enough_answers(self):
+        # GIVEN
+        self.unreachable_peers.add(PEERS[1])
+
+        # WHEN
+        response = self.verify(sl='100', timeout='1')
+
+        # THEN
+        self.assertEqual('NOT_ENOUGH_ANSWERS', response['status'])
+        self.assertEqual('50', response['sl'])
+
+    def test_otp_is_accepted_with_fast_level_when_a_peer_is_unreachable(self):
+        # GIVEN
+        self.unreachable_peers.add(PEERS[1])
+
+        # WHEN
+        response = self.verify(sl='fast')
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+
+    def test_invalid_sync_level_is_rejected(self):
+        # WHEN
+        response = self.verify(sl='most')
+
+        # THEN
+        self.assertEqual('MISSING_PARAMETER', response['status'])
+
+    def test_batch_otps_are_synchronized(self):
+        # GIVEN
+        query = self.synthetic_client.sign({
+            'id': str(self.synthetic_client.client_id),
+            'otp1': self.yubikey.token(),
+            'nonce1': self.synthetic_client.nonce(),
+            'otp2': self.yubikey.token(),
+            'nonce2': self.synthetic_client.nonce(),
+            'sl': '100',
+        })
+
+        # WHEN
+        response = parse_response(verify_batch(query).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('OK', response['status1'])
+        self.assertEqual('OK', response['status2'])
+        self.assertEqual('100', response['sl2'])
+
+    def test_batch_request_synchronized_by_a_peer_is_a_replayed_request(self):
+        # GIVEN
+        token = self.yubikey.token()
+        nonce = self.synthetic_client.nonce()
+        sync_response(SignedQuery(self.sync_query(token, nonce)))
+        query = self.synthetic_client.sign({
+            'id': str(self.synthetic_client.client_id),
+            'otp1': token,
+            'nonce1': nonce,
+            'otp2': token,
+            'nonce2': self.synthetic_client.nonce(),
+        })
+
+        # WHEN
+        response = parse_response(verify_batch(query).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('REPLAYED_REQUEST', response['status1'])
+        self.assertEqual('REPLAYED_OTP', response['status2'])
+
+    def test_sync_request_with_out_of_range_counter_is_rejected(self):
+        # GIVEN
+        query = QueryDict(mutable=True)
+        query.update({
+            'public_id': self.device.public_id,
+            'session_counter': '1',
+            'usage_counter': '256',
+            'otp': self.yubikey.token(),
+            'nonce': 'abcdef',
+        })
+        query['h'] = hmac_sign_string(ordered_parameters_string(query, escape=True), base64.b64decode(SYNC_KEY))
+
+        # WHEN
+        response = sync_response(query, self.peer_stores[PEERS[0]])
+
+        # THEN
+        self.assertEqual('MISSING_PARAMETER', response['status'])
+
+    def test_sync_request_with_bad_signature_is_rejected(self):
+        # GIVEN
+        query = QueryDict(self.sync_query(self.yubikey.token()), mutable=True)
+        query['usage_counter'] = '255'
+
+        # WHEN
+        response = sync_response(query, self.peer_stores[PEERS[0]])
+
+        # THEN
+        self.assertEqual('BAD_SIGNATURE', response['status'])
+
+
+@override_settings(YUBIVAL_SYNC_KEY=SYNC_KEY)
+class PeerServerSyncTest(TransactionTestCase):
+    """Synchronizes with a peer server running in a subprocess, with its own database, over HTTP"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.peer_database = os.path.join(cls.directory.name, 'peer.sqlite3')
+        with open(os.path.join(cls.directory.name, 'peer_settings.py'), 'w') as f:
+            f.write(PEER_SETTINGS % {'database': cls.peer_database, 'sync_key': SYNC_KEY})
+        env = dict(
+            os.environ,
+            DJANGO_SETTINGS_MODULE='peer_settings',
+            PYTHONPATH=os.pathsep.join([cls.directory.name, str(settings.BASE_DIR)]),
+        )
+        for command in (['migrate'], ['yubikey', 'add-existing', 'John', *DEVICE.values()]):
+            subprocess.run(
+                [sys.executable, '-m', 'django', *command],
+                env=env, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+
+        port = free_port()
+        cls.peer_url = 'http://127.0.0.1:%d/wsapi/2.0/sync' % port
+        cls.peer = subprocess.Popen(
+            [sys.executable, '-m', 'django', 'runserver', '--noreload', '127.0.0.1:%d' % port],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or cls.peer.poll() is not None:
+                    raise
+                time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.peer.terminate()
+        cls.peer.wait()
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.synthetic_client = SyntheticClient.from_api_key(APIKey.objects.create(), nonce_prefix=unique_nonce())
+        self.device = Device.objects.create(label='John', **DEVICE)
+        # The peer keeps the counters of the previous tests:
+        self.yubikey = SyntheticYubiKey(session_counter=self.peer_counters() >> 8, **DEVICE)
+
+    def verify(self, **params):
+        query = self.synthetic_client.sign(dict({
+            'id': str(self.synthetic_client.client_id),
+            'otp': self.yubikey.token(),
+            'nonce': self.synthetic_client.nonce(),
+            'sl': '100',
+        }, **params))
+        return parse_response(verify(query).content.decode('utf-8'))
+
+    def peer_counters(self):
+        with sqlite3.connect(self.peer_database) as connection:
+            return connection.execute('SELECT value FROM yubival_devicecounter').fetchone()[0]
+
+    def sync_peer(self, token, nonce):
+        """Sends the counters of an OTP accepted for a request to the peer, as another server would"""
+        otp = load_device_key_material(self.device.public_id).decode_otp(token.encode('utf-8'))
+        query = QueryDict(mutable=True)
+        query.update({
+            'public_id': self.device.public_id,
+            'session_counter': str(otp.session),
+            'usage_counter': str(otp.counter),
+            'otp': token,
+            'nonce': nonce,
+        })
+        query['h'] = hmac_sign_string(ordered_parameters_string(query, escape=True), base64.b64decode(SYNC_KEY))
+        return parse_response(http_get(self.peer_url, query.urlencode(), 5))
+
+    def test_otp_is_confirmed_by_peer(self):
+        # WHEN
+        with override_settings(YUBIVAL_SYNC_PEERS=[self.peer_url]):
+            response = self.verify(timeout='5')
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+        self.assertEqual('100', response['sl'])
+        self.assertEqual(DeviceCounter.objects.get(device=self.device).value, self.peer_counters())
+
+    def test_otp_accepted_by_peer_for_another_request_is_replayed(self):
+        # GIVEN
+        token = self.yubikey.token()
+        self.assertEqual('OK', self.sync_peer(token, 'peer nonce')['status'])
+
+        # WHEN
+        with override_settings(YUBIVAL_SYNC_PEERS=[self.peer_url]):
+            response = self.verify(otp=token, timeout='5')
+
+        # THEN
+        self.assertEqual('REPLAYED_OTP', response['status'])
+
+    def test_request_accepted_by_peer_is_confirmed(self):
+        # GIVEN
+        token = self.yubikey.token()
+        nonce = self.synthetic_client.nonce()
+        self.assertEqual('OK', self.sync_peer(token, nonce)['status'])
+
+        # WHEN
+        with override_settings(YUBIVAL_SYNC_PEERS=[self.peer_url]):
+            response = self.verify(otp=token, nonce=nonce, timeout='5')
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+        self.assertEqual('100', response['sl'])
+
+    def test_peer_with_other_sync_key_does_not_confirm(self):
+        # GIVEN
+        other_key = base64.b64encode(b'key of another group of servers').decode('utf-8')
+        peer_counters = self.peer_counters()
+
+        # WHEN
+        with override_settings(YUBIVAL_SYNC_PEERS=[self.peer_url], YUBIVAL_SYNC_KEY=other_key):
+            response = self.verify(timeout='5')
+
+        # THEN
+        self.assertEqual('NOT_ENOUGH_ANSWERS', response['status'])
+        self.assertEqual('0', response['sl'])
+        self.assertEqual(peer_counters, self.peer_counters())
+
+    def test_silent_peer_times_out(self):
+        # GIVEN
+        # A listening socket that never answers the connections queued in its backlog:
+        silent = socket.socket()
+        self.addCleanup(silent.close)
+        silent.bind(('127.0.0.1', 0))
+        silent.listen()
+        silent_url = 'http://127.0.0.1:%d/wsapi/2.0/sync' % silent.getsockname()[1]
+        start = time.monotonic()
+
+        # WHEN
+        with override_settings(YUBIVAL_SYNC_PEERS=[self.peer_url, silent_url]):
+            response = self.verify(timeout='1')
+
+        # THEN
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual('NOT_ENOUGH_ANSWERS', response['status'])
+        self.assertEqual('50', response['sl'])
@@ -1,15 +1,19 @@
 import base64
+import itertools
 
+from django.db import connection
 from django.db.models import Max
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 from django.contrib.auth import get_user_model
 from django.http import QueryDict
 
-from yubival.models import APIKey, Device
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
 from yubival.views import hmac_verify_string, hmac_sign_string, is_request_signature_valid, \
     ordered_parameters_string, ordered_parameters, parse_response_line, parse_response, \
-    response_signature
+    response_signature, SigningKey, DeviceKeyMaterial, VerificationResponse, Verification, ValidationStatus, \
+    VERIFICATION_STAGES, check_parameters, verify
 
 
 class TestHmacSignString(TestCase):
@@ -26,6 +30,66 @@ class TestHmacSignString(TestCase):
         # THEN
         self.assertEqual('+ja8S3IjbX593/LAgTBixwPNGX4=', signature)
 
+    def test_signing_key_is_reusable(self):
+        # GIVEN
+        key = SigningKey(base64.b64decode('mG5be6ZJU1qBGz24yPh/ESM3UdU='))
+        text = 'id=1&nonce=jrFwbaYFhn0HoxZIsd9LQ6w2ceU&otp=vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft'
+
+        # WHEN
+        hmac_sign_string('status=OK', key)
+        signature = hmac_sign_string(text, key)
+
+        # THEN
+        self.assertEqual('+ja8S3IjbX593/LAgTBixwPNGX4=', signature)
+
+
+class TestDeviceKeyMaterial(TestCase):
+    def test_decode_otp(self):
+        # Example at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
+
+        # GIVEN
+        key_material = DeviceKeyMaterial('010203040506', '000102030405060708090a0b0c0d0e0f')
+
+        # WHEN
+        otp = key_material.decode_otp(b'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn')
+
+        # THEN
+        self.assertEqual(key_material.private_id, otp.uid)
+        self.assertEqual(1, otp.session)
+        self.assertEqual(1, otp.counter)
+
+
+class TestVerificationResponse(TestCase):
+    def test_unsigned_response_keeps_parameter_order(self):
+        # GIVEN
+        response = VerificationResponse(t='2021-10-29T08:31:11', status='OK', sl=1)
+
+        # WHEN
+        text = response.render()
+
+        # THEN
+        self.assertEqual('t=2021-10-29T08:31:11\r\nstatus=OK\r\nsl=1\r\n', text)
+
+    def test_signature_matches_signature_of_parsed_text(self):
+        # GIVEN
+        key = SigningKey(base64.b64decode('mG5be6ZJU1qBGz24yPh/ESM3UdU='))
+        response = VerificationResponse(
+            t='2021-10-29T08:31:11.885803',
+            nonce='jrFwbaYFhn0HoxZIsd9LQ6w2ceU ',
+            otp='vvungrrdhvtklknvrtvuvbbkeidikkvgglrvdgrfcdft',
+            status='OK',
+            sessioncounter=3,
+            sl=1,
+        )
+
+        # WHEN
+        text = response.render(key)
+
+        # THEN
+        signature_line, unsigned_text = text.split('\r\n', 1)
+        self.assertEqual('h=%s' % response_signature(unsigned_text, key), signature_line)
+        self.assertEqual(VerificationResponse(response).render(), unsigned_text)
+
 
 class TestHmacVerifyString(TestCase):
     def test_valid_signature_is_valid(self):
@@ -123,6 +187,14 @@ class TestIsRequestSignatureValid(TestCase):
         self.assertFalse(is_valid)
 
 
+_nonce_count = itertools.count()
+
+
+def unique_nonce():
+    """Returns a nonce that no other test sends, as the process remembers the nonces of recent requests"""
+    return 'fHUKs9%010d' % next(_nonce_count)
+
+
 def get_status_from_response(response):
     lines = response.content.decode('utf-8').split('\r\n')
     for line in lines:
@@ -146,8 +218,6 @@ class TestVerifyView(TestCase):
             public_id='cdcdcdcdcdcd',
             private_id=self.private_id,
             key=self.key,
-            session_counter=0,
-            usage_counter=0,
         )
 
     def test_valid_otp_gives_ok_status(self):
@@ -157,7 +227,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -174,7 +244,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = 'pOHpsdCn3f5pazYy4MK7P+Ol6zk='
 
@@ -206,7 +276,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': unknown_api_key_id,
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -222,7 +292,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturec',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -243,7 +313,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -255,17 +325,14 @@ class TestVerifyView(TestCase):
 
     def test_ok_session_counter_bad_usage_counter_gives_replayed_otp_status(self):
         # GIVEN
-        device = Device.objects.get(public_id=self.public_id)
-        device.session_counter = 1
-        device.usage_counter = 1
-        device.save()
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(1, 1))
 
         # Example OTP at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
         q = QueryDict('', mutable=True)
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -277,17 +344,14 @@ class TestVerifyView(TestCase):
 
     def test_ok_session_counter_same_usage_counter_gives_ok_status(self):
         # GIVEN
-        device = Device.objects.get(public_id=self.public_id)
-        device.session_counter = 0
-        device.usage_counter = 1
-        device.save()
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(0, 1))
 
         # Example OTP at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
         q = QueryDict('', mutable=True)
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -299,17 +363,14 @@ class TestVerifyView(TestCase):
 
     def test_wrong_session_counter_gives_replayed_otp_status(self):
         # GIVEN
-        device = Device.objects.get(public_id=self.public_id)
-        device.session_counter = 2
-        device.usage_counter = 0
-        device.save()
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(2, 0))
 
         # Example OTP at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
         q = QueryDict('', mutable=True)
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -321,17 +382,14 @@ class TestVerifyView(TestCase):
 
     def test_ok_usage_counter_same_session_counter_gives_ok_status(self):
         # GIVEN
-        device = Device.objects.get(public_id=self.public_id)
-        device.session_counter = 1
-        device.usage_counter = 0
-        device.save()
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(1, 0))
 
         # Example OTP at https://developers.yubico.com/OTP/Specifications/Test_vectors.html
         q = QueryDict('', mutable=True)
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -353,7 +411,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -375,7 +433,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -385,6 +443,88 @@ class TestVerifyView(TestCase):
         # THEN
         self.assertEqual('BAD_OTP', get_status_from_response(response))
 
+    def test_counters_are_updated_on_success(self):
+        # GIVEN
+        q = QueryDict('', mutable=True)
+        q.update({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',  # has session and usage counters set to 1
+            'nonce': unique_nonce(),
+        })
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+
+        # WHEN
+        self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+
+        # THEN
+        counter = DeviceCounter.objects.get(device__public_id=self.public_id)
+        self.assertEqual(1, counter.session_counter)
+        self.assertEqual(1, counter.usage_counter)
+
+    def test_valid_otp_only_updates_counters(self):
+        # GIVEN
+        q = QueryDict('', mutable=True)
+        q.update({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        })
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+
+        # WHEN
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+
+        # THEN
+        self.assertEqual('OK', get_status_from_response(response))
+        updates = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+        self.assertIn('UPDATE "yubival_devicecounter"', updates[0])
+
+    def test_same_otp_twice_gives_replayed_otp_status(self):
+        # GIVEN
+        q = QueryDict('', mutable=True)
+        q.update({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        })
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+        del q['h']
+        q['nonce'] = unique_nonce()
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+
+        # WHEN
+        response = self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+
+        # THEN
+        self.assertEqual('REPLAYED_OTP', get_status_from_response(response))
+
+    def test_aes_key_changed_without_signals_gives_bad_otp_status(self):
+        # GIVEN
+        q = QueryDict('', mutable=True)
+        q.update({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': unique_nonce(),
+        })
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(0, 1))
+        self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())  # caches the device key
+
+        # WHEN
+        # As done by another process, whose changes are not notified through signals:
+        Device.objects.filter(public_id=self.public_id).update(key='000102030405060708090a0b0c0d0e0a')
+        DeviceCounter.objects.filter(device__public_id=self.public_id).update(value=pack_counters(0, 0))
+        del q['h']
+        q['nonce'] = unique_nonce()
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        response = self.client.get('/wsapi/2.0/verify?%s' % q.urlencode())
+
+        # THEN
+        self.assertEqual('BAD_OTP', get_status_from_response(response))
+
     def test_cr_lf_injection_in_nonce_hides_nonce(self):
         # GIVEN
         q = QueryDict('', mutable=True)
@@ -407,7 +547,7 @@ class TestVerifyView(TestCase):
         q.update({
             'id': str(self.api_key.id),
             'otp': '\r\nSTATUS=OK\r\nxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',  # length 44 to facilitate OTP validation
-            'nonce': 'fHUKs9',
+            'nonce': unique_nonce(),
         })
         q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
 
@@ -418,6 +558,70 @@ class TestVerifyView(TestCase):
         self.assertNotContains(response, 'STATUS')
 
 
+class TestVerificationStages(TestCase):
+    def setUp(self):
+        self.api_key = APIKey.objects.create(key=base64.b64encode(b'000000000001').decode('utf-8'))
+        Device.objects.create(
+            public_id='cdcdcdcdcdcd',
+            private_id='010203040506',
+            key='000102030405060708090a0b0c0d0e0f',
+        )
+        self.nonce = unique_nonce()
+
+    def signed_query(self, **params):
+        q = QueryDict('', mutable=True)
+        q.update(dict({
+            'id': str(self.api_key.id),
+            'otp': 'cdcdcdcdcdcddvgtiblfkbgturecfllberrvkinnctnn',
+            'nonce': self.nonce,
+        }, **params))
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), base64.b64decode(self.api_key.key))
+        return q
+
+    def test_stages_run_cheapest_first(self):
+        self.assertEqual(
+            ['parse', 'api_key', 'signature', 'nonce', 'device', 'decrypt', 'counter'],
+            [name for name, _ in VERIFICATION_STAGES],
+        )
+
+    def test_parameters_check(self):
+        for params, status in [
+            ({'otp': 'cdcdcdcdcdcddvgtiblfkbgturec'}, ValidationStatus.BAD_OTP),
+            ({'otp': 'CDCDCDCDCDCDDVGTIBLFKBGTURECFLLBERRVKINNCTNN'}, ValidationStatus.BAD_OTP),
+            ({'nonce': 'fHUKs9\r\n'}, ValidationStatus.MISSING_PARAMETER),
+            ({'sl': '200'}, ValidationStatus.MISSING_PARAMETER),
+            ({'id': 'client'}, ValidationStatus.NO_SUCH_CLIENT),
+            ({}, None),
+        ]:
+            with self.subTest(params=params):
+                self.assertEqual(status, check_parameters(Verification(self.signed_query(**params))))
+
+    def test_malformed_otp_is_rejected_without_query(self):
+        # GIVEN
+        q = self.signed_query(otp='cdcdcdcdcdcd' + 'x' * 32)
+
+        # WHEN
+        with self.assertNumQueries(0):
+            response = parse_response(verify(q).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('BAD_OTP', response['status'])
+        self.assertNotIn('h', response)
+
+    @override_settings(YUBIVAL_NONCE_WINDOW=300)
+    def test_forged_request_does_not_reserve_nonce(self):
+        # GIVEN
+        forged = self.signed_query()
+        forged['h'] = 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='
+        verify(forged)
+
+        # WHEN
+        response = parse_response(verify(self.signed_query()).content.decode('utf-8'))
+
+        # THEN
+        self.assertEqual('OK', response['status'])
+
+
 class OrderedParametersTest(TestCase):
     def test_keys_order(self):
         # GIVEN
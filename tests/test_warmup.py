@@ -0,0 +1,98 @@
+from unittest import mock
+
+from django.apps import apps
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+
+from yubival.cache import api_key_cache, device_cache
+from yubival.models import APIKey, Device, DeviceCounter, pack_counters
+from yubival.views import get_device_key_material_or_none, get_signing_key_or_none
+from yubival.warmup import is_serving, warm_up, warm_up_before_fork
+
+
+class WarmUpTest(TestCase):
+    def setUp(self):
+        api_key_cache.clear()
+        device_cache.clear()
+        self.addCleanup(api_key_cache.clear)
+        self.addCleanup(device_cache.clear)
+
+    def test_keys_are_served_from_cache_after_warm_up(self):
+        # GIVEN
+        api_key = APIKey.objects.create(label='client')
+        device = Device.objects.create(label='John')
+        DeviceCounter.objects.filter(device=device).update(value=pack_counters(1, 0))
+
+        # WHEN
+        api_key_count, device_count, _ = warm_up()
+
+        # THEN
+        self.assertEqual((1, 1), (api_key_count, device_count))
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(get_signing_key_or_none(str(api_key.id)))
+            self.assertEqual(device.key, get_device_key_material_or_none(device.public_id).key_hex)
+
+    @override_settings(YUBIVAL_WARM_UP_DEVICES=2)
+    def test_most_recent_used_devices_are_preloaded(self):
+        # GIVEN
+        devices = [Device.objects.create(label='Device %d' % i) for i in range(4)]
+        DeviceCounter.objects.filter(device__in=devices[:3]).update(value=pack_counters(0, 3))
+
+        # WHEN
+        warm_up()
+
+        # THEN
+        self.assertEqual(
+            [False, True, True, False],
+            [device_cache.lru.get(device.public_id) is not None for device in devices],
+        )
+
+    def test_changes_during_warm_up_discard_preloaded_entries(self):
+        # GIVEN
+        device = Device.objects.create(label='John')
+        DeviceCounter.objects.filter(device=device).update(value=pack_counters(1, 0))
+
+        def load_devices(count):
+            Device.objects.filter(id=device.id).update(key='00112233445566778899aabbccddeeff')
+            device.save()  # Bumps the cache generation
+            return [(device.public_id, 'stale')]
+
+        # WHEN
+        with mock.patch('yubival.warmup.load_devices', load_devices), \
+                override_settings(YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL=0):
+            warm_up()
+            key_material = get_device_key_material_or_none(device.public_id)
+
+        # THEN
+        self.assertNotEqual('stale', key_material)
+
+    def test_missing_tables_skip_warm_up(self):
+        # WHEN
+        with mock.patch('yubival.warmup.warm_up', side_effect=DatabaseError('no such table')), \
+                self.assertLogs('yubival.warmup', 'WARNING') as logs:
+            warm_up_before_fork()
+
+        # THEN
+        self.assertEqual(['WARNING:yubival.warmup:Skipped cache warm-up: no such table'], logs.output)
+
+
+class IsServingTest(TestCase):
+    def test_servers_are_serving(self):
+        self.assertTrue(is_serving(['/usr/bin/gunicorn', 'mysite.wsgi']))
+        self.assertTrue(is_serving(['manage.py', 'runserver']))
+
+    def test_management_commands_are_not_serving(self):
+        self.assertFalse(is_serving(['manage.py', 'migrate']))
+        self.assertFalse(is_serving(['/usr/bin/django-admin', 'yubikey', 'list']))
+        self.assertFalse(is_serving(['/usr/lib/python3/site-packages/django/__main__.py', 'migrate']))
+        self.assertFalse(is_serving(['manage.py']))
+
+    @override_settings(YUBIVAL_WARM_UP=True)
+    def test_migrate_does_not_warm_up(self):
+        # WHEN
+        with mock.patch('sys.argv', ['manage.py', 'migrate']), \
+                mock.patch('yubival.warmup.warm_up_before_fork') as warm_up_before_fork:
+            apps.get_app_config('yubival').ready()
+
+        # THEN
+        warm_up_before_fork.assert_not_called()
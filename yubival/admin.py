@@ -1,20 +1,277 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.utils import model_ngettext
+from django.contrib.admin.views.main import ChangeList
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import connections, transaction
+from django.db.models import Q
+from django.http import QueryDict
+from django.utils.functional import cached_property
+from yubiotp.modhex import is_modhex
 
-from yubival.models import Device, APIKey
+from yubival.models import Device, DeviceCounter, APIKey, DEVICE_PUBLIC_ID_BYTE_LENGTH
+from yubival.sharding import device_database, get_shards
+from yubival.signals import api_keys_deleted_in_bulk, devices_deleted_in_bulk
 
 
-class APIKeyAdmin(admin.ModelAdmin):
+# Number of rows above which the admin paginators stop counting rows exactly:
+ADMIN_COUNT_LIMIT = 10000
+
+
+class LargeTablePaginator(Paginator):
+    """Paginator that does not count all the rows of large tables
+
+    Rows are counted up to `ADMIN_COUNT_LIMIT`. Above that, the count is estimated from the PostgreSQL table
+    statistics, or capped to the limit on other databases.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        count = queryset.order_by().values('pk')[:ADMIN_COUNT_LIMIT + 1].count()
+        if count <= ADMIN_COUNT_LIMIT:
+            return count
+
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [queryset.model._meta.db_table])
+                row = cursor.fetchone()
+            if row is not None:
+                return max(int(row[0]), count)
+        return count
+
+
+class ListOnlyChangeList(ChangeList):
+    """Change list only loading the `list_only` columns of the model admin"""
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).only(*self.model_admin.list_only)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Model admin whose change list only runs indexed queries
+
+    Subclasses define the `list_only` columns loaded in the change list and a `bulk_delete` action. Searches match a
+    case-sensitive prefix of the unique `label` column.
+    """
+
+    list_only = ()
+    list_per_page = 50
+    ordering = ('-id',)
+    paginator = LargeTablePaginator
+    show_full_result_count = False
+    # Only displayed by Django 4.0 and later:
+    search_help_text = 'Label prefix'
+    # Shows the search box, whose terms are looked up by `get_search_results`:
+    search_fields = (
+        'label',
+    )
+
+    def get_changelist(self, request, **kwargs):
+        return ListOnlyChangeList
+
+    def get_actions(self, request):
+        actions = super().get_actions(request)
+        # Replaced by `bulk_delete`, as the default action loads and deletes selected rows one by one:
+        actions.pop('delete_selected', None)
+        return actions
+
+    def get_search_results(self, request, queryset, search_term):
+        """Looks up labels by case-sensitive prefix
+
+        The `istartswith` lookup of a `^label` search field compares upper-cased labels, which no index covers. A
+        `LIKE 'prefix%'` lookup uses the index of the unique constraint, or on PostgreSQL the `varchar_pattern_ops`
+        index that Django creates along with it whatever the database collation.
+        """
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.filter(label__startswith=search_term), False
+
+    def delete_in_bulk(self, request, queryset, deleted_in_bulk, values_field):
+        """Deletes the selected rows with a single DELETE statement and runs `deleted_in_bulk` on their values"""
+        queryset = queryset.order_by()
+        with transaction.atomic(using=queryset.db):
+            values = list(queryset.values_list(values_field, flat=True))
+            # `QuerySet.delete` would load the rows to send the `post_delete` signal of each one:
+            deleted = queryset._raw_delete(queryset.db)
+            deleted_in_bulk(values)
+        self.message_user(
+            request,
+            'Successfully deleted %d %s.' % (deleted, model_ngettext(self.opts, deleted)),
+            messages.SUCCESS,
+        )
+
+
+def selected_shard(request):
+    """Returns the device shard selected in the change list, or in the change list that links to an object page"""
+    shard = request.GET.get('shard')
+    if shard is None:
+        shard = QueryDict(request.GET.get('_changelist_filters', '')).get('shard')
+    return shard if shard in get_shards() else None
+
+
+def request_shard(request):
+    """Returns the selected device shard, or the first one"""
+    return selected_shard(request) or get_shards()[0]
+
+
+def is_public_id(text):
+    return len(text) == 2 * DEVICE_PUBLIC_ID_BYTE_LENGTH and is_modhex(text.encode('utf-8'))
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    """Selects the database shard whose devices are listed, as the change list cannot span several databases"""
+
+    title = 'shard'
+    parameter_name = 'shard'
+
+    def lookups(self, request, model_admin):
+        return [(shard, shard) for shard in get_shards()]
+
+    def queryset(self, request, queryset):
+        return queryset  # `DeviceAdmin.get_queryset` already selected the database
+
+    def choices(self, changelist):
+        selected = self.value() or get_shards()[0]
+        for lookup, title in self.lookup_choices:
+            yield {
+                'selected': lookup == selected,
+                'query_string': changelist.get_query_string({self.parameter_name: lookup}),
+                'display': title,
+            }
+
+
+class DeviceForm(forms.ModelForm):
+    def validate_unique(self):
+        if not get_shards():
+            super().validate_unique()
+            return
+
+        # The unique constraints of each shard do not cover the devices of the other shards:
+        for name in ('label', 'public_id', 'private_id'):
+            if name not in self.cleaned_data:
+                continue
+            for shard in get_shards():
+                devices = Device.objects.using(shard).filter(**{name: self.cleaned_data[name]})
+                if shard == self.instance._state.db:
+                    devices = devices.exclude(pk=self.instance.pk)
+                if devices.exists():
+                    self.add_error(name, self.instance.unique_error_message(Device, (name,)))
+                    break
+
+
+class APIKeyAdmin(LargeTableAdmin):
+    list_display = (
+        'label',
+        'id',
+        'date_created',
+    )
+    list_only = list_display
     readonly_fields = (
         'date_created',
     )
+    actions = ('bulk_delete',)
+
+    def bulk_delete(self, request, queryset):
+        self.delete_in_bulk(request, queryset, api_keys_deleted_in_bulk, 'id')
+    bulk_delete.short_description = 'Delete selected API keys'
+    bulk_delete.allowed_permissions = ('delete',)
 
 
-class DeviceAdmin(admin.ModelAdmin):
+class DeviceAdmin(LargeTableAdmin):
+    form = DeviceForm
+    list_display = (
+        'label',
+        'public_id',
+        'session_counter',
+        'usage_counter',
+        'date_created',
+    )
+    list_select_related = ('counter',)
+    # The key material is never loaded in the change list:
+    list_only = (
+        'label',
+        'public_id',
+        'counter__value',
+        'date_created',
+    )
+    search_help_text = 'Label prefix, public ID or OTP'
     readonly_fields = (
         'session_counter',
         'usage_counter',
         'date_created',
     )
+    actions = ('bulk_delete',)
+
+    def session_counter(self, device):
+        return device.counter.session_counter
+    session_counter.short_description = 'session counter'
+
+    def usage_counter(self, device):
+        return device.counter.usage_counter
+    usage_counter.short_description = 'usage counter'
+
+    def get_list_filter(self, request):
+        return (ShardListFilter,) if get_shards() else ()
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if get_shards():
+            queryset = queryset.using(request_shard(request))
+        return queryset
+
+    def get_object(self, request, object_id, from_field=None):
+        """Looks up a device in the selected shard, or else in each shard in turn
+
+        With shards, a public ID is also accepted instead of the ID, and looked up in the shard of the public ID. IDs
+        are only unique in each shard: direct links should select a shard or use the public ID.
+        """
+        shards = get_shards()
+        if not shards or from_field is not None:
+            return super().get_object(request, object_id, from_field)
+        queryset = self.get_queryset(request)
+        if is_public_id(object_id):
+            return queryset.using(device_database(object_id)).filter(public_id=object_id).first()
+        if selected_shard(request) is not None:
+            return super().get_object(request, object_id, from_field)
+
+        try:
+            pk = self.model._meta.pk.to_python(object_id)
+        except ValidationError:
+            return
+        for shard in shards:
+            device = queryset.using(shard).filter(pk=pk).first()
+            if device is not None:
+                return device
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = super().get_readonly_fields(request, obj)
+        if obj is not None and get_shards():
+            # Devices are stored in the shard of their public ID:
+            readonly_fields += ('public_id',)
+        return readonly_fields
+
+    def get_search_results(self, request, queryset, search_term):
+        """Looks up a device by exact public ID, or by the public ID of an OTP, instead of a full table scan"""
+        search_term = search_term.strip()
+        public_id_length = 2 * DEVICE_PUBLIC_ID_BYTE_LENGTH
+        if len(search_term) >= public_id_length and is_modhex(search_term.encode('utf-8')):
+            return queryset.filter(
+                Q(public_id=search_term[:public_id_length]) | Q(label__startswith=search_term),
+            ), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def bulk_delete(self, request, queryset):
+        with transaction.atomic(using=queryset.db):
+            # The raw delete of the devices does not delete their counters in cascade:
+            counters = DeviceCounter.objects.using(queryset.db).filter(device__in=queryset.order_by().values('pk'))
+            counters._raw_delete(queryset.db)
+            self.delete_in_bulk(request, queryset, devices_deleted_in_bulk, 'public_id')
+    bulk_delete.short_description = 'Delete selected devices'
+    bulk_delete.allowed_permissions = ('delete',)
 
 
 admin.site.register(APIKey, APIKeyAdmin)
@@ -4,3 +4,13 @@ from django.apps import AppConfig
 class YubivalConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'yubival'
+
+    def ready(self):
+        import yubival.signals  # noqa: F401
+        from yubival.conf import get_setting
+
+        if get_setting('YUBIVAL_WARM_UP'):
+            from yubival.warmup import is_serving, warm_up_before_fork
+            # Other management commands do not use the caches, and `migrate` may run before the tables exist:
+            if is_serving():
+                warm_up_before_fork()
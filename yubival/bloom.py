@@ -0,0 +1,173 @@
+import hashlib
+import math
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.db import connections
+from django.dispatch import receiver
+
+from yubival.cache import PUBLIC_ID_FILTER_GENERATION, get_cache_generation
+from yubival.conf import get_setting
+from yubival.models import Device
+from yubival.sharding import device_databases
+
+
+# Number of public IDs fetched from the database at a time when building the filter:
+BUILD_CHUNK_SIZE = 10000
+
+
+class BloomFilter:
+    """Set membership test with false positives but no false negatives
+
+    Args:
+        capacity: expected number of elements.
+        error_rate: false positive rate when the filter holds `capacity` elements.
+        max_memory: maximum size of the bit array in bytes. A smaller array raises the false positive rate.
+    """
+
+    def __init__(self, capacity, error_rate, max_memory):
+        capacity = max(capacity, 1)
+        bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.size = max(min(bits, 8 * max_memory), 8)
+        self.hash_count = max(round(self.size / capacity * math.log(2)), 1)
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _indexes(self, value):
+        # Double hashing: the k indexes are derived from two independent 64-bit hashes.
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        bits = self._bits
+        for index in self._indexes(value):
+            bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, value):
+        bits = self._bits
+        return all(bits[index >> 3] & (1 << (index & 7)) for index in self._indexes(value))
+
+
+class PublicIdFilter:
+    """Bloom filter of the public IDs of all devices, rejecting OTPs of unknown devices without database query
+
+    The filter is built in a background thread, then rebuilt every `YUBIVAL_PUBLIC_ID_FILTER_REFRESH_INTERVAL` seconds
+    to forget deleted devices. It is only trusted while the public ID filter generation is the one it was built with, or
+    was advanced by the devices added in this process through `add_many`: devices saved by other processes disable it
+    until it is rebuilt. Deleted devices only cause false positives, so they do not change the generation.
+    """
+
+    def __init__(self):
+        self._bloom = None
+        self._generation = None
+        self._built_at = None
+        self._current_generation = None
+        self._checked_at = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def _check(self):
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < get_setting('YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL'):
+            return
+
+        self._current_generation = get_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+        self._checked_at = now
+        built_at = self._built_at
+        if (
+            built_at is None
+            or self._generation != self._current_generation
+            or now - built_at >= get_setting('YUBIVAL_PUBLIC_ID_FILTER_REFRESH_INTERVAL')
+        ):
+            self.start_build()
+
+    def start_build(self):
+        """Rebuilds the filter in a background thread, unless it is already being rebuilt"""
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build_in_thread, name='yubival-public-id-filter', daemon=True).start()
+
+    def _build_in_thread(self):
+        try:
+            self.build()
+        finally:
+            connections.close_all()
+
+    def build(self):
+        """Loads the public IDs of all devices in a new filter"""
+        try:
+            generation = get_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+            count = sum(Device.objects.using(using).count() for using in device_databases())
+            bloom = BloomFilter(
+                # Room for the devices added until the next rebuild:
+                count + count // 4 + 1024,
+                get_setting('YUBIVAL_PUBLIC_ID_FILTER_ERROR_RATE'),
+                get_setting('YUBIVAL_PUBLIC_ID_FILTER_MAX_MEMORY'),
+            )
+            for using in device_databases():
+                devices = Device.objects.using(using).values_list('public_id', flat=True)
+                for public_id in devices.iterator(chunk_size=BUILD_CHUNK_SIZE):
+                    bloom.add(public_id)
+
+            with self._lock:
+                self._bloom = bloom
+                self._generation = generation
+                self._built_at = time.monotonic()
+                self._checked_at = None
+        finally:
+            self._building = False
+
+    def add_many(self, public_ids):
+        """Adds devices created or changed by this process, after their change bumped the public ID filter generation"""
+        bloom = self._bloom
+        if bloom is None:
+            return
+        for public_id in public_ids:
+            bloom.add(public_id)
+        generation = get_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+        with self._lock:
+            # The filter stays trusted if no other change happened since it was built:
+            if self._bloom is bloom and generation == self._generation + 1:
+                self._generation = generation
+                self._current_generation = generation
+
+    def refresh(self):
+        """Rebuilds the filter on its next use, so that it forgets the devices deleted by this process
+
+        The current filter stays in use until then, as deleted devices only cause false positives.
+        """
+        with self._lock:
+            self._built_at = None
+            self._checked_at = None
+
+    def excludes(self, public_id):
+        """Returns whether a device is certainly not registered, or `False` if the filter is disabled or stale"""
+        if not get_setting('YUBIVAL_PUBLIC_ID_FILTER'):
+            return False
+        self._check()
+        bloom = self._bloom
+        if bloom is None or self._generation != self._current_generation:
+            return False
+        return public_id not in bloom
+
+    def clear(self):
+        with self._lock:
+            self._bloom = None
+            self._generation = None
+            self._built_at = None
+            self._current_generation = None
+            self._checked_at = None
+
+
+public_id_filter = PublicIdFilter()
+
+
+@receiver(setting_changed)
+def reset_public_id_filter(setting, **kwargs):
+    if setting.startswith('YUBIVAL_PUBLIC_ID_FILTER') or setting == 'YUBIVAL_DEVICE_SHARDS':
+        public_id_filter.clear()
@@ -0,0 +1,178 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.db.models import F
+
+from yubival.conf import get_setting
+from yubival.models import CacheGeneration
+
+
+API_KEY_CACHE_GENERATION = 'apikey'
+DEVICE_CACHE_GENERATION = 'device'
+# Bumped when devices are saved, which may add public IDs, but not when they are deleted:
+PUBLIC_ID_FILTER_GENERATION = 'public_id_filter'
+
+# Approximate memory footprint in bytes of a cached device, including its AES key schedule:
+DEVICE_CACHE_ENTRY_SIZE = 1200
+
+
+def get_cache_generation(name):
+    value = CacheGeneration.objects.filter(name=name).values_list('value', flat=True).first()
+    return 0 if value is None else value
+
+
+def bump_cache_generation(name):
+    """Increments a cache generation so that all processes discard their cached entries"""
+    CacheGeneration.objects.get_or_create(name=name)
+    CacheGeneration.objects.filter(name=name).update(value=F('value') + 1)
+
+
+class LRUCache:
+    """Thread-safe mapping that evicts its least recently used entries above a maximum size"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class GenerationCache:
+    """LRU cache whose entries are dropped when a database-stored generation changes
+
+    Local changes are invalidated through model signals. The generation stored in the database lets the other processes
+    notice these changes: it is read at most once every `YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL` seconds.
+
+    After a change, entries are reloaded from the primary databases for `YUBIVAL_READ_REPLICA_MAX_LAG` seconds.
+
+    Args:
+        generation_name: name of the `CacheGeneration` row tracking the cached table.
+        get_maxsize: function returning the maximum number of entries, called when the cache is first used.
+    """
+
+    def __init__(self, generation_name, get_maxsize):
+        self.generation_name = generation_name
+        self.get_maxsize = get_maxsize
+        self._lru = None
+        self._generation = None
+        self._checked_at = None
+        self._changed_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def lru(self):
+        if self._lru is None:
+            with self._lock:
+                if self._lru is None:
+                    self._lru = LRUCache(self.get_maxsize())
+        return self._lru
+
+    def _check_generation(self):
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is not None and now - checked_at < get_setting('YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL'):
+            return
+
+        generation = get_cache_generation(self.generation_name)
+        with self._lock:
+            if generation != self._generation:
+                self.lru.clear()
+                if self._generation is not None:
+                    self._changed_at = now
+                self._generation = generation
+            self._checked_at = now
+
+    def recently_changed(self):
+        """Returns whether an entry was invalidated or the generation changed less than the maximum replication lag ago
+
+        Replicas may not have received the change yet: the entries loaded from them would stay cached with stale keys.
+        """
+        changed_at = self._changed_at
+        return changed_at is not None and time.monotonic() - changed_at < get_setting('YUBIVAL_READ_REPLICA_MAX_LAG')
+
+    def get(self, key):
+        if self.lru.maxsize <= 0:
+            return
+        self._check_generation()
+        return self.lru.get(key)
+
+    def set(self, key, value):
+        self.lru.set(key, value)
+
+    def get_or_load(self, key, load):
+        """Returns the cached value for `key`, calling `load(key)` on misses
+
+        `None` values returned by `load` are not cached.
+        """
+        value = self.get(key)
+        if value is None:
+            value = load(key)
+            if value is not None:
+                self.set(key, value)
+        return value
+
+    def fill(self, load_items):
+        """Stores the list of `(key, value)` pairs returned by `load_items()` and returns its length
+
+        The generation is read before the entries are loaded, so that changes made in the meantime still discard them.
+        """
+        generation = get_cache_generation(self.generation_name)
+        items = load_items()
+        with self._lock:
+            self._generation = generation
+            self._checked_at = time.monotonic()
+        for key, value in items:
+            self.set(key, value)
+        return len(items)
+
+    def invalidate(self, key):
+        """Drops an entry and forces a generation check on the next access"""
+        self.lru.pop(key)
+        self._changed_at = time.monotonic()
+        self._checked_at = None
+
+    def clear(self):
+        with self._lock:
+            self._lru = None
+            self._generation = None
+            self._checked_at = None
+            self._changed_at = None
+
+
+api_key_cache = GenerationCache(
+    API_KEY_CACHE_GENERATION,
+    lambda: get_setting('YUBIVAL_API_KEY_CACHE_SIZE'),
+)
+device_cache = GenerationCache(
+    DEVICE_CACHE_GENERATION,
+    lambda: get_setting('YUBIVAL_DEVICE_CACHE_MAX_MEMORY') // DEVICE_CACHE_ENTRY_SIZE,
+)
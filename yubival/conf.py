@@ -0,0 +1,69 @@
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Maximum number of API keys kept in the in-process cache. 0 disables the cache.
+    'YUBIVAL_API_KEY_CACHE_SIZE': 1024,
+    # Memory budget in bytes of the in-process cache of device keys. 0 disables the cache.
+    'YUBIVAL_DEVICE_CACHE_MAX_MEMORY': 64 * 2**20,
+    # Minimum delay in seconds between two checks of the database-stored cache generations.
+    'YUBIVAL_CACHE_GENERATION_CHECK_INTERVAL': 1.0,
+    # Whether API keys and device keys are preloaded in the in-process caches when the application is loaded.
+    'YUBIVAL_WARM_UP': False,
+    # Maximum number of devices preloaded by the warm-up.
+    'YUBIVAL_WARM_UP_DEVICES': 10000,
+    # Whether OTPs of unknown devices are rejected without database query, using a Bloom filter of all public IDs.
+    'YUBIVAL_PUBLIC_ID_FILTER': False,
+    # False positive rate of the public ID filter, and its maximum memory in bytes, which takes precedence.
+    'YUBIVAL_PUBLIC_ID_FILTER_ERROR_RATE': 0.01,
+    'YUBIVAL_PUBLIC_ID_FILTER_MAX_MEMORY': 16 * 2**20,
+    # Delay in seconds between two rebuilds of the public ID filter, which forget deleted devices.
+    'YUBIVAL_PUBLIC_ID_FILTER_REFRESH_INTERVAL': 3600,
+    # Duration in seconds during which each worker remembers request nonces to detect replayed requests. 0 disables the
+    # detection.
+    'YUBIVAL_NONCE_WINDOW': 300,
+    # Maximum number of nonces remembered by each worker.
+    'YUBIVAL_NONCE_MAX_ENTRIES': 100000,
+    # Dotted path of the `CounterStore` class storing device counters, and its keyword arguments.
+    'YUBIVAL_COUNTER_STORE': 'yubival.counters.DjangoCounterStore',
+    'YUBIVAL_COUNTER_STORE_OPTIONS': {},
+    # Database aliases storing the devices, selected by consistent hashing of their public ID. Empty disables sharding.
+    'YUBIVAL_DEVICE_SHARDS': [],
+    # Aliases of the read replicas of each database, used to look up API keys and device keys. Counters are always read
+    # and updated in the primary databases.
+    'YUBIVAL_READ_REPLICAS': {},
+    # Duration in seconds after a change of the API keys or devices during which they are loaded from the primary
+    # databases. It must exceed the replication lag, otherwise the former keys may stay cached.
+    'YUBIVAL_READ_REPLICA_MAX_LAG': 60,
+    # Maximum number of OTPs in a batch verification request.
+    'YUBIVAL_BATCH_MAX_SIZE': 100,
+    # URLs of the `wsapi/2.0/sync` endpoint of the other validation servers sharing the same devices.
+    'YUBIVAL_SYNC_PEERS': [],
+    # Base64-encoded secret key shared by the validation servers to sign synchronization requests, or `None`.
+    'YUBIVAL_SYNC_KEY': None,
+    # Percentage of the peers that must confirm an OTP when requests have no `sl` parameter.
+    'YUBIVAL_SYNC_DEFAULT_LEVEL': 60,
+    # Maximum duration in seconds of the synchronization when requests have no `timeout` parameter.
+    'YUBIVAL_SYNC_DEFAULT_TIMEOUT': 1,
+    # Maximum number of concurrent synchronization requests to the peers.
+    'YUBIVAL_SYNC_THREADS': 16,
+    # Maximum number of queued and running synchronization requests, above which new ones are dropped.
+    'YUBIVAL_SYNC_MAX_PENDING': 1000,
+    # Whether validation metrics are collected and exposed at `metrics` in the Prometheus text format.
+    'YUBIVAL_METRICS': False,
+    # Directory where each worker process writes its metrics so that they are aggregated, or `None`.
+    'YUBIVAL_METRICS_DIR': None,
+    # Whether verification responses have a `Server-Timing` header with the duration of each validation stage.
+    'YUBIVAL_STAGE_TIMING': False,
+    # Callable, or its dotted path, called with the request and the list of (stage, seconds) pairs of each verification.
+    'YUBIVAL_STAGE_TIMING_HOOK': None,
+    # Whether `wsapi/2.0/verify` and `wsapi/2.0/verify_batch` are served by asynchronous views. Requires Django >= 3.1.
+    'YUBIVAL_ASYNC_VERIFY_VIEW': False,
+    # Number of threads running the verifications of the asynchronous views, and maximum number of concurrent ones.
+    'YUBIVAL_ASYNC_THREADS': 8,
+}
+
+
+def get_setting(name):
+    """Returns the value of a Yubival setting, falling back to its default value"""
+    return getattr(settings, name, DEFAULTS[name])
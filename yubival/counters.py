@@ -0,0 +1,353 @@
+import hashlib
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from yubival.conf import get_setting
+from yubival.models import Device, DeviceCounter, pack_counters, unpack_counters
+from yubival.sharding import device_database, group_by_database
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+def request_digest(token, nonce):
+    """Returns the fixed-length digest of the OTP and nonce of a verification request, stored along with the counters"""
+    return hashlib.blake2b(('%s %s' % (token, nonce)).encode('utf-8'), digest_size=8).hexdigest()
+
+
+class CounterStore:
+    """Storage of the (session_counter, usage_counter) pairs used for OTP replay detection
+
+    Counters are tuples that compare in the same order as the OTPs. Methods accept the `DeviceKeyMaterial` used to
+    decode the OTP; backends that store counters in the database use it to only update a device whose keys did not
+    change since they were cached.
+
+    The `request_digest` of the OTP and nonce of the request that validated the stored counters is also kept, so that
+    the same request sent to several synchronized servers is not taken for a replay.
+    """
+
+    def get(self, public_ids):
+        """Returns a dictionary of the counters of the given devices, omitting unknown devices"""
+        raise NotImplementedError
+
+    def advance(self, public_id, counters, key_material, digest=''):
+        """Stores `counters` and the `digest` of their request if the counters are more recent than the stored ones
+
+        Returns:
+            updated: whether the counters were stored.
+        """
+        raise NotImplementedError
+
+    def compare_and_set(self, public_id, expected, counters, key_material, digest=''):
+        """Stores `counters` and the `digest` of their request if the stored counters are equal to `expected`
+
+        Returns:
+            updated: whether the counters were stored.
+        """
+        raise NotImplementedError
+
+    def is_accepted(self, public_id, counters, digest):
+        """Returns whether `counters` are the stored ones and were stored for the request of `digest`"""
+        raise NotImplementedError
+
+    def reset(self, public_id):
+        """Forgets the counters of a device, called when a device is created or deleted"""
+
+    def reset_many(self, public_ids):
+        """Forgets the counters of several devices, called when devices are created in bulk"""
+        for public_id in public_ids:
+            self.reset(public_id)
+
+
+class DjangoCounterStore(CounterStore):
+    """Stores counters in the `DeviceCounter` table, of the `using` database or of the shard of each device"""
+
+    def __init__(self, using=None):
+        self.using = using
+
+    def _counters(self, public_id, key_material):
+        using = self.using or device_database(public_id)
+        # A subquery rather than a join, so that the device row is neither updated nor locked:
+        devices = Device.objects.using(using).filter(
+            public_id=public_id,
+            private_id=key_material.private_id_hex,
+            key=key_material.key_hex,
+        )
+        return DeviceCounter.objects.using(using).filter(device__in=devices.values('id'))
+
+    def get(self, public_ids):
+        groups = {self.using: list(public_ids)} if self.using else group_by_database(public_ids)
+        counters = {}
+        for using, group in groups.items():
+            rows = DeviceCounter.objects.using(using).filter(device__public_id__in=group)
+            connection = transaction.get_connection(using)
+            if connection.in_atomic_block:
+                # Only locks the counter rows, not the joined device rows:
+                if connection.features.has_select_for_update_of:
+                    rows = rows.select_for_update(of=('self',))
+                else:
+                    rows = rows.select_for_update()
+            counters.update(
+                (public_id, unpack_counters(value))
+                for public_id, value in rows.values_list('device__public_id', 'value')
+            )
+        return counters
+
+    def advance(self, public_id, counters, key_material, digest=''):
+        value = pack_counters(*counters)
+        rows = self._counters(public_id, key_material).filter(value__lt=value)
+        return rows.update(value=value, request_digest=digest) == 1
+
+    def compare_and_set(self, public_id, expected, counters, key_material, digest=''):
+        rows = self._counters(public_id, key_material).filter(value=pack_counters(*expected))
+        return rows.update(value=pack_counters(*counters), request_digest=digest) == 1
+
+    def is_accepted(self, public_id, counters, digest):
+        rows = DeviceCounter.objects.using(self.using or device_database(public_id)).filter(
+            device__public_id=public_id,
+            value=pack_counters(*counters),
+            request_digest=digest,
+        )
+        return rows.exists()
+
+
+class MemoryCounterStore(CounterStore):
+    """Stores counters in memory, for tests and benchmarks
+
+    Counters of devices that are not yet in the store are initialized from the `DeviceCounter` table. Counters are lost
+    when the process exits and are not shared between processes.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _load(self, public_id):
+        counters = self._counters.get(public_id)
+        if counters is None:
+            rows = DeviceCounter.objects.using(device_database(public_id)).filter(device__public_id=public_id)
+            row = rows.values_list('value', 'request_digest').first()
+            if row is not None:
+                with self._lock:
+                    if public_id not in self._counters:
+                        self._counters[public_id] = unpack_counters(row[0])
+                        self._digests[public_id] = row[1]
+                    counters = self._counters[public_id]
+        return counters
+
+    def _store(self, public_id, counters, digest):
+        """Stores counters and a request digest with `self._lock` held and returns a value passed to `_flush`"""
+        self._counters[public_id] = counters
+        self._digests[public_id] = digest
+
+    def _flush(self, position):
+        """Makes the stored counters durable, called after `self._lock` is released"""
+
+    def get(self, public_ids):
+        result = {}
+        for public_id in public_ids:
+            counters = self._load(public_id)
+            if counters is not None:
+                result[public_id] = counters
+        return result
+
+    def advance(self, public_id, counters, key_material, digest=''):
+        self._load(public_id)
+        with self._lock:
+            stored = self._counters.get(public_id)
+            if stored is None or counters <= stored:
+                return False
+            position = self._store(public_id, counters, digest)
+        self._flush(position)
+        return True
+
+    def compare_and_set(self, public_id, expected, counters, key_material, digest=''):
+        self._load(public_id)
+        with self._lock:
+            if self._counters.get(public_id) != expected:
+                return False
+            position = self._store(public_id, counters, digest)
+        self._flush(position)
+        return True
+
+    def is_accepted(self, public_id, counters, digest):
+        self._load(public_id)
+        with self._lock:
+            return self._counters.get(public_id) == counters and self._digests.get(public_id) == digest
+
+    def reset(self, public_id):
+        with self._lock:
+            self._counters.pop(public_id, None)
+            self._digests.pop(public_id, None)
+
+
+class JournalCounterStore(MemoryCounterStore):
+    """Stores counters in memory, backed by an append-only journal file
+
+    Each update appends a line to the journal and waits until the file has been synced to disk. Concurrent updates are
+    synced together by a single fsync call (group commit). The journal is compacted when the store is opened, and when
+    it holds more than `compaction_ratio` records per device.
+
+    The file is locked by the process that opens it, so this backend requires a single worker process.
+
+    Args:
+        path: path of the journal file.
+        compaction_ratio: number of records per device above which the journal is compacted.
+        compaction_min_records: number of records below which the journal is not compacted, whatever the ratio.
+    """
+
+    def __init__(self, path, compaction_ratio=10, compaction_min_records=10000):
+        super().__init__()
+        self.path = path
+        self.compaction_ratio = compaction_ratio
+        self.compaction_min_records = compaction_min_records
+        self._file = None
+        self._records = 0
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+        self._sync_condition = threading.Condition()
+        self._lock_file()
+        self._replay()
+        self._compact()
+
+    def _lock_file(self):
+        self._lock_file_handle = open('%s.lock' % self.path, 'w')
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file_handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                self._lock_file_handle.close()
+                raise ImproperlyConfigured('Counter journal %s is used by another process.' % self.path)
+
+    def _replay(self):
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        break  # Record truncated by a crash
+                    self._records += 1
+                    fields = line.split()
+                    if len(fields) == 1:
+                        self._counters.pop(fields[0], None)
+                        self._digests.pop(fields[0], None)
+                    else:
+                        # Records written before request digests were journaled only have counters:
+                        self._counters[fields[0]] = (int(fields[1]), int(fields[2]))
+                        self._digests[fields[0]] = fields[3] if len(fields) > 3 else ''
+        except FileNotFoundError:
+            pass
+
+    def _needs_compaction(self):
+        return self._records > max(self.compaction_ratio * len(self._counters), self.compaction_min_records)
+
+    def _compact(self):
+        """Rewrites the journal with one record per device, which also syncs all the records appended so far
+
+        Called with self._lock held once the store is opened, while this process holds the lock of the journal file.
+        """
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as f:
+            for public_id, (session_counter, usage_counter) in self._counters.items():
+                f.write('%s %d %d %s\n' % (public_id, session_counter, usage_counter, self._digests.get(public_id, '')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, 'a')
+        self._records = len(self._counters)
+
+    def _append(self, line):
+        # Called with self._lock held, so that lines are written in the order of the in-memory updates.
+        self._file.write(line)
+        self._records += 1
+        self._written += 1
+        return self._written
+
+    def _store(self, public_id, counters, digest):
+        super()._store(public_id, counters, digest)
+        return self._append('%s %d %d %s\n' % (public_id, counters[0], counters[1], digest))
+
+    def _flush(self, position):
+        """Waits until the journal is synced up to `position`, syncing it if no other thread does"""
+        with self._sync_condition:
+            while self._synced < position:
+                if self._syncing:
+                    self._sync_condition.wait()
+                    continue
+
+                self._syncing = True
+                self._sync_condition.release()
+                try:
+                    # Only the syncing thread replaces the file, so it is not closed until it is synced:
+                    with self._lock:
+                        target = self._written
+                        compacted = self._needs_compaction()
+                        if compacted:
+                            self._compact()
+                        else:
+                            self._file.flush()
+                    if not compacted:
+                        os.fsync(self._file.fileno())
+                finally:
+                    self._sync_condition.acquire()
+                    self._syncing = False
+                    self._sync_condition.notify_all()
+                self._synced = max(self._synced, target)
+
+    def reset(self, public_id):
+        with self._lock:
+            self._counters.pop(public_id, None)
+            self._digests.pop(public_id, None)
+            position = self._append('%s\n' % public_id)
+        self._flush(position)
+
+    def reset_many(self, public_ids):
+        position = None
+        with self._lock:
+            for public_id in public_ids:
+                self._counters.pop(public_id, None)
+                self._digests.pop(public_id, None)
+                position = self._append('%s\n' % public_id)
+        if position is not None:
+            self._flush(position)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+            self._lock_file_handle.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_counter_store():
+    """Returns the counter store selected by the `YUBIVAL_COUNTER_STORE` setting"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store_class = import_string(get_setting('YUBIVAL_COUNTER_STORE'))
+                _store = store_class(**get_setting('YUBIVAL_COUNTER_STORE_OPTIONS'))
+    return _store
+
+
+@receiver(setting_changed)
+def reset_counter_store(setting, **kwargs):
+    global _store
+    if setting in ('YUBIVAL_COUNTER_STORE', 'YUBIVAL_COUNTER_STORE_OPTIONS'):
+        with _store_lock:
+            if _store is not None and hasattr(_store, 'close'):
+                _store.close()
+            _store = None
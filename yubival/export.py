@@ -0,0 +1,91 @@
+import csv
+import datetime
+import json
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+OUTPUT_FORMATS = ('text', 'csv', 'jsonl')
+
+# Number of rows fetched from the database at a time when listing a table:
+EXPORT_CHUNK_SIZE = 2000
+
+
+def datetime_type(value):
+    """Argparse type of ISO 8601 dates and datetimes, returning a datetime in the current time zone"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError
+        parsed = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+datetime_type.__name__ = 'datetime'
+
+
+def add_export_arguments(parser):
+    """Adds the filter and output format options of listing subcommands to an argparse parser"""
+    parser.add_argument('--label-prefix', type=str, help='only list entries whose label starts with this prefix')
+    parser.add_argument(
+        '--created-after',
+        type=datetime_type,
+        help='only list entries created at or after this ISO 8601 date or datetime',
+    )
+    parser.add_argument(
+        '--created-before',
+        type=datetime_type,
+        help='only list entries created before this ISO 8601 date or datetime',
+    )
+    parser.add_argument(
+        '--format',
+        choices=OUTPUT_FORMATS,
+        default='text',
+        help='output format: aligned columns, CSV with a header line, or one JSON object per line (default: text)',
+    )
+
+
+def filter_queryset(queryset, options):
+    """Applies the filter options of `add_export_arguments` to a queryset"""
+    if options['label_prefix']:
+        queryset = queryset.filter(label__startswith=options['label_prefix'])
+    if options['created_after'] is not None:
+        queryset = queryset.filter(date_created__gte=options['created_after'])
+    if options['created_before'] is not None:
+        queryset = queryset.filter(date_created__lt=options['created_before'])
+    return queryset
+
+
+def iterate_rows(queryset, fields):
+    """Returns an iterator of the value tuples of a queryset, fetching rows in chunks so that memory use is constant"""
+    return queryset.order_by('id').values_list(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def export_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+def write_rows(stream, fields, rows, output_format):
+    """Writes rows to a stream in the CSV or JSON lines format
+
+    Args:
+        stream: file-like object or management command output wrapper.
+        fields: field names, used as CSV header and JSON keys.
+        rows: iterable of value tuples.
+        output_format: `'csv'` or `'jsonl'`.
+    """
+    if output_format == 'csv':
+        writer = csv.writer(stream, lineterminator='\n')
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([export_value(value) for value in row])
+    else:  # output_format == 'jsonl'
+        for row in rows:
+            stream.write('%s\n' % json.dumps(dict(zip(fields, (export_value(value) for value in row)))))
@@ -0,0 +1,134 @@
+import base64
+import math
+import time
+import urllib.parse
+import urllib.request
+
+from django.db import connections
+from django.http import QueryDict
+from django.test import Client
+from yubiotp.otp import YubiKey, encode_otp
+
+from yubival.views import hmac_sign_string, ordered_parameters_string, parse_response
+
+
+class SyntheticYubiKey:
+    """Simulated YubiKey generating OTPs with increasing counters for a registered device
+
+    Generated OTPs start at the session following `session_counter`, so that they are more recent than any OTP already
+    accepted for the device.
+    """
+
+    def __init__(self, public_id, private_id, key, session_counter=0):
+        self.public_id = public_id
+        self.key = bytes.fromhex(key)
+        self._yubikey = YubiKey(bytes.fromhex(private_id), session=session_counter + 1)
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(device.public_id, device.private_id, device.key, device.counter.session_counter)
+
+    def token(self):
+        return encode_otp(self._yubikey.generate(), self.key, self.public_id.encode('utf-8')).decode('utf-8')
+
+
+class SyntheticClient:
+    """API client signing verification requests
+
+    Args:
+        client_id: API key ID.
+        key: API key, base64-encoded.
+        nonce_prefix: prefix making the nonces of this client unique among concurrent clients.
+    """
+
+    def __init__(self, client_id, key, nonce_prefix=''):
+        self.client_id = client_id
+        self.key = base64.b64decode(key)
+        self.nonce_prefix = nonce_prefix
+        self._nonce_count = 0
+
+    @classmethod
+    def from_api_key(cls, api_key, nonce_prefix=''):
+        return cls(api_key.id, api_key.key, nonce_prefix)
+
+    def nonce(self):
+        self._nonce_count += 1
+        return '%s%016d' % (self.nonce_prefix, self._nonce_count)
+
+    def sign(self, params):
+        q = QueryDict('', mutable=True)
+        q.update(params)
+        q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), self.key)
+        return q
+
+    def verify_query(self, yubikey):
+        """Returns the query string of a signed verification request for a new OTP of `yubikey`"""
+        return self.sign({
+            'id': str(self.client_id),
+            'otp': yubikey.token(),
+            'nonce': self.nonce(),
+        }).urlencode()
+
+
+class InProcessTarget:
+    """Sends verification requests to the Django request handler of the current process
+
+    Targets are not thread-safe: each worker needs its own.
+    """
+
+    def __init__(self, path, host):
+        self.path = path
+        self.host = host
+        self._client = None
+
+    def get(self, query):
+        if self._client is None:
+            self._client = Client(HTTP_HOST=self.host)
+        return self._client.get('%s?%s' % (self.path, query)).content.decode('utf-8')
+
+    def close(self):
+        connections.close_all()
+
+
+class HTTPTarget:
+    """Sends verification requests to a validation server URL"""
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def get(self, query):
+        separator = '&' if urllib.parse.urlsplit(self.url).query else '?'
+        with urllib.request.urlopen('%s%s%s' % (self.url, separator, query), timeout=self.timeout) as response:
+            return response.read().decode('utf-8')
+
+    def close(self):
+        pass
+
+
+def run_load(target, client, yubikeys, requests):
+    """Sends `requests` verification requests, cycling through `yubikeys`
+
+    Returns:
+        results: list of `(status, latency)` pairs, where `latency` is in seconds and `status` is the response status or
+            the name of the exception raised by the request.
+    """
+    results = []
+    try:
+        for i in range(requests):
+            query = client.verify_query(yubikeys[i % len(yubikeys)])
+            start = time.perf_counter()
+            try:
+                status = parse_response(target.get(query)).get('status', 'NO_STATUS')
+            except Exception as e:
+                status = type(e).__name__
+            results.append((status, time.perf_counter() - start))
+    finally:
+        target.close()
+    return results
+
+
+def percentile(sorted_values, fraction):
+    """Returns the nearest-rank percentile of a sorted list"""
+    rank = math.ceil(fraction * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
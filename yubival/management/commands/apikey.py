@@ -1,24 +1,36 @@
 from django.core.management.base import BaseCommand
 from django.db import IntegrityError
+from django.db.models import Max
 
+from yubival.export import add_export_arguments, filter_queryset, iterate_rows, write_rows
 from yubival.models import APIKey
 
 
+# Fields of the CSV and JSON lines listings, which do not include the keys:
+API_KEY_LIST_FIELDS = ('id', 'label', 'date_created')
+
+
 class Command(BaseCommand):
     help = 'Manages API keys'
     requires_migrations_checks = True
 
-    def _list(self):
-        """Lists all API keys"""
+    def _list(self, options):
+        """Lists the API keys matching the filter options"""
+
+        keys = filter_queryset(APIKey.objects.all(), options)
+
+        if options['format'] != 'text':
+            write_rows(self.stdout, API_KEY_LIST_FIELDS, iterate_rows(keys, API_KEY_LIST_FIELDS), options['format'])
+            return
 
-        if APIKey.objects.count() == 0:
+        max_id = keys.aggregate(Max('id'))['id__max']
+        if max_id is None:
             return
 
-        id_column_size = len(str(APIKey.objects.latest('id').id))
-        row_format = '{:<%d} {:<}' % id_column_size
+        row_format = '{:<%d} {:<}' % len(str(max_id))
 
-        for key in APIKey.objects.order_by('id'):
-            self.stdout.write(row_format.format(key.id, key.label))
+        for key_id, label in iterate_rows(keys, ('id', 'label')):
+            self.stdout.write(row_format.format(key_id, label))
 
     def _add(self, label):
         """Adds an API key"""
@@ -60,11 +72,12 @@ class Command(BaseCommand):
         )
         parser_add.add_argument('label', type=str, help='API key label')
 
-        subparsers.add_parser(
+        parser_list = subparsers.add_parser(
             'list',
             called_from_command_line=True,
             description='Lists API keys',
         )
+        add_export_arguments(parser_list)
 
         parser_delete = subparsers.add_parser(
             'delete',
@@ -80,4 +93,4 @@ class Command(BaseCommand):
         elif subcommand == 'delete':
             self._delete(options['id'])
         else:  # subcommand == 'list'
-            self._list()
+            self._list(options)
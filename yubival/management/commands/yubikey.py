@@ -1,24 +1,84 @@
+import csv
+import itertools
 import random
+import sys
+from collections import defaultdict
 
-from django.core.management.base import BaseCommand
-from django.db import IntegrityError
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, connections, transaction
+from django.db.models import Q
 from yubiotp.modhex import modhex
 
-from yubival.models import Device, DEVICE_PUBLIC_ID_BYTE_LENGTH, DEVICE_PRIVATE_ID_BYTE_LENGTH
+from yubival.export import add_export_arguments, filter_queryset, iterate_rows, write_rows
+from yubival.models import Device, DeviceCounter, DEVICE_PUBLIC_ID_BYTE_LENGTH, DEVICE_PRIVATE_ID_BYTE_LENGTH, \
+    unpack_counters
+from yubival.sharding import device_database, device_databases, get_shards
+from yubival.signals import devices_created_in_bulk
 from yubival.validators import argparse_type
 
 
+DEVICE_FIELDS = ('label', 'public_id', 'private_id', 'key')
+IMPORT_FORMATS = ('csv', 'ykman')
+# Fields of the CSV and JSON lines listings, which do not include the device secrets:
+DEVICE_LIST_FIELDS = ('id', 'public_id', 'label', 'date_created', 'session_counter', 'usage_counter')
+
+
+def import_rows(rows, file_format, label_prefix):
+    """Yields the `(line_number, fields)` pairs of the devices of an import file
+
+    `fields` are the (label, public_id, private_id, key) strings of a device, or `None` if the line is malformed.
+
+    Args:
+        rows: CSV reader of the import file.
+        file_format: `'csv'` for files with label, public_id, private_id and key columns, with an optional header line,
+            or `'ykman'` for YubiKey Manager logs, whose columns are serial, public_id, private_id, key and other
+            settings. Devices of YubiKey Manager logs are labeled with `label_prefix` followed by their serial number,
+            or by their public ID if the serial number is not logged.
+        label_prefix: prefix of the device labels of YubiKey Manager logs.
+    """
+    for row in rows:
+        line_number = rows.line_num
+        if not row or not ''.join(row).strip() or row[0].startswith('#'):
+            continue
+        if file_format == 'csv':
+            if line_number == 1 and tuple(row) == DEVICE_FIELDS:
+                continue
+            yield line_number, tuple(row) if len(row) == 4 else None
+        else:  # file_format == 'ykman'
+            if len(row) < 4:
+                yield line_number, None
+                continue
+            serial, public_id, private_id, key = row[:4]
+            yield line_number, ('%s%s' % (label_prefix, serial or public_id), public_id, private_id, key)
+
+
 class Command(BaseCommand):
     help = 'Manages YubiKey devices'
     requires_migrations_checks = True
 
-    def _list(self):
-        """Lists all registered YubiKeys"""
+    def _list(self, options):
+        """Lists the registered YubiKeys matching the filter options, of each database storing devices in turn"""
+
+        querysets = []
+        for using in device_databases():
+            devices = filter_queryset(Device.objects.using(using), options)
+            if options['used'] is not None:
+                unused = Q(counter__value=0)
+                devices = devices.exclude(unused) if options['used'] else devices.filter(unused)
+            querysets.append(devices)
 
-        row_format = '{:%d} {:<}' % DEVICE_PUBLIC_ID_BYTE_LENGTH
+        def rows(fields):
+            return itertools.chain.from_iterable(iterate_rows(devices, fields) for devices in querysets)
 
-        for key in Device.objects.order_by('id'):
-            self.stdout.write(row_format.format(key.public_id, key.label))
+        if options['format'] == 'text':
+            row_format = '{:%d} {:<}' % DEVICE_PUBLIC_ID_BYTE_LENGTH
+            for public_id, label in rows(('public_id', 'label')):
+                self.stdout.write(row_format.format(public_id, label))
+        else:
+            # The session and usage counters are unpacked from the last column:
+            fields = DEVICE_LIST_FIELDS[:-2] + ('counter__value',)
+            list_rows = (row[:-1] + unpack_counters(row[-1]) for row in rows(fields))
+            write_rows(self.stdout, DEVICE_LIST_FIELDS, list_rows, options['format'])
 
     def _add(self, label):
         """Registers a YubiKey by autogenerating device IDs and key"""
@@ -48,10 +108,141 @@ class Command(BaseCommand):
 
         self.stdout.write(self.style.SUCCESS('Created: %s' % str(device)))
 
+    def _import(self, path, file_format, batch_size, label_prefix):
+        """Registers the YubiKeys of a CSV file or YubiKey Manager log
+
+        Devices are inserted in batches of `batch_size`, each in its own transaction. Lines whose device already exists
+        with the same IDs and key are skipped, so that an interrupted import can be resumed by running it again.
+        """
+        field_types = {
+            name: argparse_type(Device._meta.get_field(name))
+            for name in DEVICE_FIELDS
+        }
+        counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+
+        try:
+            f = sys.stdin if path == '-' else open(path, newline='')
+        except OSError as e:
+            raise CommandError('Cannot read %s: %s' % (path, e.strerror))
+
+        try:
+            batch = []
+            for line_number, fields in import_rows(csv.reader(f), file_format, label_prefix):
+                if fields is None:
+                    self._import_error(counts, line_number, 'expected label, public_id, private_id and key fields')
+                    continue
+
+                values = {}
+                for name, value in zip(DEVICE_FIELDS, fields):
+                    try:
+                        values[name] = field_types[name](value.strip())
+                    except ValueError:
+                        self._import_error(counts, line_number, 'invalid %s "%s"' % (name, value))
+                        break
+                else:
+                    batch.append((line_number, Device(**values)))
+
+                if len(batch) >= batch_size:
+                    self._import_batch(batch, counts)
+                    batch = []
+            if batch:
+                self._import_batch(batch, counts)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        style = self.style.SUCCESS if counts['failed'] == 0 else self.style.WARNING
+        self.stdout.write(style(
+            'Imported %(imported)d devices, skipped %(skipped)d already imported, %(failed)d failed.' % counts
+        ))
+
+    def _import_error(self, counts, line_number, message):
+        counts['failed'] += 1
+        self.stdout.write(self.style.ERROR('Line %d: %s' % (line_number, message)))
+
+    def _import_batch(self, batch, counts):
+        """Inserts a batch of `(line_number, device)` pairs, reporting the devices that conflict with existing ones
+
+        Labels and private IDs are checked against the devices of all shards, whose tables only enforce their
+        uniqueness within each shard.
+        """
+        public_ids = [device.public_id for _, device in batch]
+        labels = [device.label for _, device in batch]
+        private_ids = [device.private_id for _, device in batch]
+        existing = {}
+        taken = {'label': set(), 'public_id': set(), 'private_id': set()}
+        for using in device_databases():
+            devices = Device.objects.using(using)
+            existing.update(
+                (public_id, (private_id, key))
+                for public_id, private_id, key in devices.filter(public_id__in=public_ids).values_list(
+                    'public_id', 'private_id', 'key',
+                )
+            )
+            taken['label'].update(devices.filter(label__in=labels).values_list('label', flat=True))
+            taken['private_id'].update(devices.filter(private_id__in=private_ids).values_list('private_id', flat=True))
+        taken['public_id'].update(existing)
+
+        new_devices = []
+        for line_number, device in batch:
+            if existing.get(device.public_id) == (device.private_id, device.key):
+                counts['skipped'] += 1
+                continue
+
+            duplicates = [name for name, values in taken.items() if getattr(device, name) in values]
+            if duplicates:
+                self._import_error(counts, line_number, 'duplicate %s' % ', '.join(
+                    '%s "%s"' % (name, getattr(device, name)) for name in duplicates
+                ))
+                continue
+
+            for name, values in taken.items():
+                values.add(getattr(device, name))
+            new_devices.append((line_number, device))
+
+        shard_devices = defaultdict(list)
+        for line_number, device in new_devices:
+            shard_devices[device_database(device.public_id)].append((line_number, device))
+
+        created = []
+        for using, shard_batch in shard_devices.items():
+            try:
+                with transaction.atomic(using=using):
+                    devices = Device.objects.using(using).bulk_create([device for _, device in shard_batch])
+                    self._create_counters(using, {device.public_id: 0 for device in devices})
+                created.extend(device for _, device in shard_batch)
+            except IntegrityError:
+                # Devices were concurrently added by another process: insert them one by one to find the conflicting
+                # ones.
+                for line_number, device in shard_batch:
+                    try:
+                        with transaction.atomic(using=using):
+                            device.save(force_insert=True, using=using)
+                        created.append(device)
+                    except IntegrityError as e:
+                        self._import_error(counts, line_number, 'failed creating device: %s' % e.args[0])
+
+        # `bulk_create` does not send the `post_save` signals that reset the counters of new devices:
+        devices_created_in_bulk([device.public_id for device in created])
+        counts['imported'] += len(created)
+
+    def _create_counters(self, using, counters):
+        """Creates the counter rows of devices inserted without sending `post_save` signals
+
+        Args:
+            using: database alias of the devices.
+            counters: dictionary of the packed counters of the devices, by public ID.
+        """
+        # Not all databases return the primary keys of the devices inserted in bulk:
+        device_ids = Device.objects.using(using).filter(public_id__in=counters).values_list('public_id', 'id')
+        DeviceCounter.objects.using(using).bulk_create([
+            DeviceCounter(device_id=device_id, value=counters[public_id]) for public_id, device_id in device_ids
+        ])
+
     def _delete(self, public_id):
         """Deletes a YubiKey"""
         try:
-            device = Device.objects.get(public_id=public_id)
+            device = Device.objects.using(device_database(public_id)).get(public_id=public_id)
         except Device.DoesNotExist:
             self.stdout.write(self.style.ERROR('Device public_id=%s does not exist.' % public_id))
             return
@@ -60,6 +251,92 @@ class Command(BaseCommand):
         device.delete()
         self.stdout.write(self.style.SUCCESS('Deleted: %s' % device_str))
 
+    def _rebalance(self, sources, batch_size, dry_run):
+        """Moves the devices that are not stored in the shard of their public ID, after shards were added or removed
+
+        The shards and the `sources` databases are scanned in batches of `batch_size` devices. Misplaced devices are
+        copied to their shard, along with their counters and creation date, then deleted from their former database.
+        Devices already copied by an interrupted run are only deleted, so that rebalancing can be resumed.
+        """
+        shards = get_shards()
+        if not shards:
+            raise CommandError('Devices are not sharded: set the YUBIVAL_DEVICE_SHARDS setting.')
+
+        for source in sources:
+            if source not in connections.databases:
+                raise CommandError('Unknown database "%s".' % source)
+
+        counts = {'moved': 0, 'failed': 0}
+        for source in list(shards) + [source for source in sources if source not in shards]:
+            last_id = 0
+            while True:
+                devices = Device.objects.using(source).filter(id__gt=last_id).order_by('id')
+                rows = list(devices.values_list('id', 'public_id')[:batch_size])
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                misplaced = defaultdict(list)
+                for device_id, public_id in rows:
+                    target = device_database(public_id)
+                    if target != source:
+                        misplaced[target].append(device_id)
+                for target, device_ids in misplaced.items():
+                    self._move_devices(source, target, device_ids, dry_run, counts)
+
+        if dry_run:
+            self.stdout.write('%(moved)d devices would be moved, %(failed)d conflicting.' % counts)
+            return
+        style = self.style.SUCCESS if counts['failed'] == 0 else self.style.WARNING
+        self.stdout.write(style('Moved %(moved)d devices, %(failed)d failed.' % counts))
+
+    def _move_devices(self, source, target, device_ids, dry_run, counts):
+        """Moves devices of the `source` database to the `target` one"""
+        devices = list(Device.objects.using(source).filter(id__in=device_ids))
+        existing = {
+            public_id: (private_id, key)
+            for public_id, private_id, key in Device.objects.using(target).filter(
+                public_id__in=[device.public_id for device in devices],
+            ).values_list('public_id', 'private_id', 'key')
+        }
+
+        new_devices = []
+        moved_ids = []
+        for device in devices:
+            target_keys = existing.get(device.public_id)
+            if target_keys is None:
+                new_devices.append(device)
+            elif target_keys != (device.private_id, device.key):
+                counts['failed'] += 1
+                self.stdout.write(self.style.ERROR('Device %s of %s conflicts with another device of %s.' % (
+                    device, source, target,
+                )))
+                continue
+            moved_ids.append(device.id)
+        counts['moved'] += len(moved_ids)
+        if dry_run or not moved_ids:
+            return
+
+        counters = dict(
+            DeviceCounter.objects.using(source).filter(device_id__in=moved_ids).values_list('device_id', 'value'),
+        )
+
+        # Unlike `bulk_create`, raw inserts keep the creation dates. Shards assign new primary keys:
+        fields = [field for field in Device._meta.concrete_fields if not field.primary_key]
+        chunk_size = connections[target].ops.bulk_batch_size(fields, new_devices) or len(new_devices)
+        with transaction.atomic(using=target):
+            for start in range(0, len(new_devices), chunk_size):
+                Device.objects.using(target)._insert(
+                    new_devices[start:start + chunk_size], fields=fields, raw=True, using=target,
+                )
+            self._create_counters(target, {
+                device.public_id: counters.get(device.id, 0) for device in new_devices
+            })
+        with transaction.atomic(using=source):
+            # `QuerySet.delete` would send the `post_delete` signals that reset the counters of the devices:
+            DeviceCounter.objects.using(source).filter(device_id__in=moved_ids)._raw_delete(source)
+            Device.objects.using(source).filter(id__in=moved_ids)._raw_delete(source)
+
     def add_arguments(self, parser):
         subparsers = parser.add_subparsers(
             title='subcommands',
@@ -109,11 +386,80 @@ class Command(BaseCommand):
             help='AES key (16-byte hexadecimal such as "00112233445566778899aabbccddeeff")',
         )
 
-        subparsers.add_parser(
+        parser_import = subparsers.add_parser(
+            'import',
+            called_from_command_line=True,
+            description='Registers the already configured YubiKeys of a CSV file or YubiKey Manager log. CSV files '
+                        'have label, public_id, private_id and key columns, and an optional header line. Lines of '
+                        'devices that are already registered with the same IDs and key are skipped, so an interrupted '
+                        'import is resumed by running it again.',
+        )
+        parser_import.add_argument('file', type=str, help='path of the file to import, or "-" for standard input')
+        parser_import.add_argument(
+            '--format',
+            choices=IMPORT_FORMATS,
+            default='csv',
+            help='file format: CSV file or YubiKey Manager log (default: csv)',
+        )
+        parser_import.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='number of devices inserted per transaction (default: 1000)',
+        )
+        parser_import.add_argument(
+            '--label-prefix',
+            type=str,
+            default='yubikey-',
+            help='prefix of the labels of devices imported from a YubiKey Manager log, followed by their serial number '
+                 '(default: "yubikey-")',
+        )
+
+        parser_list = subparsers.add_parser(
             'list',
             called_from_command_line=True,
             description='Lists YubiKeys',
         )
+        add_export_arguments(parser_list)
+        parser_list_used = parser_list.add_mutually_exclusive_group()
+        parser_list_used.add_argument(
+            '--used',
+            action='store_const',
+            const=True,
+            help='only list YubiKeys that have been used to validate an OTP',
+        )
+        parser_list_used.add_argument(
+            '--unused',
+            action='store_const',
+            const=False,
+            dest='used',
+            help='only list YubiKeys that have never been used to validate an OTP',
+        )
+
+        parser_rebalance = subparsers.add_parser(
+            'rebalance',
+            called_from_command_line=True,
+            description='Moves the YubiKeys that are not stored in the shard of their public ID to that shard, after '
+                        'databases were added to or removed from the YUBIVAL_DEVICE_SHARDS setting',
+        )
+        parser_rebalance.add_argument(
+            '--source',
+            action='append',
+            default=[],
+            help='alias of a database that is no longer a shard, such as "default" when enabling sharding, whose '
+                 'YubiKeys are also moved (can be repeated)',
+        )
+        parser_rebalance.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='number of devices scanned per query (default: 1000)',
+        )
+        parser_rebalance.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='only count the YubiKeys to move',
+        )
 
         parser_delete = subparsers.add_parser(
             'delete',
@@ -132,7 +478,15 @@ class Command(BaseCommand):
             self._add(options['label'])
         elif subcommand == 'add-existing':
             self._add_existing(options['label'], options['public_id'], options['private_id'], options['key'])
+        elif subcommand == 'import':
+            if options['batch_size'] < 1:
+                raise CommandError('The batch size must be positive.')
+            self._import(options['file'], options['format'], options['batch_size'], options['label_prefix'])
+        elif subcommand == 'rebalance':
+            if options['batch_size'] < 1:
+                raise CommandError('The batch size must be positive.')
+            self._rebalance(options['source'], options['batch_size'], options['dry_run'])
         elif subcommand == 'delete':
             self._delete(options['public_id'])
         else:  # subcommand == 'list'
-            self._list()
+            self._list(options)
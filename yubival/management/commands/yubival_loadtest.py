@@ -0,0 +1,123 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.urls import reverse
+
+from yubival.loadtest import SyntheticClient, SyntheticYubiKey, InProcessTarget, HTTPTarget, run_load, percentile
+from yubival.models import APIKey, Device
+from yubival.sharding import device_databases
+
+
+def setup_django():
+    # Process pool initializer, needed when worker processes are spawned instead of forked.
+    if not apps.ready:
+        django.setup()
+
+
+class Command(BaseCommand):
+    help = 'Sends valid OTP verification requests to measure the validation server capacity'
+    requires_migrations_checks = True
+
+    def _get_devices(self, label_prefix, count):
+        """Returns `count` devices whose label starts with `label_prefix`, creating missing ones"""
+        devices = []
+        for using in device_databases():
+            matching = Device.objects.using(using).filter(label__startswith=label_prefix).select_related('counter')
+            matching = matching.order_by('id')
+            devices += matching[:count - len(devices)]
+        labels = {device.label for device in devices}
+        n = 0
+        while len(devices) < count:
+            label = '%s%d' % (label_prefix, n)
+            if label not in labels:
+                devices.append(Device.objects.create(label=label))
+            n += 1
+        return devices
+
+    def _get_target(self, url):
+        if url is not None:
+            return HTTPTarget(url)
+
+        host = next((h for h in settings.ALLOWED_HOSTS if not h.startswith('.') and h != '*'), 'localhost')
+        return InProcessTarget(reverse('verify'), host)
+
+    def _report(self, results, elapsed):
+        latencies = sorted(latency for _, latency in results)
+
+        self.stdout.write('Requests: %d in %.2f s (%.1f requests/s)' % (len(results), elapsed, len(results) / elapsed))
+        self.stdout.write('Latency: %s' % ', '.join(
+            '%s %.2f ms' % (name, 1000 * percentile(latencies, fraction))
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1))
+        ))
+        self.stdout.write('Statuses:')
+        for status, count in Counter(status for status, _ in results).most_common():
+            self.stdout.write('\t%s: %d' % (status, count))
+
+    def add_arguments(self, parser):
+        parser.add_argument('api_key', type=int, help='ID of the API key signing the requests')
+        parser.add_argument('--requests', type=int, default=1000, help='total number of requests (default: 1000)')
+        parser.add_argument('--workers', type=int, default=4, help='number of concurrent workers (default: 4)')
+        parser.add_argument(
+            '--processes', action='store_true',
+            help='run workers in separate processes instead of threads',
+        )
+        parser.add_argument(
+            '--devices', type=int,
+            help='number of YubiKeys generating OTPs, at least the number of workers (default: number of workers)',
+        )
+        parser.add_argument(
+            '--label-prefix', default='loadtest-',
+            help='label prefix of the YubiKeys generating OTPs; missing ones are created (default: "loadtest-")',
+        )
+        parser.add_argument(
+            '--url',
+            help='URL of the verify endpoint of a running server, such as "http://127.0.0.1:8000/wsapi/2.0/verify"; '
+                 'requests are handled in-process if not set',
+        )
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        device_count = options['devices'] or workers
+        if workers < 1 or options['requests'] < 1:
+            raise CommandError('The numbers of requests and workers must be positive.')
+        if device_count < workers:
+            raise CommandError('Each worker needs its own YubiKey: --devices must be at least --workers.')
+
+        try:
+            api_key = APIKey.objects.get(id=options['api_key'])
+        except APIKey.DoesNotExist:
+            raise CommandError('API key id=%d does not exist.' % options['api_key'])
+
+        devices = self._get_devices(options['label_prefix'], device_count)
+
+        # Each worker gets its own YubiKeys and nonces, so that concurrent requests never replay each other.
+        jobs = []
+        for i in range(workers):
+            client = SyntheticClient.from_api_key(api_key, nonce_prefix='%d-%d-%d-' % (os.getpid(), time.time(), i))
+            yubikeys = [SyntheticYubiKey.from_device(device) for device in devices[i::workers]]
+            requests = options['requests'] // workers + (i < options['requests'] % workers)
+            jobs.append((self._get_target(options['url']), client, yubikeys, requests))
+
+        if options['processes']:
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=setup_django)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+
+        self.stdout.write('Sending %d requests from %d workers with %d YubiKeys...' % (
+            options['requests'], workers, device_count,
+        ))
+        start = time.perf_counter()
+        with executor:
+            futures = [executor.submit(run_load, *job) for job in jobs]
+            results = [result for future in futures for result in future.result()]
+        elapsed = time.perf_counter() - start
+
+        self._report(results, elapsed)
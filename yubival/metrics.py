@@ -0,0 +1,390 @@
+import bisect
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from yubival.conf import get_setting
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# Upper bounds in seconds of the latency histogram buckets:
+DURATION_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Delay in seconds between two writes of the metrics of a process to the metrics directory:
+FLUSH_INTERVAL = 1.0
+
+# File of the metrics directory summing the values of the processes that exited, and files of the running processes:
+MERGED_FILENAME = 'metrics-merged.json'
+PROCESS_FILENAME_RE = re.compile(r'metrics-(\d+)\.json')
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+METRICS = {
+    'yubival_responses_total': (
+        COUNTER, 'Verification responses, by endpoint, status and API client.', ('endpoint', 'status', 'client'),
+    ),
+    'yubival_batch_otps_total': (
+        COUNTER, 'OTPs of batch verification requests, by status and API client.', ('status', 'client'),
+    ),
+    'yubival_sync_dropped_total': (
+        COUNTER, 'Synchronization requests dropped because too many were pending, by peer.', ('peer',),
+    ),
+    'yubival_request_duration_seconds': (
+        HISTOGRAM, 'Duration of verification requests, by endpoint.', ('endpoint',),
+    ),
+    'yubival_counter_update_duration_seconds': (
+        HISTOGRAM, 'Duration of the device counter updates, including database lock waits.', (),
+    ),
+    'yubival_decrypt_duration_seconds': (
+        HISTOGRAM, 'Duration of the OTP decryptions.', (),
+    ),
+}
+
+
+class Registry:
+    """Counters and histograms of a process
+
+    Updates only hold a lock for a dictionary update. When a metrics directory is configured, a background thread of
+    each process writes the values to a file of that directory every `FLUSH_INTERVAL` seconds, so that the values of
+    all worker processes can be aggregated without any file I/O in the request threads.
+
+    Like the multiprocess mode of prometheus_client, the files of the processes that exited are kept: they are merged
+    into a single file when a process starts and when the values are collected, before their PID can be reused.
+
+    Args:
+        directory: directory shared by the worker processes, or `None`.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher_pid = None
+        self._closed = threading.Event()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._start_flusher()
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        index = bisect.bisect_left(DURATION_BUCKETS, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, the last one being +Inf, followed by the sum of the values:
+                histogram = self._histograms[key] = [0] * (len(DURATION_BUCKETS) + 1) + [0.0]
+            histogram[index] += 1
+            histogram[-1] += value
+        self._start_flusher()
+
+    def snapshot(self):
+        with self._lock:
+            return make_snapshot(self._counters, self._histograms)
+
+    def _path(self):
+        return os.path.join(self.directory, 'metrics-%d.json' % os.getpid())
+
+    def _start_flusher(self):
+        """Starts the thread writing the values to the metrics directory, once in each process"""
+        if self.directory is None or self._flusher_pid == os.getpid() or self._closed.is_set():
+            return
+        with self._lock:
+            if self._flusher_pid != os.getpid():
+                # Threads do not survive a fork, and the lock may have been held by the flusher of the parent:
+                self._flush_lock = threading.Lock()
+                self._flusher_pid = os.getpid()
+                # A file with the PID of this process was written by a former process:
+                self.merge_exited_processes(own_pid=True)
+                threading.Thread(target=self._flush_periodically, name='yubival-metrics', daemon=True).start()
+
+    def _flush_periodically(self):
+        while not self._closed.wait(FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        """Writes the values of the process to the metrics directory
+
+        Errors are ignored, so that metrics never fail a request.
+
+        Returns:
+            flushed: whether the values were written.
+        """
+        with self._flush_lock:
+            try:
+                write_json(self._path(), self.snapshot())
+            except OSError:
+                return False
+        return True
+
+    def close(self):
+        """Stops the thread writing the values to the metrics directory"""
+        self._closed.set()
+
+    def merge_exited_processes(self, own_pid=False):
+        """Adds the values of the exited processes to the merged file of the metrics directory and removes their files
+
+        Files are merged under a lock of the directory so that concurrent merges do not count them twice. Errors are
+        ignored, and nothing is merged on platforms without `fcntl`.
+
+        Args:
+            own_pid: whether the file with the PID of this process is merged, which is only true when it starts.
+        """
+        if fcntl is None:
+            return
+        try:
+            with open(os.path.join(self.directory, 'metrics.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                exited_paths = []
+                for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+                    match = PROCESS_FILENAME_RE.fullmatch(os.path.basename(path))
+                    if match is None:
+                        continue
+                    pid = int(match.group(1))
+                    if own_pid if pid == os.getpid() else not is_process_alive(pid):
+                        exited_paths.append(path)
+                if not exited_paths:
+                    return
+
+                merged_path = os.path.join(self.directory, MERGED_FILENAME)
+                snapshot = make_snapshot(*merge_snapshots(read_snapshots([merged_path] + exited_paths)))
+                write_json(merged_path, snapshot)
+                for path in exited_paths:
+                    os.remove(path)
+        except OSError:
+            pass
+
+    def collect(self):
+        """Returns the values of all processes sharing the metrics directory, or of this process only"""
+        if self.directory is None:
+            return merge_snapshots([self.snapshot()])
+
+        self._start_flusher()
+        self.flush()
+        self.merge_exited_processes()
+        return merge_snapshots(read_snapshots(glob.glob(os.path.join(self.directory, 'metrics-*.json'))))
+
+
+def is_process_alive(pid):
+    if os.name != 'posix':
+        return True  # os.kill() would terminate the process
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Process of another user
+    return True
+
+
+def write_json(path, data):
+    """Writes `data` to a temporary file renamed to `path`, so that readers never see a partial file"""
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_snapshots(paths):
+    snapshots = []
+    for path in paths:
+        try:
+            with open(path) as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            pass  # File of a process that is being written or was removed
+    return snapshots
+
+
+def make_snapshot(counters, histograms):
+    """Returns the JSON-serializable form of `(counters, histograms)` dictionaries keyed by `(name, labels)`"""
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), list(h)] for (name, labels), h in histograms.items()],
+    }
+
+
+def merge_snapshots(snapshots):
+    """Sums registry snapshots into `(counters, histograms)` dictionaries keyed by `(name, labels)`"""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot['counters']:
+            key = (name, tuple(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot['histograms']:
+            key = (name, tuple(labels))
+            if key in histograms:
+                histograms[key] = [a + b for a, b in zip(histograms[key], values)]
+            else:
+                histograms[key] = values
+    return counters, histograms
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape_label_value(value)) for name, value in pairs)
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def prometheus_text(counters, histograms):
+    """Formats metric values in the Prometheus text exposition format"""
+    lines = []
+    for name, (metric_type, help_text, label_names) in METRICS.items():
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        if metric_type == COUNTER:
+            for (metric_name, labels), value in sorted(counters.items()):
+                if metric_name == name:
+                    lines.append('%s%s %s' % (name, format_labels(label_names, labels), format_number(value)))
+        else:
+            for (metric_name, labels), values in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ('+Inf',), values[:-1]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                        name, format_labels(label_names, labels, [('le', bound)]), cumulative,
+                    ))
+                lines.append('%s_sum%s %s' % (name, format_labels(label_names, labels), format_number(values[-1])))
+                lines.append('%s_count%s %d' % (name, format_labels(label_names, labels), cumulative))
+    return '\n'.join(lines) + '\n'
+
+
+class Timer:
+    """Context manager observing its duration in a histogram"""
+
+    __slots__ = ('registry', 'name', 'labels', 'start')
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.name, time.perf_counter() - self.start, self.labels)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def timer(registry, name, labels=()):
+    """Returns a context manager observing its duration in a histogram of `registry`, if not `None`"""
+    return NULL_TIMER if registry is None else Timer(registry, name, labels)
+
+
+class StageTimings:
+    """Durations of the successive stages of a request
+
+    Each call to `mark` ends the current stage, which started when the previous one ended.
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._start = self._last = time.perf_counter()
+
+    def mark(self, name):
+        now = time.perf_counter()
+        self.stages.append((name, now - self._last))
+        self._last = now
+
+    @property
+    def total(self):
+        return self._last - self._start
+
+    def server_timing(self):
+        """Returns the value of a `Server-Timing` header, with durations in milliseconds"""
+        return ', '.join(
+            '%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in self.stages + [('total', self.total)]
+        )
+
+
+class NullStageTimings:
+    __slots__ = ()
+
+    def mark(self, name):
+        pass
+
+
+NULL_STAGE_TIMINGS = NullStageTimings()
+
+
+def get_stage_timings():
+    """Returns a new `StageTimings` if the `YUBIVAL_STAGE_TIMING` setting is enabled, or `None`"""
+    if get_setting('YUBIVAL_STAGE_TIMING'):
+        return StageTimings()
+
+
+def report_stage_timings(request, response, timings):
+    """Adds stage timings to a response in a `Server-Timing` header and passes them to `YUBIVAL_STAGE_TIMING_HOOK`"""
+    response['Server-Timing'] = timings.server_timing()
+    hook = get_setting('YUBIVAL_STAGE_TIMING_HOOK')
+    if hook is not None:
+        if isinstance(hook, str):
+            hook = import_string(hook)
+        hook(request, timings.stages)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Returns the metrics registry of the process, or `None` if metrics are disabled"""
+    global _registry
+    if _registry is None:
+        if not get_setting('YUBIVAL_METRICS'):
+            return
+        with _registry_lock:
+            if _registry is None:
+                _registry = Registry(get_setting('YUBIVAL_METRICS_DIR'))
+    return _registry
+
+
+@receiver(setting_changed)
+def reset_registry(setting, **kwargs):
+    global _registry
+    if setting in ('YUBIVAL_METRICS', 'YUBIVAL_METRICS_DIR'):
+        with _registry_lock:
+            if _registry is not None:
+                _registry.close()
+            _registry = None
@@ -38,7 +38,7 @@ class Migration(migrations.Migration):
             field=models.CharField(max_length=64, null=True),
             preserve_default=False,
         ),
-        migrations.RunPython(set_apikey_labels, migrations.RunPython.noop),
+        migrations.RunPython(set_apikey_labels, migrations.RunPython.noop, hints={'model_name': 'apikey'}),
         migrations.AlterField(
             model_name='apikey',
             name='label',
@@ -59,7 +59,7 @@ class Migration(migrations.Migration):
             field=models.CharField(max_length=64, null=True),
             preserve_default=False,
         ),
-        migrations.RunPython(set_device_labels, migrations.RunPython.noop),
+        migrations.RunPython(set_device_labels, migrations.RunPython.noop, hints={'model_name': 'device'}),
         migrations.AlterField(
             model_name='device',
             name='label',
@@ -0,0 +1,59 @@
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Number of devices whose counters are copied at a time:
+COPY_BATCH_SIZE = 1000
+
+
+def copy_counters(apps, schema_editor):
+    Device = apps.get_model('yubival', 'Device')
+    DeviceCounter = apps.get_model('yubival', 'DeviceCounter')
+    using = schema_editor.connection.alias
+    rows = Device.objects.using(using).order_by('id').values_list('id', 'session_counter', 'usage_counter')
+    batch = []
+    for device_id, session_counter, usage_counter in rows.iterator(chunk_size=COPY_BATCH_SIZE):
+        batch.append(DeviceCounter(device_id=device_id, session_counter=session_counter, usage_counter=usage_counter))
+        if len(batch) >= COPY_BATCH_SIZE:
+            DeviceCounter.objects.using(using).bulk_create(batch)
+            batch = []
+    DeviceCounter.objects.using(using).bulk_create(batch)
+
+
+def restore_counters(apps, schema_editor):
+    Device = apps.get_model('yubival', 'Device')
+    DeviceCounter = apps.get_model('yubival', 'DeviceCounter')
+    using = schema_editor.connection.alias
+    for counter in DeviceCounter.objects.using(using).iterator(chunk_size=COPY_BATCH_SIZE):
+        Device.objects.using(using).filter(id=counter.device_id).update(
+            session_counter=counter.session_counter,
+            usage_counter=counter.usage_counter,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yubival', '0004_add_cache_generation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceCounter',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='yubival.device')),
+                ('session_counter', models.IntegerField(default=0, editable=False, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(32767)])),
+                ('usage_counter', models.IntegerField(default=0, editable=False, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(255)])),
+            ],
+        ),
+        migrations.RunPython(copy_counters, restore_counters, hints={'model_name': 'devicecounter'}),
+        migrations.RemoveField(
+            model_name='device',
+            name='session_counter',
+        ),
+        migrations.RemoveField(
+            model_name='device',
+            name='usage_counter',
+        ),
+    ]
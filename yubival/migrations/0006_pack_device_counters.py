@@ -0,0 +1,49 @@
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import F
+
+
+# Number of counters unpacked at a time when reverting the migration:
+UNPACK_BATCH_SIZE = 1000
+
+
+def pack_counters(apps, schema_editor):
+    DeviceCounter = apps.get_model('yubival', 'DeviceCounter')
+    DeviceCounter.objects.using(schema_editor.connection.alias).update(
+        value=F('session_counter') * 256 + F('usage_counter'),
+    )
+
+
+def unpack_counters(apps, schema_editor):
+    DeviceCounter = apps.get_model('yubival', 'DeviceCounter')
+    using = schema_editor.connection.alias
+    # Unpacked in Python, as the integer division differs between databases:
+    for counter in DeviceCounter.objects.using(using).iterator(chunk_size=UNPACK_BATCH_SIZE):
+        DeviceCounter.objects.using(using).filter(device_id=counter.device_id).update(
+            session_counter=counter.value >> 8,
+            usage_counter=counter.value & 255,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yubival', '0005_device_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicecounter',
+            name='value',
+            field=models.IntegerField(default=0, editable=False, validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(8388607)]),
+        ),
+        migrations.RunPython(pack_counters, unpack_counters, hints={'model_name': 'devicecounter'}),
+        migrations.RemoveField(
+            model_name='devicecounter',
+            name='session_counter',
+        ),
+        migrations.RemoveField(
+            model_name='devicecounter',
+            name='usage_counter',
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('yubival', '0006_pack_device_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='devicecounter',
+            name='request_digest',
+            field=models.CharField(blank=True, default='', editable=False, max_length=16),
+        ),
+    ]
@@ -12,6 +12,8 @@ API_KEY_BYTE_LENGTH = 20
 DEVICE_PUBLIC_ID_BYTE_LENGTH = 6
 DEVICE_PRIVATE_ID_BYTE_LENGTH = 6
 DEVICE_KEY_BYTE_LENGTH = 16
+# Number of bits of the usage counter, stored below the session counter in `DeviceCounter.value`:
+USAGE_COUNTER_BITS = 8
 
 
 def generate_api_key():
@@ -30,6 +32,16 @@ def generate_private_id():
     return secrets.token_hex(DEVICE_PRIVATE_ID_BYTE_LENGTH)
 
 
+def pack_counters(session_counter, usage_counter):
+    """Returns the integer ordering OTP counters like the `(session_counter, usage_counter)` tuple"""
+    return session_counter << USAGE_COUNTER_BITS | usage_counter
+
+
+def unpack_counters(value):
+    """Returns the `(session_counter, usage_counter)` tuple of a packed counter"""
+    return value >> USAGE_COUNTER_BITS, value & ((1 << USAGE_COUNTER_BITS) - 1)
+
+
 class APIKey(models.Model):
     label = models.CharField(
         max_length=64,
@@ -48,6 +60,14 @@ class APIKey(models.Model):
         return '%s (%d)' % (self.label, self.id)
 
 
+class DeviceQuerySet(models.QuerySet):
+    def create(self, **kwargs):
+        # Unlike `QuerySet.create`, lets the database routers select the database from the new device, like `save` does:
+        device = self.model(**kwargs)
+        device.save(force_insert=True, using=self._db)
+        return device
+
+
 class Device(models.Model):
     label = models.CharField(
         max_length=64,
@@ -68,19 +88,68 @@ class Device(models.Model):
         validators=[LengthValidator(2 * DEVICE_KEY_BYTE_LENGTH), validate_hex],
         default=generate_otp_key,
     )
-    session_counter = models.IntegerField(
-        validators=[MinValueValidator(0), MaxValueValidator(2**15 - 1)],
+    date_created = models.DateTimeField(
+        auto_now_add=True,
+    )
+
+    objects = DeviceQuerySet.as_manager()
+
+    def __str__(self):
+        return '%s (%s)' % (self.label, self.public_id)
+
+
+class DeviceCounter(models.Model):
+    """Counters of the last OTP accepted from a device
+
+    They are updated on every successful validation, so they are stored apart from the rarely changing device row, which
+    is then never rewritten nor locked by validations. Each device has a counter row, in the same database.
+
+    The session and usage counters are packed in a single integer, so that a more recent OTP has a greater `value` and
+    replay detection is a single comparison.
+    """
+
+    device = models.OneToOneField(
+        Device,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='counter',
+    )
+    value = models.IntegerField(
+        validators=[MinValueValidator(0), MaxValueValidator(pack_counters(2**15 - 1, 255))],
         default=0,
         editable=False,
     )
-    usage_counter = models.IntegerField(
-        validators=[MinValueValidator(0), MaxValueValidator(255)],
-        default=0,
+
+    # `request_digest` of the OTP and nonce of the request that validated the counters:
+    request_digest = models.CharField(
+        max_length=16,
+        blank=True,
+        default='',
         editable=False,
     )
-    date_created = models.DateTimeField(
-        auto_now_add=True,
+
+    @property
+    def session_counter(self):
+        return unpack_counters(self.value)[0]
+
+    @property
+    def usage_counter(self):
+        return unpack_counters(self.value)[1]
+
+    def __str__(self):
+        return '%d (%d, %d)' % (self.device_id, self.session_counter, self.usage_counter)
+
+
+class CacheGeneration(models.Model):
+    """Counter incremented on every change of a cached table, used to invalidate the caches of all processes"""
+
+    name = models.CharField(
+        max_length=32,
+        unique=True,
+    )
+    value = models.BigIntegerField(
+        default=0,
     )
 
     def __str__(self):
-        return '%s (%s)' % (self.label, self.public_id)
+        return '%s (%d)' % (self.name, self.value)
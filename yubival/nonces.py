@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import deque
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from yubival.conf import get_setting
+
+
+# Number of sets the nonce window is split into. Sets are dropped one at a time as they expire.
+NONCE_INDEX_BUCKETS = 4
+
+
+class NonceIndex:
+    """Remembers the (client, nonce) pairs of recent requests to detect replayed requests
+
+    Pairs are hashed and stored in a rotating list of sets, each covering a fraction of the time window. A pair is
+    remembered for at least `(buckets - 1) / buckets * window` seconds and at most `window` seconds. When the index
+    holds `max_entries` pairs, its oldest set is dropped early.
+
+    Args:
+        window: duration in seconds during which pairs are remembered.
+        max_entries: maximum number of pairs remembered.
+        buckets: number of sets the window is split into.
+    """
+
+    def __init__(self, window, max_entries, buckets=NONCE_INDEX_BUCKETS):
+        self.window = window
+        self.max_entries = max_entries
+        self.bucket_duration = window / buckets
+        self.buckets = buckets
+        self._sets = deque([set()])
+        self._size = 0
+        self._current_start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _drop_oldest(self):
+        self._size -= len(self._sets.popleft())
+        if not self._sets:
+            self._sets.append(set())
+
+    def _rotate(self, now):
+        if now - self._current_start >= self.window:
+            self._sets = deque([set()])
+            self._size = 0
+            self._current_start = now
+            return
+
+        while now - self._current_start >= self.bucket_duration:
+            self._sets.append(set())
+            self._current_start += self.bucket_duration
+            if len(self._sets) > self.buckets:
+                self._drop_oldest()
+
+    def add(self, client_id, nonce):
+        """Records a (client, nonce) pair
+
+        Returns:
+            added: `False` if the pair was already recorded within the window.
+        """
+        pair_hash = hash((client_id, nonce))
+        with self._lock:
+            self._rotate(time.monotonic())
+            if any(pair_hash in s for s in self._sets):
+                return False
+            while self._size >= self.max_entries and self._size > 0:
+                self._drop_oldest()
+            self._sets[-1].add(pair_hash)
+            self._size += 1
+            return True
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_nonce_index():
+    """Returns the nonce index of the process, or `None` if replayed request detection is disabled"""
+    global _index
+    if _index is None:
+        window = get_setting('YUBIVAL_NONCE_WINDOW')
+        if window <= 0:
+            return
+        with _index_lock:
+            if _index is None:
+                _index = NonceIndex(window, get_setting('YUBIVAL_NONCE_MAX_ENTRIES'))
+    return _index
+
+
+def is_nonce_replayed(client_id, nonce):
+    """Records a (client, nonce) pair and returns whether it was already seen recently"""
+    index = get_nonce_index()
+    return index is not None and not index.add(client_id, nonce)
+
+
+@receiver(setting_changed)
+def reset_nonce_index(setting, **kwargs):
+    global _index
+    if setting in ('YUBIVAL_NONCE_WINDOW', 'YUBIVAL_NONCE_MAX_ENTRIES'):
+        with _index_lock:
+            _index = None
@@ -0,0 +1,102 @@
+import re
+from urllib.parse import quote_plus, unquote
+
+from django.conf import settings
+from django.core.exceptions import TooManyFieldsSent
+from django.utils.datastructures import MultiValueDictKeyError
+
+
+# Characters that `quote_plus` leaves unchanged; names and values made of them are already in their canonical form. `~`
+# is left out since Python < 3.7 quotes it:
+CANONICAL_RE = re.compile(r'[A-Za-z0-9_.-]*')
+
+
+def unquote_plus(text, encoding):
+    # Same decoding as `urllib.parse.parse_qsl`, used by `QueryDict`:
+    return unquote(text.replace('+', ' '), encoding=encoding, errors='replace')
+
+
+class SignedQuery:
+    """Parameters of a signed request, parsed from its raw query string in a single pass
+
+    While splitting the query string, the parser detects duplicate parameters, extracts the `h` signature and builds the
+    string covered by the signature. That string is the same as `ordered_parameters_string(query_dict, escape=True)`
+    without `h`, but names and values that are already URL-encoded canonically are reused as they were sent.
+
+    Provides the subset of the `QueryDict` interface used by the verification functions.
+    """
+
+    __slots__ = ('_lists', 'has_duplicates', 'signature', 'signed_text')
+
+    def __init__(self, query_string, encoding='utf-8'):
+        lists = {}
+        signed_pairs = []
+        has_duplicates = False
+        max_fields = settings.DATA_UPLOAD_MAX_NUMBER_FIELDS
+        if max_fields is not None and query_string.count('&') + 1 > max_fields:
+            raise TooManyFieldsSent(
+                'The number of GET/POST parameters exceeded settings.DATA_UPLOAD_MAX_NUMBER_FIELDS.'
+            )
+
+        for raw_pair in query_string.split('&'):
+            if not raw_pair:
+                continue
+            raw_name, _, raw_value = raw_pair.partition('=')
+            if CANONICAL_RE.fullmatch(raw_name):
+                name = canonical_name = raw_name
+            else:
+                name = unquote_plus(raw_name, encoding)
+                canonical_name = quote_plus(name)
+            if CANONICAL_RE.fullmatch(raw_value):
+                value = canonical_value = raw_value
+            else:
+                value = unquote_plus(raw_value, encoding)
+                canonical_value = None  # Only computed for signed parameters
+
+            values = lists.get(name)
+            if values is None:
+                lists[name] = [value]
+            else:
+                values.append(value)
+                has_duplicates = True
+
+            if name != 'h':
+                if canonical_value is None:
+                    canonical_value = quote_plus(value)
+                signed_pairs.append((name, canonical_name, canonical_value))
+
+        self._lists = lists
+        self.has_duplicates = has_duplicates
+        signatures = lists.get('h')
+        self.signature = signatures[0] if signatures is not None else None
+        signed_pairs.sort()
+        self.signed_text = '&'.join('%s=%s' % (name, value) for _, name, value in signed_pairs)
+
+    @classmethod
+    def from_request(cls, request):
+        """Returns the parsed query string of a request, or `None` if it is not ASCII
+
+        Servers pass non-ASCII query strings with various encodings, which `request.GET` takes care of.
+        """
+        query_string = request.META.get('QUERY_STRING', '')
+        try:
+            query_string.encode('ascii')  # `str.isascii` requires Python 3.7
+        except UnicodeEncodeError:
+            return
+        return cls(query_string, request.encoding or settings.DEFAULT_CHARSET)
+
+    def __contains__(self, name):
+        return name in self._lists
+
+    def __getitem__(self, name):
+        try:
+            return self._lists[name][-1]
+        except KeyError:
+            raise MultiValueDictKeyError(name)
+
+    def get(self, name, default=None):
+        values = self._lists.get(name)
+        return values[-1] if values is not None else default
+
+    def getlist(self, name):
+        return list(self._lists.get(name, ()))
@@ -0,0 +1,34 @@
+import random
+
+from django.db import router
+
+from yubival.conf import get_setting
+
+
+def replica_database(model, using=None):
+    """Returns the alias of a random read replica of `using`, or of the database of `model` if `using` is `None`
+
+    Returns `None` if the database has no replica in the `YUBIVAL_READ_REPLICAS` setting.
+    """
+    replicas = get_setting('YUBIVAL_READ_REPLICAS')
+    if not replicas:
+        return
+    aliases = replicas.get(using or router.db_for_write(model))
+    if not aliases:
+        return
+    return random.choice(aliases)
+
+
+def read_replica_first(model, using, read, primary=False):
+    """Returns `read(alias)` for a read replica of `using`, or for `using` itself if the replica returned `None`
+
+    Rows that were just created on the primary database may not be replicated yet: looking them up again on the primary
+    database avoids rejecting new API keys and devices because of replication lag. With `primary`, the replica is
+    skipped, for instance when the rows were just changed.
+    """
+    replica = None if primary else replica_database(model, using)
+    if replica is not None:
+        result = read(replica)
+        if result is not None:
+            return result
+    return read(using)
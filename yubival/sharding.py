@@ -0,0 +1,117 @@
+import bisect
+import contextlib
+import functools
+import hashlib
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from yubival.conf import get_setting
+
+
+# Models stored in the shard of their device:
+DEVICE_MODELS = frozenset(['yubival.device', 'yubival.devicecounter'])
+
+# Number of points of each shard on the hash ring. More points spread devices more evenly between shards:
+RING_POINTS_PER_SHARD = 128
+
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of device public IDs to database aliases
+
+    Each shard is placed at `RING_POINTS_PER_SHARD` pseudo-random points of a ring, and a public ID belongs to the shard
+    of the first point following its hash. Adding a shard only moves the devices of the ring segments it takes over,
+    about one device out of the new number of shards.
+    """
+
+    def __init__(self, shards):
+        points = sorted(
+            (ring_hash('%s-%d' % (shard, i)), shard)
+            for shard in shards
+            for i in range(RING_POINTS_PER_SHARD)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard(self, public_id):
+        index = bisect.bisect(self._hashes, ring_hash(public_id))
+        return self._shards[index % len(self._shards)]
+
+
+@functools.lru_cache(maxsize=4)
+def get_hash_ring(shards):
+    return HashRing(shards)
+
+
+def get_shards():
+    """Returns the database aliases of the `YUBIVAL_DEVICE_SHARDS` setting, which is empty if sharding is disabled"""
+    return tuple(get_setting('YUBIVAL_DEVICE_SHARDS'))
+
+
+def device_database(public_id):
+    """Returns the alias of the database storing a device, or `None` to let the routers select it without sharding"""
+    shards = get_shards()
+    if not shards:
+        return
+    return get_hash_ring(shards).shard(public_id)
+
+
+def device_databases():
+    """Returns the aliases of all databases storing devices, which is `[None]` without sharding"""
+    return list(get_shards()) or [None]
+
+
+def group_by_database(public_ids):
+    """Returns a dictionary of the public IDs stored by each database alias"""
+    groups = defaultdict(list)
+    for public_id in public_ids:
+        groups[device_database(public_id)].append(public_id)
+    return groups
+
+
+def atomic_devices(public_ids):
+    """Returns a context manager running a transaction in each database storing one of the devices"""
+    stack = contextlib.ExitStack()
+    for using in sorted(group_by_database(public_ids), key=lambda using: using or ''):
+        stack.enter_context(transaction.atomic(using=using))
+    return stack
+
+
+class DeviceShardRouter:
+    """Database router storing each device in the shard of its public ID
+
+    Add it to the `DATABASE_ROUTERS` setting along with `YUBIVAL_DEVICE_SHARDS`. Shards other than the default database
+    only hold the `Device` and `DeviceCounter` tables. Devices that are already stored, and may be misplaced until they
+    are rebalanced, are saved to the database they were loaded from, and counters to the database of their device.
+
+    Migrations are routed by model name: the data migrations of this app pass the name of the model they change in
+    their `hints`.
+    """
+
+    def _is_device(self, model):
+        return model._meta.label_lower in DEVICE_MODELS
+
+    def db_for_write(self, model, **hints):
+        if not self._is_device(model):
+            return
+        instance = hints.get('instance')
+        if instance is None or instance._state.db is not None:
+            return
+        if instance._meta.label_lower == 'yubival.devicecounter':
+            instance = instance.device
+            if instance._state.db is not None:
+                return instance._state.db
+        return device_database(instance.public_id)
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        shards = get_shards()
+        if not shards:
+            return
+        if '%s.%s' % (app_label, model_name) in DEVICE_MODELS:
+            return db in shards
+        if db in shards and db != DEFAULT_DB_ALIAS:
+            return False
@@ -0,0 +1,78 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from yubival.bloom import public_id_filter
+from yubival.cache import API_KEY_CACHE_GENERATION, DEVICE_CACHE_GENERATION, PUBLIC_ID_FILTER_GENERATION, \
+    api_key_cache, device_cache, bump_cache_generation
+from yubival.counters import get_counter_store
+from yubival.models import APIKey, Device, DeviceCounter
+
+
+@receiver([post_save, post_delete], sender=APIKey, dispatch_uid='yubival_invalidate_api_key')
+def invalidate_api_key(sender, instance, **kwargs):
+    api_key_cache.invalidate(instance.id)
+    # A concurrent request may reload the old key before the transaction commits:
+    transaction.on_commit(lambda: api_key_cache.invalidate(instance.id))
+    bump_cache_generation(API_KEY_CACHE_GENERATION)
+
+
+@receiver(post_save, sender=Device, dispatch_uid='yubival_create_device_counter')
+def create_device_counter(sender, instance, created, raw, using, **kwargs):
+    # Fixtures hold the counters of their devices:
+    if created and not raw:
+        DeviceCounter.objects.using(using).create(device=instance)
+
+
+@receiver(post_save, sender=Device, dispatch_uid='yubival_reset_created_device_counters')
+def reset_created_device_counters(sender, instance, created, **kwargs):
+    if created:
+        get_counter_store().reset(instance.public_id)
+
+
+@receiver(post_delete, sender=Device, dispatch_uid='yubival_reset_deleted_device_counters')
+def reset_deleted_device_counters(sender, instance, **kwargs):
+    get_counter_store().reset(instance.public_id)
+
+
+@receiver([post_save, post_delete], sender=Device, dispatch_uid='yubival_invalidate_device')
+def invalidate_device(sender, instance, created=False, **kwargs):
+    device_cache.invalidate(instance.public_id)
+    transaction.on_commit(lambda: device_cache.invalidate(instance.public_id))
+    # Other processes only cache existing devices, which a created device does not change:
+    if not created:
+        bump_cache_generation(DEVICE_CACHE_GENERATION)
+
+
+@receiver(post_save, sender=Device, dispatch_uid='yubival_add_device_public_id')
+def add_device_public_id(sender, instance, **kwargs):
+    bump_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+    public_id_filter.add_many([instance.public_id])
+
+
+def api_keys_deleted_in_bulk(key_ids):
+    """Invalidates the cache like `invalidate_api_key` for API keys deleted without sending signals"""
+    for key_id in key_ids:
+        api_key_cache.invalidate(key_id)
+    transaction.on_commit(lambda: [api_key_cache.invalidate(key_id) for key_id in key_ids])
+    bump_cache_generation(API_KEY_CACHE_GENERATION)
+
+
+def devices_deleted_in_bulk(public_ids):
+    """Resets counters and invalidates the cache like the receivers above for devices deleted without sending signals"""
+    get_counter_store().reset_many(public_ids)
+    for public_id in public_ids:
+        device_cache.invalidate(public_id)
+    transaction.on_commit(lambda: [device_cache.invalidate(public_id) for public_id in public_ids])
+    bump_cache_generation(DEVICE_CACHE_GENERATION)
+    public_id_filter.refresh()
+
+
+def devices_created_in_bulk(public_ids):
+    """Resets counters and updates the public ID filter like the receivers above for devices created without signals
+
+    The counter rows of the devices must be created by the caller.
+    """
+    get_counter_store().reset_many(public_ids)
+    bump_cache_generation(PUBLIC_ID_FILTER_GENERATION)
+    public_id_filter.add_many(public_ids)
@@ -0,0 +1,217 @@
+import base64
+import concurrent.futures
+import math
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from yubival.conf import get_setting
+from yubival.metrics import get_registry
+
+
+# Synchronization levels of the `sl=fast` and `sl=secure` request parameters, as in the reference validation server:
+SYNC_LEVELS = {
+    'fast': 1,
+    'secure': 40,
+}
+
+# Maximum value of the `timeout` request parameter, in seconds:
+MAX_SYNC_TIMEOUT = 60
+
+SYNC_OK = 'OK'
+SYNC_REPLAYED_OTP = 'REPLAYED_OTP'
+SYNC_NOT_ENOUGH_ANSWERS = 'NOT_ENOUGH_ANSWERS'
+
+
+def parse_sync_level(value):
+    """Returns the percentage of peers that must confirm an OTP for a `sl` request parameter, or the default one
+
+    Raises:
+        ValueError: the parameter is invalid.
+    """
+    if value is None:
+        return get_setting('YUBIVAL_SYNC_DEFAULT_LEVEL')
+    if value in SYNC_LEVELS:
+        return SYNC_LEVELS[value]
+    level = int(value)
+    if not 0 <= level <= 100:
+        raise ValueError
+    return level
+
+
+def parse_sync_timeout(value):
+    """Returns the synchronization timeout in seconds for a `timeout` request parameter, or the default one
+
+    Raises:
+        ValueError: the parameter is invalid.
+    """
+    if value is None:
+        return get_setting('YUBIVAL_SYNC_DEFAULT_TIMEOUT')
+    timeout = int(value)
+    if not 0 < timeout <= MAX_SYNC_TIMEOUT:
+        raise ValueError
+    return timeout
+
+
+def http_get(url, query, timeout):
+    separator = '&' if urllib.parse.urlsplit(url).query else '?'
+    with urllib.request.urlopen('%s%s%s' % (url, separator, query), timeout=timeout) as response:
+        return response.read().decode('utf-8')
+
+
+class SyncResult:
+    """Outcome of the synchronization of an accepted OTP with the peers
+
+    Attributes:
+        status: `SYNC_OK`, `SYNC_REPLAYED_OTP` if a peer had accepted the OTP or a more recent one for another request,
+            or `SYNC_NOT_ENOUGH_ANSWERS` if too few peers confirmed the OTP before the timeout.
+        level: percentage of peers that confirmed the OTP, returned in the `sl` response parameter.
+    """
+
+    __slots__ = ('status', 'level')
+
+    def __init__(self, status, level):
+        self.status = status
+        self.level = level
+
+
+class SyncPool:
+    """Validation servers sharing the same devices, which exchange the counters of the OTPs they accept
+
+    After a server accepts an OTP, it sends its counters to all peers, along with the OTP and nonce of the request.
+    Each peer stores them if they are more recent than its own counters, and answers whether it had already seen them.
+    The OTP is replayed if any peer had already accepted it, or a more recent one, for another request. A peer which
+    accepted the same OTP and nonce confirms it, since the client sent the same request to several servers at once.
+
+    Requests to the peers keep running in the background after the client got its response, so that all peers
+    eventually receive all counters while clients only wait for the answers they asked for. When peers are too slow
+    and `max_pending` requests are already queued or running, new requests are dropped and counted in the
+    `yubival_sync_dropped_total` metric instead of queuing without bound.
+
+    Args:
+        peers: URLs of the `wsapi/2.0/sync` endpoint of the other servers.
+        key: secret key shared by all servers, used to sign synchronization requests and responses.
+        threads: maximum number of concurrent requests to the peers.
+        transport: function called with a peer URL, a query string and a timeout, returning the response text.
+        max_pending: maximum number of queued and running requests to the peers.
+    """
+
+    def __init__(self, peers, key, threads=16, transport=http_get, max_pending=1000):
+        self.peers = list(peers)
+        self.key = key
+        self.transport = transport
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='yubival-sync')
+        self._pending = threading.BoundedSemaphore(max_pending)
+
+    def start(self, send):
+        """Calls `send(peer)` for each peer in the background and returns the futures of the answer statuses
+
+        Requests dropped because too many are pending have no future, so they count as unanswered.
+        """
+        futures = []
+        for peer in self.peers:
+            if not self._pending.acquire(blocking=False):
+                registry = get_registry()
+                if registry is not None:
+                    registry.inc('yubival_sync_dropped_total', (peer,))
+                continue
+            futures.append(self._executor.submit(self._send, send, peer))
+        return futures
+
+    def _send(self, send, peer):
+        try:
+            return send(peer)
+        finally:
+            self._pending.release()
+
+    def wait(self, futures, level, timeout):
+        """Waits until enough peers confirmed an OTP, one of them reports a replay, or `timeout` seconds elapse
+
+        Args:
+            futures: futures returned by `start`.
+            level: percentage of the peers that must confirm the OTP.
+            timeout: maximum waiting time in seconds.
+
+        Returns:
+            result: `SyncResult`.
+        """
+        required = math.ceil(len(self.peers) * level / 100)
+        deadline = time.monotonic() + timeout
+        confirmed = 0
+        pending = set(futures)
+        while pending and confirmed < required:
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=max(deadline - time.monotonic(), 0),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                break
+            for future in done:
+                try:
+                    status = future.result()
+                except Exception:
+                    continue  # Unreachable peer or invalid answer
+                if status == SYNC_REPLAYED_OTP:
+                    return SyncResult(SYNC_REPLAYED_OTP, self._level(confirmed))
+                if status == SYNC_OK:
+                    confirmed += 1
+
+        if confirmed < required:
+            return SyncResult(SYNC_NOT_ENOUGH_ANSWERS, self._level(confirmed))
+        return SyncResult(SYNC_OK, self._level(confirmed))
+
+    def _level(self, confirmed):
+        return 100 * confirmed // len(self.peers)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def get_sync_key():
+    """Returns the decoded `YUBIVAL_SYNC_KEY` setting, or `None` if synchronization is disabled"""
+    key = get_setting('YUBIVAL_SYNC_KEY')
+    if key is None:
+        return
+    return base64.b64decode(key)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_sync_pool():
+    """Returns the pool of the `YUBIVAL_SYNC_PEERS` setting, or `None` if there are no peers"""
+    global _pool
+    if _pool is None:
+        peers = get_setting('YUBIVAL_SYNC_PEERS')
+        if not peers:
+            return
+        with _pool_lock:
+            if _pool is None:
+                key = get_sync_key()
+                if key is None:
+                    raise ImproperlyConfigured('YUBIVAL_SYNC_PEERS requires YUBIVAL_SYNC_KEY.')
+                _pool = SyncPool(
+                    peers,
+                    key,
+                    get_setting('YUBIVAL_SYNC_THREADS'),
+                    max_pending=get_setting('YUBIVAL_SYNC_MAX_PENDING'),
+                )
+    return _pool
+
+
+@receiver(setting_changed)
+def reset_sync_pool(setting, **kwargs):
+    global _pool
+    if setting in ('YUBIVAL_SYNC_PEERS', 'YUBIVAL_SYNC_KEY', 'YUBIVAL_SYNC_THREADS', 'YUBIVAL_SYNC_MAX_PENDING'):
+        with _pool_lock:
+            if _pool is not None:
+                _pool.close()
+            _pool = None
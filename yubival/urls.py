@@ -1,7 +1,22 @@
 from django.urls import path
 
 from yubival import views
+from yubival.conf import get_setting
+
+if get_setting('YUBIVAL_ASYNC_VERIFY_VIEW'):
+    verify_view = views.AsyncVerifyView
+    batch_verify_view = views.AsyncBatchVerifyView
+else:
+    verify_view = views.VerifyView
+    batch_verify_view = views.BatchVerifyView
 
 urlpatterns = [
-    path('wsapi/2.0/verify', views.VerifyView.as_view(), name='verify'),
+    path('wsapi/2.0/verify', verify_view.as_view(), name='verify'),
+    path('wsapi/2.0/verify_batch', batch_verify_view.as_view(), name='verify_batch'),
 ]
+
+if get_setting('YUBIVAL_SYNC_KEY') is not None:
+    urlpatterns.append(path('wsapi/2.0/sync', views.SyncView.as_view(), name='sync'))
+
+if get_setting('YUBIVAL_METRICS'):
+    urlpatterns.append(path('metrics', views.metrics_view, name='metrics'))
@@ -1,18 +1,51 @@
+import asyncio
 import base64
 import datetime
 import hashlib
 import hmac
-from binascii import hexlify
-from collections import OrderedDict
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
-from django.db import transaction
-from django.http import HttpResponse
+import django
+from django.db import close_old_connections
+from django.http import Http404, HttpResponse, QueryDict
+from django.utils.decorators import method_decorator
 from django.utils.http import urlencode
 from django.views import View
-from yubiotp.otp import decode_otp
-
-from yubival.models import APIKey, Device
+from django.views.decorators.csrf import csrf_exempt
+from Crypto.Cipher import AES
+from yubiotp.modhex import unmodhex
+from yubiotp.otp import OTP
+
+from yubival.bloom import public_id_filter
+from yubival.cache import api_key_cache, device_cache
+from yubival.conf import get_setting
+from yubival.counters import get_counter_store, request_digest
+from yubival.metrics import NULL_STAGE_TIMINGS, get_registry, get_stage_timings, prometheus_text, \
+    report_stage_timings, timer
+from yubival.models import APIKey, Device, DEVICE_PUBLIC_ID_BYTE_LENGTH
+from yubival.nonces import is_nonce_replayed
+from yubival.query import SignedQuery
+from yubival.replicas import read_replica_first, replica_database
+from yubival.sharding import atomic_devices, device_database, group_by_database
+from yubival.sync import SYNC_NOT_ENOUGH_ANSWERS, SYNC_REPLAYED_OTP, get_sync_key, get_sync_pool, \
+    parse_sync_level, parse_sync_timeout
+
+try:
+    from asgiref.sync import markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    markcoroutinefunction = None
+
+
+# Modhex OTPs made of a device public ID and 16 encrypted bytes:
+OTP_RE = re.compile(r'[cbdefghijklnrtuv]{%d}' % (2 * DEVICE_PUBLIC_ID_BYTE_LENGTH + 32))
+
+# Number of times the counters of a device are re-read when they change during a batch verification:
+BATCH_UPDATE_ATTEMPTS = 3
 
 
 class ValidationStatus(Enum):
@@ -59,21 +92,44 @@ def response_signature(text, api_key):
     return hmac_sign_string(text, api_key)
 
 
-def response_parameters_to_text(response_params):
-    return ''.join(
-        '%s=%s\r\n' % (k, v) for k, v in response_params.items()
-    )
+def is_response_signature_valid(params, key):
+    """Checks the `h` signature of parsed response parameters"""
+    params = dict(params)
+    signature = params.pop('h', None)
+    if signature is None:
+        return False
+    text = '&'.join('%s=%s' % (k, v) for k, v in sorted(params.items()))
+    return hmac_verify_string(text, signature, key)
+
+
+class VerificationResponse(dict):
+    """Parameters of a verification response
+
+    The wire text and the string signed by `h` are both built from the parameters, instead of parsing the rendered
+    text back to sort it.
+    """
+
+    def render(self, key=None):
+        """Returns the text of the response, signed with `key` unless it is `None`"""
+        items = [(name, str(value)) for name, value in self.items()]
+        text = ''.join('%s=%s\r\n' % item for item in items)
+        if key is None:
+            return text
+
+        # Clients strip the lines of the response before checking its signature, like `parse_response`:
+        signed_text = '&'.join('%s=%s' % (name, value.rstrip()) for name, value in sorted(items))
+        return 'h=%s\r\n%s' % (hmac_sign_string(signed_text, key), text)
+
+    def http_response(self, key=None):
+        return HttpResponse(self.render(key), content_type='text/plain')
 
 
 def http_text_response(response_params):
-    return HttpResponse(response_parameters_to_text(response_params), content_type='text/plain')
+    return VerificationResponse(response_params).http_response()
 
 
 def signed_http_text_response(response_params, api_key):
-    text = response_parameters_to_text(response_params)
-    signature = response_signature(text, api_key)
-    text = 'h=%s\r\n%s' % (signature, text)
-    return HttpResponse(text, content_type='text/plain')
+    return VerificationResponse(response_params).http_response(api_key)
 
 
 def get_api_key_or_none(str_id):
@@ -82,15 +138,130 @@ def get_api_key_or_none(str_id):
     except ValueError:
         return
 
+    return read_replica_first(
+        APIKey,
+        None,
+        lambda using: APIKey.objects.using(using).filter(id=key_id).first(),
+        primary=api_key_cache.recently_changed(),
+    )
+
+
+class SigningKey:
+    """API key with a precomputed HMAC-SHA1 state
+
+    The HMAC inner and outer pads are computed once per key; signing a message only copies that state.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self._hmac = hmac.new(key, digestmod=hashlib.sha1)
+
+    def sign(self, text):
+        hashed = self._hmac.copy()
+        hashed.update(text.encode('utf-8'))
+        return base64.b64encode(hashed.digest()).decode('utf-8')
+
+
+class DeviceKeyMaterial:
+    """Decoded device secrets with a prepared AES decryptor"""
+
+    __slots__ = ('private_id_hex', 'key_hex', 'private_id', 'key', '_cipher')
+
+    def __init__(self, private_id, key):
+        self.private_id_hex = private_id
+        self.key_hex = key
+        self.private_id = bytes.fromhex(private_id)
+        self.key = bytes.fromhex(key)
+        self._cipher = AES.new(self.key, AES.MODE_ECB)
+
+    def decode_otp(self, token):
+        """Decrypts a modhex-encoded token like `yubiotp.otp.decode_otp` and returns the `OTP` structure"""
+        return OTP.unpack(self._cipher.decrypt(unmodhex(token[-32:])))
+
+
+def load_device_key_material(public_id):
+    if public_id_filter.excludes(public_id):
+        return
+    row = read_replica_first(
+        Device,
+        device_database(public_id),
+        lambda using: Device.objects.using(using).filter(public_id=public_id).values_list('private_id', 'key').first(),
+        primary=device_cache.recently_changed(),
+    )
+    if row is None:
+        return
+    return DeviceKeyMaterial(*row)
+
+
+def get_device_key_material_or_none(public_id):
+    """Returns the key material of a device from the in-process cache, or `None` if the device does not exist"""
+    return device_cache.get_or_load(public_id, load_device_key_material)
+
+
+def get_devices_key_material(public_ids):
+    """Returns a dictionary of the key material of existing devices, loading cache misses with a single query"""
+    key_materials = {}
+    missing = []
+    for public_id in set(public_ids):
+        key_material = device_cache.get(public_id)
+        if key_material is not None:
+            key_materials[public_id] = key_material
+        elif not public_id_filter.excludes(public_id):
+            missing.append(public_id)
+
+    primary = device_cache.recently_changed()
+    for using, group in group_by_database(missing).items():
+        replica = None if primary else replica_database(Device, using)
+        if replica is not None:
+            load_devices_key_material(replica, group, key_materials)
+            # Devices that are not replicated yet:
+            group = [public_id for public_id in group if public_id not in key_materials]
+        if group:
+            load_devices_key_material(using, group, key_materials)
+
+    return key_materials
+
+
+def load_devices_key_material(using, public_ids, key_materials):
+    """Loads the key material of devices of a database into the cache and the `key_materials` dictionary"""
+    rows = Device.objects.using(using).filter(public_id__in=public_ids).values_list('public_id', 'private_id', 'key')
+    for public_id, private_id, key in rows:
+        key_material = DeviceKeyMaterial(private_id, key)
+        device_cache.set(public_id, key_material)
+        key_materials[public_id] = key_material
+
+
+def device_filter(public_id, key_material):
+    """Selects a device only if it still has the given key material, in the primary database"""
+    return Device.objects.using(device_database(public_id)).filter(
+        public_id=public_id,
+        private_id=key_material.private_id_hex,
+        key=key_material.key_hex,
+    )
+
+
+def load_signing_key(key_id):
+    api_key = get_api_key_or_none(key_id)
+    if api_key is None:
+        return
+    return SigningKey(base64.b64decode(api_key.key))
+
+
+def get_signing_key_or_none(str_id):
+    """Returns the client signing key from the in-process cache, or `None` if the client does not exist"""
     try:
-        return APIKey.objects.get(id=key_id)
-    except APIKey.DoesNotExist:
+        key_id = int(str_id)
+    except ValueError:
         return
 
+    return api_key_cache.get_or_load(key_id, load_signing_key)
+
 
 def hmac_sign_string(text, key):
-    hashed = hmac.new(key, text.encode('utf-8'), hashlib.sha1)
-    return base64.encodebytes(hashed.digest()).decode('utf-8')[:-1]
+    """Signs `text` with `key`, either raw key bytes or a `SigningKey`"""
+    if not isinstance(key, SigningKey):
+        key = SigningKey(key)
+    return key.sign(text)
 
 
 def ordered_parameters_string(query_dict, escape):
@@ -113,6 +284,11 @@ def hmac_verify_string(text, signature, key):
 
 
 def is_request_signature_valid(query_dict, api_key):
+    if isinstance(query_dict, SignedQuery):
+        if query_dict.has_duplicates or query_dict.signature is None:
+            return False
+        return hmac_verify_string(query_dict.signed_text, query_dict.signature, api_key)
+
     # Reject if any key appears more than once
     if any(len(l) > 1 for _, l in query_dict.lists()):
         return False
@@ -129,79 +305,648 @@ def is_request_signature_valid(query_dict, api_key):
     return hmac_verify_string(text, signature, api_key)
 
 
+class Verification:
+    """State of a verification request passed from one validation stage to the next
+
+    Attributes:
+        query_dict: request parameters.
+        registry: metrics `Registry`, or `None`.
+        response: `VerificationResponse` filled by the stages.
+        key: `SigningKey` of the client once it is authenticated, used to sign the response.
+    """
+
+    __slots__ = (
+        'query_dict', 'registry', 'response', 'key', 'token', 'nonce', 'sync_level', 'sync_timeout', 'public_id',
+        'key_material', 'otp',
+    )
+
+    def __init__(self, query_dict, registry=None):
+        self.query_dict = query_dict
+        self.registry = registry
+        self.response = VerificationResponse(
+            t=datetime.datetime.utcnow().isoformat(),
+        )
+        self.key = None
+
+
+def check_parameters(verification):
+    """Checks the syntax of the request parameters, without I/O"""
+    query_dict = verification.query_dict
+    required_fields = ['id', 'otp', 'nonce']
+    if not all(name in query_dict for name in required_fields):
+        return ValidationStatus.MISSING_PARAMETER
+
+    nonce = query_dict.getlist('nonce')[0]
+    if '\r' in nonce or '\n' in nonce:
+        return ValidationStatus.MISSING_PARAMETER
+    verification.nonce = nonce
+    verification.response['nonce'] = nonce
+
+    try:
+        verification.sync_level = parse_sync_level(query_dict.get('sl'))
+        verification.sync_timeout = parse_sync_timeout(query_dict.get('timeout'))
+    except ValueError:
+        return ValidationStatus.MISSING_PARAMETER
+
+    # As in the reference validation server, malformed OTPs are rejected before the client is authenticated:
+    token = query_dict.getlist('otp')[0]
+    if not OTP_RE.fullmatch(token):
+        return ValidationStatus.BAD_OTP
+    verification.token = token
+
+    if not query_dict['id'].isdigit():
+        return ValidationStatus.NO_SUCH_CLIENT
+
+
+def check_client(verification):
+    verification.key = get_signing_key_or_none(verification.query_dict['id'])
+    if verification.key is None:
+        return ValidationStatus.NO_SUCH_CLIENT
+
+
+def check_signature(verification):
+    if not is_request_signature_valid(verification.query_dict, verification.key):
+        return ValidationStatus.BAD_SIGNATURE
+
+
+def check_nonce(verification):
+    # Only the nonces of authenticated requests are remembered, so that forged requests cannot reserve them:
+    if is_nonce_replayed(verification.query_dict['id'], verification.nonce):
+        return ValidationStatus.REPLAYED_REQUEST
+
+
+def check_device(verification):
+    verification.response['otp'] = verification.token
+    verification.public_id = verification.token[:2 * DEVICE_PUBLIC_ID_BYTE_LENGTH]
+    verification.key_material = get_device_key_material_or_none(verification.public_id)
+    if verification.key_material is None:
+        return ValidationStatus.BAD_OTP
+
+
+def check_otp(verification):
+    """Decrypts the OTP and checks its private ID"""
+    try:
+        with timer(verification.registry, 'yubival_decrypt_duration_seconds'):
+            otp = verification.key_material.decode_otp(verification.token.encode('utf-8'))
+    except Exception:
+        return ValidationStatus.BAD_OTP
+
+    verification.otp = otp
+    response = verification.response
+    response['sessionuse'] = otp.session
+    response['sessioncounter'] = otp.counter
+    response['timestamp'] = otp.timestamp
+
+    if otp.uid != verification.key_material.private_id:
+        return ValidationStatus.BAD_OTP
+
+
+def check_counters(verification):
+    """Stores the OTP counters if they are more recent than the stored ones, and accepts the OTP"""
+    public_id = verification.public_id
+    key_material = verification.key_material
+    counters = (verification.otp.session, verification.otp.counter)
+    digest = request_digest(verification.token, verification.nonce)
+    store = get_counter_store()
+    with timer(verification.registry, 'yubival_counter_update_duration_seconds'):
+        updated = store.advance(public_id, counters, key_material, digest)
+    if not updated:
+        # The same request was sent to a peer, which accepted it and synchronized its counters first:
+        if store.is_accepted(public_id, counters, digest):
+            return ValidationStatus.REPLAYED_REQUEST
+        if device_filter(public_id, key_material).exists():
+            return ValidationStatus.REPLAYED_OTP
+        # The device was deleted or its keys changed since they were cached:
+        device_cache.invalidate(public_id)
+        return ValidationStatus.BAD_OTP
+
+    verification.response['status'] = ValidationStatus.OK.value
+    verification.response['sl'] = 1
+
+
+def sync_counters(verification):
+    """Sends the counters of the accepted OTP to the peers and waits for their answers"""
+    pool = get_sync_pool()
+    otp = verification.otp
+    futures = start_counters_sync(
+        pool, verification.public_id, (otp.session, otp.counter), verification.token, verification.nonce,
+        verification.sync_timeout,
+    )
+    result = pool.wait(futures, verification.sync_level, verification.sync_timeout)
+    apply_sync_result(result, [verification.response])
+
+
+# Validation stages of `verify_response`, named after their `StageTimings` mark. Each stage returns the
+# `ValidationStatus` of a rejected request, or `None` to continue. Cheap checks come first, so that malformed requests
+# are rejected before any I/O.
+VERIFICATION_STAGES = (
+    ('parse', check_parameters),
+    ('api_key', check_client),
+    ('signature', check_signature),
+    ('nonce', check_nonce),
+    ('device', check_device),
+    ('decrypt', check_otp),
+    ('counter', check_counters),
+)
+SYNC_STAGE = ('sync', sync_counters)
+
+
+def verify_response(query_dict, registry, stages):
+    """Validates the OTP of a verification request by running the `VERIFICATION_STAGES`
+
+    Args:
+        query_dict: request parameters.
+        registry: metrics `Registry`, or `None`.
+        stages: `StageTimings` marked at the end of each validation stage.
+
+    Returns:
+        response: `VerificationResponse`.
+        key: `SigningKey` of the client if the response should be signed, or `None`.
+    """
+    verification = Verification(query_dict, registry)
+    pipeline = VERIFICATION_STAGES if get_sync_pool() is None else VERIFICATION_STAGES + (SYNC_STAGE,)
+    for name, stage in pipeline:
+        status = stage(verification)
+        stages.mark(name)
+        if status is not None:
+            verification.response['status'] = status.value
+            break
+
+    return verification.response, verification.key
+
+
+def start_counters_sync(pool, public_id, counters, token, nonce, timeout):
+    """Sends the counters of an accepted OTP to the peers of a `SyncPool` and returns the futures of their answers
+
+    The OTP `token` and `nonce` of the verification request are sent along with the counters, so that a peer which
+    already accepted the same request does not take it for a replay.
+    """
+    key = SigningKey(pool.key)
+    q = QueryDict('', mutable=True)
+    q.update({
+        'public_id': public_id,
+        'session_counter': str(counters[0]),
+        'usage_counter': str(counters[1]),
+        'otp': token,
+        'nonce': nonce,
+    })
+    q['h'] = hmac_sign_string(ordered_parameters_string(q, escape=True), key)
+    query = q.urlencode()
+
+    def send(peer):
+        params = parse_response(pool.transport(peer, query, timeout))
+        if not is_response_signature_valid(params, key):
+            raise ValueError('Invalid signature of the answer of %s' % peer)
+        if params.get('nonce') != nonce or params.get('public_id') != public_id or params.get('otp') != token:
+            raise ValueError('Answer of %s does not match the request' % peer)
+        return params.get('status')
+
+    return pool.start(send)
+
+
+def apply_sync_result(result, responses):
+    """Updates the responses of accepted OTPs with the outcome of their synchronization with the peers"""
+    for response in responses:
+        response['sl'] = result.level
+        if result.status == SYNC_REPLAYED_OTP:
+            response['status'] = ValidationStatus.REPLAYED_OTP.value
+        elif result.status == SYNC_NOT_ENOUGH_ANSWERS:
+            response['status'] = ValidationStatus.NOT_ENOUGH_ANSWERS.value
+
+
+def client_label(query_dict, key):
+    """Returns the API client ID used in metric labels, which is empty if the client is not authenticated"""
+    return str(int(query_dict['id'])) if key is not None else ''
+
+
+def verify(query_dict, stages=NULL_STAGE_TIMINGS):
+    """Validates the OTP of a verification request and returns the HTTP response"""
+    registry = get_registry()
+    if registry is None:
+        response, key = verify_response(query_dict, None, stages)
+        http_response = response.http_response(key)
+        stages.mark('sign')
+        return http_response
+
+    start = time.perf_counter()
+    response, key = verify_response(query_dict, registry, stages)
+    http_response = response.http_response(key)
+    stages.mark('sign')
+    registry.inc('yubival_responses_total', ('verify', response['status'], client_label(query_dict, key)))
+    registry.observe('yubival_request_duration_seconds', time.perf_counter() - start, ('verify',))
+    return http_response
+
+
+def batch_items(query_dict, max_size):
+    """Returns the (otp, nonce) pairs of a batch request, given as `otp1`, `nonce1`, `otp2`, `nonce2`...
+
+    At most `max_size + 1` pairs are returned, which is enough to detect oversized batches.
+    """
+    items = []
+    while len(items) <= max_size:
+        n = len(items) + 1
+        otp_name = 'otp%d' % n
+        nonce_name = 'nonce%d' % n
+        if otp_name not in query_dict and nonce_name not in query_dict:
+            break
+        items.append((query_dict.get(otp_name), query_dict.get(nonce_name)))
+    return items
+
+
+def advance_batch_device_counters(store, public_id, key_material, decoded_otps, counters):
+    """Accepts the OTPs of a device that are more recent than its counters, in increasing counter order
+
+    Args:
+        store: `CounterStore` holding the device counters.
+        public_id: device public ID.
+        key_material: `DeviceKeyMaterial` used to decode the OTPs.
+        decoded_otps: list of `(otp, result)` pairs, where `result` is the response dictionary of the OTP, with its
+            `otp` and `nonce`.
+        counters: device counters read from `store`, or `None` if the device does not exist.
+    """
+    for _ in range(BATCH_UPDATE_ATTEMPTS):
+        if counters is None:
+            break
+
+        new_counters = counters
+        digest = ''
+        for otp, result in sorted(decoded_otps, key=lambda item: (item[0].session, item[0].counter)):
+            otp_digest = request_digest(result['otp'], result['nonce'])
+            if (otp.session, otp.counter) > new_counters:
+                new_counters = (otp.session, otp.counter)
+                digest = otp_digest
+                result['status'] = ValidationStatus.OK.value
+            elif (otp.session, otp.counter) == counters and store.is_accepted(public_id, counters, otp_digest):
+                # The same request was sent to a peer, which accepted it and synchronized its counters first:
+                result['status'] = ValidationStatus.REPLAYED_REQUEST.value
+            else:
+                result['status'] = ValidationStatus.REPLAYED_OTP.value
+
+        if new_counters == counters or store.compare_and_set(public_id, counters, new_counters, key_material, digest):
+            return
+
+        if not device_filter(public_id, key_material).exists():
+            break
+
+        # The counters were concurrently updated:
+        counters = store.get([public_id]).get(public_id)
+    else:
+        for _, result in decoded_otps:
+            result['status'] = ValidationStatus.BACKEND_ERROR.value
+        return
+
+    # The device was deleted or its keys changed since they were cached:
+    device_cache.invalidate(public_id)
+    for _, result in decoded_otps:
+        result['status'] = ValidationStatus.BAD_OTP.value
+
+
+def verify_otps(client_id, items, registry=None, sync_level=0, sync_timeout=1):
+    """Validates a list of (otp, nonce) pairs of a client and returns the list of their response dictionaries
+
+    The counters of all devices are read at once and updated in a single transaction of each database storing them.
+    Several OTPs of the same device are checked in increasing counter order, so that all of them can be accepted
+    regardless of their order in `items`.
+    The most recent accepted counters of each device are then synchronized with the peers, if any, and the accepted
+    OTPs of a device get the outcome of that synchronization.
+    """
+    results = [{} for _ in items]
+
+    pending = []
+    for (token, nonce), result in zip(items, results):
+        if token is None or nonce is None or '\r' in nonce or '\n' in nonce:
+            result['status'] = ValidationStatus.MISSING_PARAMETER.value
+            continue
+        result['nonce'] = nonce
+
+        if is_nonce_replayed(client_id, nonce):
+            result['status'] = ValidationStatus.REPLAYED_REQUEST.value
+            continue
+
+        if not OTP_RE.fullmatch(token):
+            result['status'] = ValidationStatus.BAD_OTP.value
+            continue
+        result['otp'] = token
+        pending.append((token, result))
+
+    key_materials = get_devices_key_material(token[:12] for token, _ in pending)
+
+    decoded = defaultdict(list)
+    for token, result in pending:
+        public_id = token[:12]
+        key_material = key_materials.get(public_id)
+        if key_material is None:
+            result['status'] = ValidationStatus.BAD_OTP.value
+            continue
+
+        try:
+            with timer(registry, 'yubival_decrypt_duration_seconds'):
+                otp = key_material.decode_otp(token.encode('utf-8'))
+        except Exception:
+            result['status'] = ValidationStatus.BAD_OTP.value
+            continue
+
+        result['sessionuse'] = otp.session
+        result['sessioncounter'] = otp.counter
+        result['timestamp'] = otp.timestamp
+
+        if otp.uid != key_material.private_id:
+            result['status'] = ValidationStatus.BAD_OTP.value
+            continue
+
+        decoded[public_id].append((otp, result))
+
+    if decoded:
+        store = get_counter_store()
+        with timer(registry, 'yubival_counter_update_duration_seconds'), atomic_devices(decoded):
+            counters = store.get(decoded)
+            for public_id, decoded_otps in decoded.items():
+                advance_batch_device_counters(
+                    store, public_id, key_materials[public_id], decoded_otps, counters.get(public_id),
+                )
+
+        pool = get_sync_pool()
+        if pool is not None:
+            synchronized = []
+            for public_id, decoded_otps in decoded.items():
+                accepted = [
+                    (otp, result) for otp, result in decoded_otps if result['status'] == ValidationStatus.OK.value
+                ]
+                if accepted:
+                    otp, result = max(accepted, key=lambda item: (item[0].session, item[0].counter))
+                    futures = start_counters_sync(
+                        pool, public_id, (otp.session, otp.counter), result['otp'], result['nonce'], sync_timeout,
+                    )
+                    synchronized.append((futures, [result for _, result in accepted]))
+
+            deadline = time.monotonic() + sync_timeout
+            for futures, accepted_results in synchronized:
+                result = pool.wait(futures, sync_level, max(deadline - time.monotonic(), 0))
+                apply_sync_result(result, accepted_results)
+
+    return results
+
+
+def verify_batch_response(query_dict, registry, stages):
+    """Validates the OTPs of a batch verification request
+
+    Returns the response parameters and the signing key of the client, like `verify_response`. The response holds a
+    global `status` for the request and, for each OTP number n, the fields of a single OTP verification response
+    suffixed with n (`status1`, `otp1`, `nonce1`...).
+    """
+    response = VerificationResponse(
+        t=datetime.datetime.utcnow().isoformat(),
+    )
+
+    max_size = get_setting('YUBIVAL_BATCH_MAX_SIZE')
+    items = batch_items(query_dict, max_size)
+    stages.mark('parse')
+    if 'id' not in query_dict or not items:
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response, None
+
+    key = get_signing_key_or_none(query_dict['id'])
+    stages.mark('api_key')
+    if key is None:
+        response['status'] = ValidationStatus.NO_SUCH_CLIENT.value
+        return response, None
+
+    valid = is_request_signature_valid(query_dict, key)
+    stages.mark('signature')
+    if not valid:
+        response['status'] = ValidationStatus.BAD_SIGNATURE.value
+        return response, key
+
+    if len(items) > max_size:
+        response['status'] = ValidationStatus.OPERATION_NOT_ALLOWED.value
+        return response, key
+
+    try:
+        sync_level = parse_sync_level(query_dict.get('sl'))
+        sync_timeout = parse_sync_timeout(query_dict.get('timeout'))
+    except ValueError:
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response, key
+
+    results = verify_otps(query_dict['id'], items, registry, sync_level, sync_timeout)
+    stages.mark('otps')
+    for n, result in enumerate(results, 1):
+        for name, value in result.items():
+            response['%s%d' % (name, n)] = value
+
+    response['status'] = ValidationStatus.OK.value
+    response['sl'] = 1
+    return response, key
+
+
+def verify_batch(query_dict, stages=NULL_STAGE_TIMINGS):
+    """Validates the OTPs of a batch verification request and returns the HTTP response"""
+    registry = get_registry()
+    if registry is None:
+        response, key = verify_batch_response(query_dict, None, stages)
+        http_response = response.http_response(key)
+        stages.mark('sign')
+        return http_response
+
+    start = time.perf_counter()
+    response, key = verify_batch_response(query_dict, registry, stages)
+    http_response = response.http_response(key)
+    stages.mark('sign')
+    client = client_label(query_dict, key)
+    registry.inc('yubival_responses_total', ('verify_batch', response['status'], client))
+    for name, value in response.items():
+        if name.startswith('status') and name != 'status':
+            registry.inc('yubival_batch_otps_total', (value, client))
+    registry.observe('yubival_request_duration_seconds', time.perf_counter() - start, ('verify_batch',))
+    return http_response
+
+
+def timed_verification(func, request, query_dict):
+    """Calls a verification function, adding stage timings to its response if `YUBIVAL_STAGE_TIMING` is enabled"""
+    stages = get_stage_timings()
+    if stages is None:
+        return func(query_dict)
+    response = func(query_dict, stages)
+    report_stage_timings(request, response, stages)
+    return response
+
+
+def query_parameters(request):
+    """Returns the query string parameters of a request, parsed by `SignedQuery` unless they are not ASCII"""
+    query = SignedQuery.from_request(request)
+    return request.GET if query is None else query
+
+
 class VerifyView(View):
     def get(self, request, *args, **kwargs):
-        response = {
-            't': datetime.datetime.utcnow().isoformat(),
-        }
+        return timed_verification(verify, request, query_parameters(request))
 
-        required_fields = ['id', 'otp', 'nonce']
-        if not all(name in request.GET for name in required_fields):
-            response['status'] = ValidationStatus.MISSING_PARAMETER.value
-            return http_text_response(response)
 
-        token = request.GET.getlist('otp')[0]
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchVerifyView(View):
+    def get(self, request, *args, **kwargs):
+        return timed_verification(verify_batch, request, query_parameters(request))
 
-        nonce = request.GET.getlist('nonce')[0]
-        if '\r' in nonce or '\n' in nonce:
-            response['status'] = ValidationStatus.MISSING_PARAMETER.value
-            return http_text_response(response)
+    def post(self, request, *args, **kwargs):
+        return timed_verification(verify_batch, request, request.POST)
 
-        response['nonce'] = nonce
 
-        api_key = get_api_key_or_none(request.GET['id'])
-        if api_key is None:
-            response['status'] = ValidationStatus.NO_SUCH_CLIENT.value
-            return http_text_response(response)
+_executor = None
+_executor_lock = threading.Lock()
 
-        key = base64.b64decode(api_key.key)
 
-        if not is_request_signature_valid(request.GET, key):
-            response['status'] = ValidationStatus.BAD_SIGNATURE.value
-            return signed_http_text_response(response, key)
+def get_executor():
+    """Returns the thread pool running the blocking parts of asynchronous verifications"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=get_setting('YUBIVAL_ASYNC_THREADS'),
+                    thread_name_prefix='yubival',
+                )
+    return _executor
 
-        if len(token) != 44 or '\r' in token or '\n' in token:
-            response['status'] = ValidationStatus.BAD_OTP.value
-            return signed_http_text_response(response, key)
 
-        response['otp'] = token
+def run_with_db_connection(func, *args):
+    # Mimics the connection management Django performs around each request:
+    close_old_connections()
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+def mark_coroutine_function(func):
+    """Marks `func` so that Django awaits it, with `asgiref.sync.markcoroutinefunction` if available (asgiref >= 3.6)"""
+    if markcoroutinefunction is not None:
+        return markcoroutinefunction(func)
+    func._is_coroutine = asyncio.coroutines._is_coroutine
+    return func
 
-        public_id = token[:12]
-        devices = Device.objects.select_for_update().filter(public_id=public_id)
-        with transaction.atomic():
-            try:
-                device = devices.get()
-            except Device.DoesNotExist:
-                response['status'] = ValidationStatus.BAD_OTP.value
-                return signed_http_text_response(response, key)
-
-            try:
-                _, otp = decode_otp(token.encode('utf-8'), bytes.fromhex(device.key))
-            except Exception:
-                response['status'] = ValidationStatus.BAD_OTP.value
-                return signed_http_text_response(response, key)
-
-            response['sessionuse'] = otp.session
-            response['sessioncounter'] = otp.counter
-            response['timestamp'] = otp.timestamp
-
-            if hexlify(otp.uid) != device.private_id.encode('utf-8'):
-                response['status'] = ValidationStatus.BAD_OTP.value
-                return signed_http_text_response(response, key)
-
-            if otp.session < device.session_counter:
-                response['status'] = ValidationStatus.REPLAYED_OTP.value
-                return signed_http_text_response(response, key)
-
-            if (otp.session == device.session_counter) and (otp.counter <= device.usage_counter):
-                response['status'] = ValidationStatus.REPLAYED_OTP.value
-                return signed_http_text_response(response, key)
-
-            # OTP is valid; we update the counters:
-            device.session_counter = otp.session
-            device.usage_counter = otp.counter
-            device.save()
 
+async def run_in_executor(func, *args):
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), run_with_db_connection, func, *args)
+
+
+async def timed_verification_in_executor(func, request, query_dict):
+    """Asynchronous version of `timed_verification`, running the verification in the executor"""
+    stages = get_stage_timings()
+    if stages is None:
+        return await run_in_executor(func, query_dict)
+    response = await run_in_executor(func, query_dict, stages)
+    report_stage_timings(request, response, stages)
+    return response
+
+
+class AsyncVerifyView(View):
+    """Asynchronous version of `VerifyView` for ASGI deployments
+
+    Verifications run on a dedicated pool of `YUBIVAL_ASYNC_THREADS` threads instead of the single thread Django uses
+    for synchronous views. The event loop still accepts other requests, but at most `YUBIVAL_ASYNC_THREADS`
+    verifications run concurrently: the others wait for a free thread.
+    """
+
+    verify = staticmethod(verify)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Django < 4.1 does not detect asynchronous class-based views:
+        if django.VERSION < (4, 1):
+            view = mark_coroutine_function(view)
+        return view
+
+    async def get(self, request, *args, **kwargs):
+        return await timed_verification_in_executor(self.verify, request, query_parameters(request))
+
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
+
+    async def http_method_not_allowed(self, request, *args, **kwargs):
+        return super().http_method_not_allowed(request, *args, **kwargs)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncBatchVerifyView(AsyncVerifyView):
+    """Asynchronous version of `BatchVerifyView` for ASGI deployments"""
+
+    verify = staticmethod(verify_batch)
+
+    async def post(self, request, *args, **kwargs):
+        return await timed_verification_in_executor(self.verify, request, request.POST)
+
+
+def sync_response(query_dict, store=None):
+    """Handles a synchronization request of a peer and returns the parameters of the answer
+
+    The counters of the request are stored in `store`, or in the configured counter store, if they are more recent than
+    the stored ones. The answer status is `OK` if they were, or if they were already stored for the same OTP and nonce,
+    as when a client sends the same verification request to several servers. It is `REPLAYED_OTP` if the OTP or a
+    more recent one was accepted for another request.
+    """
+    response = VerificationResponse(
+        t=datetime.datetime.utcnow().isoformat(),
+    )
+
+    required_fields = ['public_id', 'session_counter', 'usage_counter', 'otp', 'nonce']
+    if not all(name in query_dict for name in required_fields):
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response
+
+    public_id = query_dict['public_id']
+    token = query_dict['otp']
+    nonce = query_dict['nonce']
+    if any('\r' in value or '\n' in value for value in (public_id, token, nonce)):
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response
+    response['nonce'] = nonce
+    response['public_id'] = public_id
+    response['otp'] = token
+
+    if not is_request_signature_valid(query_dict, get_sync_key()):
+        response['status'] = ValidationStatus.BAD_SIGNATURE.value
+        return response
+
+    try:
+        counters = (int(query_dict['session_counter']), int(query_dict['usage_counter']))
+    except ValueError:
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response
+    # Counters out of the ranges of the OTP fields would not be packed in order by the counter stores:
+    if not (0 <= counters[0] <= 0xffff and 0 <= counters[1] <= 0xff):
+        response['status'] = ValidationStatus.MISSING_PARAMETER.value
+        return response
+
+    store = store or get_counter_store()
+    digest = request_digest(token, nonce)
+    key_material = get_device_key_material_or_none(public_id)
+    if key_material is None:
+        response['status'] = ValidationStatus.BAD_OTP.value
+    elif store.advance(public_id, counters, key_material, digest) or store.is_accepted(public_id, counters, digest):
         response['status'] = ValidationStatus.OK.value
-        response['sl'] = 1
-        return signed_http_text_response(response, key)
+    elif device_filter(public_id, key_material).exists():
+        response['status'] = ValidationStatus.REPLAYED_OTP.value
+    else:
+        device_cache.invalidate(public_id)
+        response['status'] = ValidationStatus.BAD_OTP.value
+    return response
+
+
+class SyncView(View):
+    """Endpoint receiving the counters of the OTPs accepted by the peers, enabled by `YUBIVAL_SYNC_KEY`"""
+
+    def get(self, request, *args, **kwargs):
+        key = get_sync_key()
+        if key is None:
+            raise Http404
+        return sync_response(query_parameters(request)).http_response(key)
+
+
+def metrics_view(request):
+    """Exposes the validation metrics of all worker processes in the Prometheus text format"""
+    registry = get_registry()
+    if registry is None:
+        raise Http404
+    return HttpResponse(prometheus_text(*registry.collect()), content_type='text/plain; version=0.0.4; charset=utf-8')
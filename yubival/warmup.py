@@ -0,0 +1,108 @@
+import base64
+import logging
+import os
+import sys
+import time
+
+from django.db import DatabaseError, connections, router
+
+from yubival.bloom import public_id_filter
+from yubival.cache import api_key_cache, device_cache
+from yubival.conf import get_setting
+from yubival.models import APIKey, Device
+from yubival.sharding import device_databases
+from yubival.views import DeviceKeyMaterial, SigningKey
+
+
+logger = logging.getLogger(__name__)
+
+# Management commands that serve requests, and warm up the caches when `YUBIVAL_WARM_UP` is enabled:
+SERVING_COMMANDS = frozenset(['runserver'])
+
+
+def load_api_keys(count):
+    """Returns the `(id, SigningKey)` pairs of the `count` most recently created API keys"""
+    rows = APIKey.objects.order_by('-id').values_list('id', 'key')[:count]
+    return [(key_id, SigningKey(base64.b64decode(key))) for key_id, key in rows]
+
+
+def load_devices(count):
+    """Returns the `(public_id, DeviceKeyMaterial)` pairs of up to `count` devices, split between the shards
+
+    Devices do not record when they were last used: the most recently created devices that validated at least one OTP
+    are loaded.
+    """
+    databases = device_databases()
+    per_database = -(-count // len(databases))
+    items = []
+    for using in databases:
+        used_devices = Device.objects.using(using).exclude(counter__value=0)
+        rows = used_devices.order_by('-id').values_list('public_id', 'private_id', 'key')
+        rows = rows[:min(per_database, count - len(items))]
+        items.extend((public_id, DeviceKeyMaterial(private_id, key)) for public_id, private_id, key in rows)
+    return items
+
+
+def warm_up():
+    """Preloads API keys and device keys, with their HMAC and AES states, in the in-process caches
+
+    The public ID filter is also built if `YUBIVAL_PUBLIC_ID_FILTER` is enabled.
+
+    Returns:
+        api_key_count: number of preloaded API keys, up to the cache size.
+        device_count: number of preloaded devices, up to `YUBIVAL_WARM_UP_DEVICES` and the cache size.
+        duration: warm-up duration in seconds.
+    """
+    start = time.monotonic()
+    api_key_count = api_key_cache.fill(lambda: load_api_keys(api_key_cache.lru.maxsize))
+    device_count = device_cache.fill(
+        lambda: load_devices(min(get_setting('YUBIVAL_WARM_UP_DEVICES'), device_cache.lru.maxsize)),
+    )
+    if get_setting('YUBIVAL_PUBLIC_ID_FILTER'):
+        public_id_filter.build()
+    duration = time.monotonic() - start
+    logger.info('Preloaded %d API keys and %d devices in %.3f s.', api_key_count, device_count, duration)
+    return api_key_count, device_count, duration
+
+
+def management_command(argv=None):
+    """Returns the name of the management command run by this process, or `None` if it is not run by `manage.py`,
+    `django-admin` or `python -m django`
+    """
+    argv = sys.argv if argv is None else argv
+    if not argv:
+        return
+    program = os.path.basename(argv[0])
+    # `python -m django` runs the `__main__` module of the django package:
+    if program == '__main__.py' and os.path.basename(os.path.dirname(argv[0])) == 'django':
+        program = 'django-admin'
+    if program in ('manage.py', 'django-admin', 'django-admin.py'):
+        return argv[1] if len(argv) > 1 else 'help'
+
+
+def is_serving(argv=None):
+    """Returns whether this process serves requests, rather than running a management command such as `migrate`"""
+    command = management_command(argv)
+    return command is None or command in SERVING_COMMANDS
+
+
+def warm_up_before_fork():
+    """Runs `warm_up` when the application is loaded, then closes the database connections
+
+    Worker processes forked from a preloaded application share the cached entries, but must not share the database
+    connections of their parent. Warm-up is skipped if the tables are missing, for instance before migrations.
+    """
+    try:
+        warm_up()
+    except DatabaseError as e:
+        logger.warning('Skipped cache warm-up: %s', e)
+    finally:
+        connections.close_all()
+
+
+def connect_databases():
+    """Opens the database connections of the API keys and devices, for instance from a gunicorn `post_fork` hook"""
+    databases = {router.db_for_read(APIKey)}
+    databases.update(using or router.db_for_read(Device) for using in device_databases())
+    for using in databases:
+        connections[using].ensure_connection()